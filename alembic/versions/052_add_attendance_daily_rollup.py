@@ -0,0 +1,81 @@
+"""Add attendance_daily_rollup table
+
+Revision ID: 052
+Revises: 051
+Create Date: 2026-10-17 09:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '052'
+down_revision = '051'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    """Apply the migration - create and backfill attendance_daily_rollup"""
+    try:
+        op.create_table('attendance_daily_rollup',
+                        sa.Column('company_id', sa.Integer(), nullable=False),
+                        sa.Column('task_id', sa.Integer(), nullable=False),
+                        sa.Column('worker_id', sa.Integer(), nullable=False),
+                        sa.Column('date', sa.Date(), nullable=False),
+                        sa.Column('present', sa.Boolean(), nullable=False, server_default=sa.false()),
+                        sa.Column('units', sa.Integer(), nullable=False, server_default='0'),
+                        sa.Column('hours', sa.Float(), nullable=False, server_default='0'),
+                        sa.PrimaryKeyConstraint('company_id', 'task_id', 'worker_id', 'date'))
+        print("✅ Created attendance_daily_rollup table")
+    except Exception as e:
+        print(f"Table may already exist: {e}")
+        pass
+
+    try:
+        op.create_index('idx_attendance_rollup_company_date',
+                       'attendance_daily_rollup',
+                       ['company_id', 'date'],
+                       if_not_exists=True)
+        print("✅ Created index idx_attendance_rollup_company_date")
+    except Exception as e:
+        print(f"Index may already exist: {e}")
+        pass
+
+    # Backfill from existing attendance; several rows for the same day count once
+    try:
+        connection = op.get_bind()
+        existing = connection.execute(sa.text("SELECT COUNT(*) FROM attendance_daily_rollup")).scalar()
+        if not existing:
+            connection.execute(sa.text("""
+                INSERT INTO attendance_daily_rollup (company_id, task_id, worker_id, date, present, units, hours)
+                SELECT company_id, task_id, worker_id, date,
+                       MAX(CASE WHEN status = 'Present' THEN 1 ELSE 0 END) = 1,
+                       COALESCE(SUM(units_completed), 0),
+                       COALESCE(SUM(hours_worked), 0)
+                FROM attendance
+                GROUP BY company_id, task_id, worker_id, date
+            """))
+            print("✅ Backfilled attendance_daily_rollup from attendance")
+    except Exception as e:
+        print(f"Could not backfill attendance_daily_rollup: {e}")
+        pass
+
+
+def downgrade() -> None:
+    """Revert the migration - drop the rollup table"""
+    try:
+        op.drop_index('idx_attendance_rollup_company_date',
+                     table_name='attendance_daily_rollup')
+        print("✅ Dropped index idx_attendance_rollup_company_date")
+    except Exception as e:
+        print(f"Index doesn't exist or couldn't be dropped: {e}")
+        pass
+
+    try:
+        op.drop_table('attendance_daily_rollup')
+        print("✅ Dropped attendance_daily_rollup table")
+    except Exception as e:
+        print(f"Table doesn't exist or couldn't be dropped: {e}")
+        pass
@@ -0,0 +1,38 @@
+"""Add report_data_version column to company table
+
+Revision ID: 053
+Revises: 052
+Create Date: 2026-10-17 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '053'
+down_revision = '052'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    """Apply the migration - add report_data_version column"""
+    try:
+        op.add_column('company',
+                     sa.Column('report_data_version', sa.Integer(),
+                              nullable=False, server_default='0'))
+        print("✅ Added report_data_version column to company")
+    except Exception as e:
+        print(f"Column may already exist: {e}")
+        pass
+
+
+def downgrade() -> None:
+    """Revert the migration - remove the column"""
+    try:
+        op.drop_column('company', 'report_data_version')
+        print("✅ Removed report_data_version column from company")
+    except Exception as e:
+        print(f"Column doesn't exist or couldn't be dropped: {e}")
+        pass
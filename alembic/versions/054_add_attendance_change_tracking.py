@@ -0,0 +1,79 @@
+"""Add attendance.updated_at and the attendance_tombstone table
+
+Revision ID: 054
+Revises: 053
+Create Date: 2026-10-17 11:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '054'
+down_revision = '053'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    """Apply the migration - add change tracking for delta report exports"""
+    # Existing rows keep a NULL updated_at: they predate any watermark a client can hold
+    try:
+        op.add_column('attendance', sa.Column('updated_at', sa.DateTime(), nullable=True))
+        print("✅ Added updated_at column to attendance")
+    except Exception as e:
+        print(f"Column may already exist: {e}")
+        pass
+
+    try:
+        op.create_index('idx_attendance_company_updated',
+                       'attendance',
+                       ['company_id', 'updated_at'],
+                       if_not_exists=True)
+        print("✅ Created index idx_attendance_company_updated")
+    except Exception as e:
+        print(f"Index may already exist: {e}")
+        pass
+
+    try:
+        op.create_table('attendance_tombstone',
+                        sa.Column('id', sa.Integer(), nullable=False),
+                        sa.Column('company_id', sa.Integer(), nullable=False),
+                        sa.Column('worker_id', sa.Integer(), nullable=False),
+                        sa.Column('task_id', sa.Integer(), nullable=False),
+                        sa.Column('date', sa.Date(), nullable=False),
+                        sa.Column('deleted_at', sa.DateTime(), nullable=False),
+                        sa.PrimaryKeyConstraint('id'))
+        print("✅ Created attendance_tombstone table")
+    except Exception as e:
+        print(f"Table may already exist: {e}")
+        pass
+
+    try:
+        op.create_index('idx_attendance_tombstone_company_deleted',
+                       'attendance_tombstone',
+                       ['company_id', 'deleted_at'],
+                       if_not_exists=True)
+        print("✅ Created index idx_attendance_tombstone_company_deleted")
+    except Exception as e:
+        print(f"Index may already exist: {e}")
+        pass
+
+
+def downgrade() -> None:
+    """Revert the migration - remove change tracking"""
+    try:
+        op.drop_table('attendance_tombstone')
+        print("✅ Dropped attendance_tombstone table")
+    except Exception as e:
+        print(f"Table doesn't exist or couldn't be dropped: {e}")
+        pass
+
+    try:
+        op.drop_index('idx_attendance_company_updated', table_name='attendance')
+        op.drop_column('attendance', 'updated_at')
+        print("✅ Removed updated_at column from attendance")
+    except Exception as e:
+        print(f"Column doesn't exist or couldn't be dropped: {e}")
+        pass
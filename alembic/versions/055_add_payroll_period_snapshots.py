@@ -0,0 +1,63 @@
+"""Add payroll_period and payroll_snapshot_row tables
+
+Revision ID: 055
+Revises: 054
+Create Date: 2026-10-17 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '055'
+down_revision = '054'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    """Apply the migration - create the closed payroll period tables"""
+    try:
+        op.create_table('payroll_period',
+                        sa.Column('id', sa.Integer(), nullable=False),
+                        sa.Column('company_id', sa.Integer(), nullable=False),
+                        sa.Column('start_date', sa.Date(), nullable=False),
+                        sa.Column('end_date', sa.Date(), nullable=False),
+                        sa.Column('closed_at', sa.DateTime(), nullable=False),
+                        sa.Column('closed_by', sa.Integer(), nullable=True),
+                        sa.Column('field_layout', sa.Text(), nullable=False),
+                        sa.Column('row_count', sa.Integer(), nullable=False, server_default='0'),
+                        sa.ForeignKeyConstraint(['company_id'], ['company.id']),
+                        sa.ForeignKeyConstraint(['closed_by'], ['user.id']),
+                        sa.PrimaryKeyConstraint('id'),
+                        sa.UniqueConstraint('company_id', 'start_date', 'end_date',
+                                            name='uq_payroll_period_company_dates'))
+        print("✅ Created payroll_period table")
+    except Exception as e:
+        print(f"Table may already exist: {e}")
+        pass
+
+    try:
+        op.create_table('payroll_snapshot_row',
+                        sa.Column('period_id', sa.Integer(), nullable=False),
+                        sa.Column('payout_type', sa.String(length=20), nullable=False),
+                        sa.Column('position', sa.Integer(), nullable=False),
+                        sa.Column('data', sa.Text(), nullable=False),
+                        sa.ForeignKeyConstraint(['period_id'], ['payroll_period.id'], ondelete='CASCADE'),
+                        sa.PrimaryKeyConstraint('period_id', 'payout_type', 'position'))
+        print("✅ Created payroll_snapshot_row table")
+    except Exception as e:
+        print(f"Table may already exist: {e}")
+        pass
+
+
+def downgrade() -> None:
+    """Revert the migration - drop the closed payroll period tables"""
+    try:
+        op.drop_table('payroll_snapshot_row')
+        op.drop_table('payroll_period')
+        print("✅ Dropped payroll_period and payroll_snapshot_row tables")
+    except Exception as e:
+        print(f"Tables don't exist or couldn't be dropped: {e}")
+        pass
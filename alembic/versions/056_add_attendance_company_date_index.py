@@ -0,0 +1,39 @@
+"""Add an attendance (company_id, date) index for report previews
+
+Revision ID: 056
+Revises: 055
+Create Date: 2026-10-17 13:00:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '056'
+down_revision = '055'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    """Apply the migration - index attendance by company and date"""
+    # Lets the report preview read the latest rows with ORDER BY date DESC LIMIT n
+    try:
+        op.create_index('idx_attendance_company_date',
+                       'attendance',
+                       ['company_id', 'date'],
+                       if_not_exists=True)
+        print("✅ Created index idx_attendance_company_date")
+    except Exception as e:
+        print(f"Index may already exist: {e}")
+        pass
+
+
+def downgrade() -> None:
+    """Revert the migration - drop the attendance (company_id, date) index"""
+    try:
+        op.drop_index('idx_attendance_company_date', table_name='attendance')
+        print("✅ Dropped index idx_attendance_company_date")
+    except Exception as e:
+        print(f"Index doesn't exist or couldn't be dropped: {e}")
+        pass
@@ -0,0 +1,39 @@
+"""Add an attendance_daily_rollup (worker_id, date) index for worker history
+
+Revision ID: 057
+Revises: 056
+Create Date: 2026-10-17 14:00:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '057'
+down_revision = '056'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    """Apply the migration - index the rollup by worker and date"""
+    # Lets /api/worker/<id>/history page through one worker's days by date
+    try:
+        op.create_index('idx_attendance_rollup_worker_date',
+                       'attendance_daily_rollup',
+                       ['worker_id', 'date'],
+                       if_not_exists=True)
+        print("✅ Created index idx_attendance_rollup_worker_date")
+    except Exception as e:
+        print(f"Index may already exist: {e}")
+        pass
+
+
+def downgrade() -> None:
+    """Revert the migration - drop the rollup (worker_id, date) index"""
+    try:
+        op.drop_index('idx_attendance_rollup_worker_date', table_name='attendance_daily_rollup')
+        print("✅ Dropped index idx_attendance_rollup_worker_date")
+    except Exception as e:
+        print(f"Index doesn't exist or couldn't be dropped: {e}")
+        pass
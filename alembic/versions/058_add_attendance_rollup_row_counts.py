@@ -0,0 +1,65 @@
+"""Add attendance and Present row counts to attendance_daily_rollup
+
+Revision ID: 058
+Revises: 057
+Create Date: 2026-10-17 19:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '058'
+down_revision = '057'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    """Apply the migration - count attendance and Present rows per rollup day"""
+    for column in ('attendance_rows', 'present_rows'):
+        try:
+            op.add_column('attendance_daily_rollup',
+                         sa.Column(column, sa.Integer(), nullable=False, server_default='0'))
+            print(f"✅ Added {column} column to attendance_daily_rollup")
+        except Exception as e:
+            print(f"Column may already exist: {e}")
+            pass
+
+    # Fill the counts in from attendance for every existing rollup day
+    try:
+        connection = op.get_bind()
+        connection.execute(sa.text("""
+            UPDATE attendance_daily_rollup
+            SET attendance_rows = (
+                    SELECT COUNT(*) FROM attendance
+                    WHERE attendance.company_id = attendance_daily_rollup.company_id
+                      AND attendance.task_id = attendance_daily_rollup.task_id
+                      AND attendance.worker_id = attendance_daily_rollup.worker_id
+                      AND attendance.date = attendance_daily_rollup.date
+                ),
+                present_rows = (
+                    SELECT COUNT(*) FROM attendance
+                    WHERE attendance.company_id = attendance_daily_rollup.company_id
+                      AND attendance.task_id = attendance_daily_rollup.task_id
+                      AND attendance.worker_id = attendance_daily_rollup.worker_id
+                      AND attendance.date = attendance_daily_rollup.date
+                      AND attendance.status = 'Present'
+                )
+        """))
+        print("✅ Backfilled attendance_daily_rollup row counts from attendance")
+    except Exception as e:
+        print(f"Could not backfill attendance_daily_rollup row counts: {e}")
+        pass
+
+
+def downgrade() -> None:
+    """Revert the migration - remove the row count columns"""
+    for column in ('present_rows', 'attendance_rows'):
+        try:
+            op.drop_column('attendance_daily_rollup', column)
+            print(f"✅ Removed {column} column from attendance_daily_rollup")
+        except Exception as e:
+            print(f"Column doesn't exist or couldn't be dropped: {e}")
+            pass
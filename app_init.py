@@ -204,6 +204,10 @@ def master_admin_required(f):
 # Import routes to register them with the app early
 import routes
 
+# Register CLI maintenance commands
+from commands import register_commands
+register_commands(app)
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -0,0 +1,104 @@
+"""
+Attendance Changes
+==================
+
+Change tracking for delta report exports.
+
+Inserted and edited Attendance rows carry updated_at (set by the model on
+insert and update, including bulk UPDATEs). Deleted rows leave an
+AttendanceTombstone, written in the same transaction by the session events
+below, so a client holding a watermark also learns about removals.
+
+Tombstones are kept for ATTENDANCE_TOMBSTONE_RETENTION_DAYS and purged by
+`flask attendance purge-tombstones`; a watermark older than that could miss
+removals, so it is refused and the client takes a full export instead.
+"""
+
+from sqlalchemy import DateTime, delete, event, insert, literal, select, union
+from sqlalchemy.orm import Session
+from models import db, Attendance, AttendanceTombstone
+from datetime import datetime, timedelta
+import logging
+import os
+
+# Watermarks trail the clock by this much so rows written by transactions
+# still in flight when a delta is taken are picked up by the next one
+DELTA_WATERMARK_LAG_SECONDS = int(os.environ.get('DELTA_WATERMARK_LAG_SECONDS', 60))
+
+# How long deletions stay visible to delta exports
+ATTENDANCE_TOMBSTONE_RETENTION_DAYS = int(os.environ.get('ATTENDANCE_TOMBSTONE_RETENTION_DAYS', 90))
+
+
+@event.listens_for(Session, 'before_flush')
+def _tombstone_deleted_attendance(session, flush_context, instances):
+    """Leave a tombstone for every Attendance row deleted through the session"""
+    deleted_at = datetime.utcnow()
+    for obj in list(session.deleted):
+        if isinstance(obj, Attendance):
+            session.add(AttendanceTombstone(
+                company_id=obj.company_id,
+                worker_id=obj.worker_id,
+                task_id=obj.task_id,
+                date=obj.date,
+                deleted_at=deleted_at
+            ))
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def _tombstone_bulk_deletes(orm_execute_state):
+    """Leave tombstones for rows removed by a bulk Attendance DELETE"""
+    if not orm_execute_state.is_delete:
+        return
+    mapper = orm_execute_state.bind_mapper
+    if mapper is None or mapper.class_ is not Attendance:
+        return
+
+    query = select(
+        Attendance.company_id, Attendance.worker_id, Attendance.task_id, Attendance.date,
+        literal(datetime.utcnow(), DateTime)
+    ).distinct()
+    whereclause = orm_execute_state.statement.whereclause
+    if whereclause is not None:
+        query = query.where(whereclause)
+
+    connection = orm_execute_state.session.connection()
+    result = connection.execute(insert(AttendanceTombstone.__table__).from_select(
+        ['company_id', 'worker_id', 'task_id', 'date', 'deleted_at'], query
+    ))
+    logging.debug(f"Recorded {result.rowcount} attendance tombstones for a bulk delete")
+
+
+def next_watermark():
+    """Return the watermark to hand out with a delta taken now"""
+    return datetime.utcnow() - timedelta(seconds=DELTA_WATERMARK_LAG_SECONDS)
+
+
+def oldest_usable_watermark(retention_days=ATTENDANCE_TOMBSTONE_RETENTION_DAYS):
+    """Return the oldest watermark whose deletions are still all tombstoned"""
+    return datetime.utcnow() - timedelta(days=retention_days)
+
+
+def purge_attendance_tombstones(retention_days=ATTENDANCE_TOMBSTONE_RETENTION_DAYS):
+    """Delete tombstones older than the oldest usable watermark; the caller commits"""
+    table = AttendanceTombstone.__table__
+    result = db.session.execute(delete(table).where(table.c.deleted_at < oldest_usable_watermark(retention_days)))
+    logging.info(f"Purged {result.rowcount} attendance tombstones older than {retention_days} days")
+    return result.rowcount
+
+
+def changed_attendance_pairs(company_id, start_date, end_date, since):
+    """
+    Return the (worker_id, task_id) pairs with attendance between start_date
+    and end_date that was inserted, edited or deleted after since.
+    """
+    edited = select(Attendance.worker_id, Attendance.task_id).where(
+        Attendance.company_id == company_id,
+        Attendance.updated_at > since,
+        Attendance.date.between(start_date, end_date)
+    )
+    deleted = select(AttendanceTombstone.worker_id, AttendanceTombstone.task_id).where(
+        AttendanceTombstone.company_id == company_id,
+        AttendanceTombstone.deleted_at > since,
+        AttendanceTombstone.date.between(start_date, end_date)
+    )
+    return set(db.session.execute(union(edited, deleted)).all())
@@ -0,0 +1,88 @@
+"""
+Attendance Rollup
+=================
+
+Maintains attendance_daily_rollup, one row per (company, task, worker, day)
+with the present flag, units completed, hours worked and how many
+attendance rows, and Present rows, the day had.
+
+Routes that write Attendance call refresh_attendance_rollup for the slice
+they touched before committing, so the rollup changes in the same
+transaction. Reports and dashboards read the rollup instead of raw
+attendance. `flask rollup rebuild` recomputes it from scratch.
+"""
+
+from sqlalchemy import case, delete, func, insert, select
+from models import db, Attendance, AttendanceDailyRollup
+import logging
+
+
+def _scope(model, company_id, task_id, worker_ids, start_date, end_date):
+    """Build the filter conditions for a rollup slice on Attendance or the rollup"""
+    conditions = []
+    if company_id is not None:
+        conditions.append(model.company_id == company_id)
+    if task_id is not None:
+        conditions.append(model.task_id == task_id)
+    if worker_ids is not None:
+        conditions.append(model.worker_id.in_(list(worker_ids)))
+    if start_date is not None:
+        conditions.append(model.date >= start_date)
+    if end_date is not None:
+        conditions.append(model.date <= end_date)
+    return conditions
+
+
+def refresh_attendance_rollup(company_id=None, task_id=None, worker_ids=None, start_date=None, end_date=None):
+    """
+    Recompute the rollup rows for a slice of attendance.
+
+    Every argument narrows the slice; with none, the whole table is rebuilt.
+    Pending session changes are flushed first and the caller commits, so the
+    rollup is written in the same transaction as the attendance it reflects.
+    Several attendance rows for the same day set one present flag, but
+    attendance_rows and present_rows count each of them, as reports and
+    dashboards built on raw attendance did.
+    """
+    if worker_ids is not None and not worker_ids:
+        return 0
+
+    db.session.flush()
+
+    db.session.execute(
+        delete(AttendanceDailyRollup).where(
+            *_scope(AttendanceDailyRollup, company_id, task_id, worker_ids, start_date, end_date)
+        ).execution_options(synchronize_session=False)
+    )
+
+    daily = select(
+        Attendance.company_id,
+        Attendance.task_id,
+        Attendance.worker_id,
+        Attendance.date,
+        func.max(case((Attendance.status == 'Present', 1), else_=0)) == 1,
+        func.coalesce(func.sum(Attendance.units_completed), 0),
+        func.coalesce(func.sum(Attendance.hours_worked), 0),
+        func.count(Attendance.id),
+        func.sum(case((Attendance.status == 'Present', 1), else_=0))
+    ).where(
+        *_scope(Attendance, company_id, task_id, worker_ids, start_date, end_date)
+    ).group_by(
+        Attendance.company_id,
+        Attendance.task_id,
+        Attendance.worker_id,
+        Attendance.date
+    )
+
+    result = db.session.execute(
+        insert(AttendanceDailyRollup).from_select(
+            ['company_id', 'task_id', 'worker_id', 'date', 'present', 'units', 'hours', 'attendance_rows',
+             'present_rows'],
+            daily
+        )
+    )
+    logging.debug(
+        f"Refreshed attendance rollup (company={company_id}, task={task_id}, "
+        f"workers={None if worker_ids is None else len(worker_ids)}, {start_date} to {end_date}): {result.rowcount} rows"
+    )
+    return result.rowcount
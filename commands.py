@@ -0,0 +1,133 @@
+"""
+CLI Commands
+============
+
+Maintenance commands registered on the Flask CLI, e.g.
+
+    flask --app app_init rollup rebuild
+    flask --app app_init reports generate-all --period 2026-09
+    flask --app app_init attendance purge-tombstones
+"""
+
+from calendar import monthrange
+from concurrent.futures import as_completed
+from datetime import date, datetime
+from flask.cli import AppGroup
+from models import db
+import click
+import logging
+import os
+import time
+
+rollup_cli = AppGroup('rollup', help='Maintain the daily attendance rollup.')
+reports_cli = AppGroup('reports', help='Generate payroll reports.')
+attendance_cli = AppGroup('attendance', help='Maintain attendance change tracking.')
+
+
+@rollup_cli.command('rebuild')
+@click.option('--company-id', type=int, default=None, help='Only rebuild this company.')
+def rebuild_rollup_command(company_id):
+    """Rebuild attendance_daily_rollup from the attendance table"""
+    from attendance_rollup import refresh_attendance_rollup
+    from report_cache import invalidate_company_reports
+
+    try:
+        rows = refresh_attendance_rollup(company_id=company_id)
+        # Cached reports were built from the old rollup
+        invalidate_company_reports(None if company_id is None else [company_id])
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logging.error(f"Error rebuilding attendance rollup: {str(e)}")
+        raise click.ClickException(str(e))
+
+    scope = f"company {company_id}" if company_id is not None else "all companies"
+    click.echo(f"Rebuilt attendance rollup for {scope}: {rows} rows")
+
+
+@reports_cli.command('generate-all')
+@click.option('--period', required=True, help='Month to report on, as YYYY-MM.')
+@click.option('--output-dir', type=click.Path(file_okay=False), default=None,
+              help='Where to write the files (default: reports/<period>).')
+@click.option('--format', 'format_type', type=click.Choice(['csv', 'xlsx', 'parquet', 'arrow']), default='csv',
+              show_default=True)
+@click.option('--workers', type=int, default=None, help='Worker processes (default: CPU count).')
+@click.option('--company-id', 'company_ids', type=int, multiple=True, help='Only these companies; may be repeated.')
+def generate_all_reports_command(period, output_dir, format_type, workers, company_ids):
+    """Write every company's per_day, per_part and per_hour reports for a month"""
+    from models import Company
+    from report_jobs import generate_company_reports, new_report_executor
+
+    try:
+        month = datetime.strptime(period, '%Y-%m')
+    except ValueError:
+        raise click.BadParameter('Use YYYY-MM, e.g. 2026-09', param_hint='--period')
+    start_date = date(month.year, month.month, 1)
+    end_date = date(month.year, month.month, monthrange(month.year, month.month)[1])
+    output_dir = output_dir or os.path.join('reports', period)
+
+    query = db.session.query(Company.id).order_by(Company.id)
+    if company_ids:
+        query = query.filter(Company.id.in_(company_ids))
+    ids = [company_id for company_id, in query]
+    # Workers are forked, so they must not inherit an open transaction
+    db.session.remove()
+    if not ids:
+        click.echo('No companies to report on')
+        return
+
+    workers = max(1, min(workers or os.cpu_count() or 1, len(ids)))
+    click.echo(f"Generating {format_type} reports for {len(ids)} companies, {start_date} to {end_date}, "
+               f"with {workers} workers into {output_dir}")
+
+    started = time.time()
+    failed = []
+    with new_report_executor(workers) as executor:
+        futures = {
+            executor.submit(generate_company_reports, company_id, start_date, end_date,
+                            os.path.join(output_dir, str(company_id)), format_type): company_id
+            for company_id in ids
+        }
+        for future in as_completed(futures):
+            company_id = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                result = {'company_id': company_id, 'error': str(e), 'seconds': 0}
+            if result['error']:
+                failed.append(company_id)
+                click.echo(f"  company {company_id}: FAILED after {result['seconds']}s: {result['error']}", err=True)
+            else:
+                click.echo(f"  company {company_id} ({result['company_name']}): {result['row_count']} rows "
+                           f"in {len(result['files'])} files, {result['seconds']}s")
+
+    click.echo(f"Finished {len(ids) - len(failed)} of {len(ids)} companies in {time.time() - started:.1f}s")
+    if failed:
+        raise click.ClickException(f"Reports failed for companies {', '.join(map(str, sorted(failed)))}")
+
+
+@attendance_cli.command('purge-tombstones')
+@click.option('--retention-days', type=int, default=None,
+              help='Keep tombstones this many days (default: ATTENDANCE_TOMBSTONE_RETENTION_DAYS).')
+def purge_tombstones_command(retention_days):
+    """Delete attendance tombstones no usable delta watermark can need"""
+    from attendance_changes import ATTENDANCE_TOMBSTONE_RETENTION_DAYS, purge_attendance_tombstones
+
+    if retention_days is None:
+        retention_days = ATTENDANCE_TOMBSTONE_RETENTION_DAYS
+    try:
+        removed = purge_attendance_tombstones(retention_days)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logging.error(f"Error purging attendance tombstones: {str(e)}")
+        raise click.ClickException(str(e))
+
+    click.echo(f"Purged {removed} attendance tombstones older than {retention_days} days")
+
+
+def register_commands(app):
+    """Attach the maintenance command groups to the app's CLI"""
+    app.cli.add_command(rollup_cli)
+    app.cli.add_command(reports_cli)
+    app.cli.add_command(attendance_cli)
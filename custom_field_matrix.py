@@ -0,0 +1,84 @@
+"""
+Custom Field Matrix
+===================
+
+Loads a company's WorkerCustomFieldValue rows in one query instead of one
+query per worker and import field.
+
+Values are held as worker_id -> list aligned with the field order, so a
+lookup for a worker is a single dict access.
+"""
+
+from models import db, Worker, WorkerCustomFieldValue
+import logging
+
+# Marks a field that has no stored value for a worker
+_MISSING = object()
+
+
+class CustomFieldMatrix:
+    """A company's import field values indexed by worker"""
+
+    __slots__ = ('fields', 'names', '_rows')
+
+    def __init__(self, fields, rows):
+        self.fields = list(fields)
+        self.names = [field.name for field in self.fields]
+        self._rows = rows
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, worker_id):
+        return worker_id in self._rows
+
+    def values(self, worker_id, default=None):
+        """Return a worker's values in field order, with default for missing ones"""
+        row = self._rows.get(worker_id)
+        if row is None:
+            return [default] * len(self.fields)
+        return [default if value is _MISSING else value for value in row]
+
+    def as_dict(self, worker_id, default=None):
+        """Return a worker's values keyed by field name"""
+        return dict(zip(self.names, self.values(worker_id, default)))
+
+
+def load_custom_field_matrix(company_id, fields, worker_ids=None):
+    """
+    Fetch the values of fields for a company's workers in a single query.
+
+    worker_ids optionally limits the workers loaded. If a worker has several
+    values for the same field, the oldest one wins.
+    """
+    fields = list(fields)
+    rows = {}
+    if not fields:
+        return CustomFieldMatrix(fields, rows)
+
+    positions = {field.id: index for index, field in enumerate(fields)}
+    query = db.session.query(
+        WorkerCustomFieldValue.worker_id,
+        WorkerCustomFieldValue.custom_field_id,
+        WorkerCustomFieldValue.value
+    ).join(
+        Worker, Worker.id == WorkerCustomFieldValue.worker_id
+    ).filter(
+        Worker.company_id == company_id,
+        WorkerCustomFieldValue.custom_field_id.in_(list(positions))
+    )
+    if worker_ids is not None:
+        query = query.filter(WorkerCustomFieldValue.worker_id.in_(list(worker_ids)))
+
+    value_count = 0
+    for worker_id, field_id, value in query.order_by(WorkerCustomFieldValue.id):
+        row = rows.get(worker_id)
+        if row is None:
+            row = rows[worker_id] = [_MISSING] * len(fields)
+        position = positions[field_id]
+        if row[position] is _MISSING:
+            row[position] = value
+            value_count += 1
+
+    logging.debug(f"Loaded {value_count} custom field values for {len(rows)} workers of company {company_id}")
+    return CustomFieldMatrix(fields, rows)
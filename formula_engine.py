@@ -0,0 +1,390 @@
+"""
+Formula Engine
+==============
+
+Compiles ReportField formulas into cached callables.
+
+A formula is parsed once with the ``ast`` module, checked against a small
+whitelist of arithmetic, comparison and conditional syntax, and turned into
+a tree of closures. Evaluating a row then walks that tree with a name lookup
+function instead of rewriting strings and calling ``eval``.
+
+When NumPy is available the same AST can also be compiled into a column
+evaluator whose lookup returns whole float arrays, so one call computes a
+field for every row of a report.
+"""
+
+from functools import lru_cache
+import ast
+import operator
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+MAX_EXPONENT = 100
+
+_BINARY_OPERATORS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod,
+    ast.Pow: operator.pow,
+}
+
+_UNARY_OPERATORS = {
+    ast.UAdd: operator.pos,
+    ast.USub: operator.neg,
+    ast.Not: operator.not_,
+}
+
+_COMPARE_OPERATORS = {
+    ast.Gt: operator.gt,
+    ast.GtE: operator.ge,
+    ast.Lt: operator.lt,
+    ast.LtE: operator.le,
+    ast.Eq: operator.eq,
+    ast.NotEq: operator.ne,
+}
+
+_FUNCTIONS = {
+    'min': min,
+    'max': max,
+    'abs': abs,
+    'round': round,
+}
+
+
+class FormulaError(ValueError):
+    """Raised when a formula cannot be parsed or evaluated"""
+
+
+class FormulaCycleError(FormulaError):
+    """Raised when report fields reference each other in a cycle"""
+
+    def __init__(self, cycle):
+        self.cycle = list(cycle)
+        super().__init__("Circular reference between fields: " + ", ".join(self.cycle))
+
+
+def _number(value, name):
+    """Coerce a looked-up value to a number"""
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, (int, float)):
+        return value
+    if isinstance(value, str):
+        try:
+            return int(value)
+        except ValueError:
+            try:
+                return float(value)
+            except ValueError:
+                pass
+    raise FormulaError(f"'{name}' is not a number: {value!r}")
+
+
+def _power(base, exponent):
+    """Exponentiation with a bound on the exponent"""
+    if abs(exponent) > MAX_EXPONENT:
+        raise FormulaError(f"Exponent {exponent} is too large")
+    return operator.pow(base, exponent)
+
+
+def _compile_node(node):
+    """Turn a validated AST node into a callable taking a name lookup"""
+    if isinstance(node, ast.Expression):
+        return _compile_node(node.body)
+
+    if isinstance(node, ast.Constant):
+        if isinstance(node.value, bool) or not isinstance(node.value, (int, float)):
+            raise FormulaError(f"Unsupported constant: {node.value!r}")
+        value = node.value
+        return lambda lookup: value
+
+    if isinstance(node, ast.Name):
+        name = node.id
+        return lambda lookup: _number(lookup(name), name)
+
+    if isinstance(node, ast.BinOp):
+        op_type = type(node.op)
+        if op_type not in _BINARY_OPERATORS:
+            raise FormulaError(f"Unsupported operator: {op_type.__name__}")
+        op = _power if op_type is ast.Pow else _BINARY_OPERATORS[op_type]
+        left = _compile_node(node.left)
+        right = _compile_node(node.right)
+        return lambda lookup: op(left(lookup), right(lookup))
+
+    if isinstance(node, ast.UnaryOp):
+        op_type = type(node.op)
+        if op_type not in _UNARY_OPERATORS:
+            raise FormulaError(f"Unsupported operator: {op_type.__name__}")
+        op = _UNARY_OPERATORS[op_type]
+        operand = _compile_node(node.operand)
+        return lambda lookup: op(operand(lookup))
+
+    if isinstance(node, ast.Compare):
+        ops = []
+        for op in node.ops:
+            if type(op) not in _COMPARE_OPERATORS:
+                raise FormulaError(f"Unsupported comparison: {type(op).__name__}")
+            ops.append(_COMPARE_OPERATORS[type(op)])
+        operands = [_compile_node(node.left)] + [_compile_node(c) for c in node.comparators]
+
+        def compare(lookup):
+            left = operands[0](lookup)
+            for op, operand in zip(ops, operands[1:]):
+                right = operand(lookup)
+                if not op(left, right):
+                    return False
+                left = right
+            return True
+        return compare
+
+    if isinstance(node, ast.BoolOp):
+        values = [_compile_node(v) for v in node.values]
+        if isinstance(node.op, ast.And):
+            return lambda lookup: all(v(lookup) for v in values)
+        return lambda lookup: any(v(lookup) for v in values)
+
+    if isinstance(node, ast.IfExp):
+        test = _compile_node(node.test)
+        body = _compile_node(node.body)
+        orelse = _compile_node(node.orelse)
+        return lambda lookup: body(lookup) if test(lookup) else orelse(lookup)
+
+    if isinstance(node, ast.Call):
+        if not isinstance(node.func, ast.Name) or node.func.id not in _FUNCTIONS or node.keywords:
+            raise FormulaError("Only min, max, abs and round calls are allowed")
+        func = _FUNCTIONS[node.func.id]
+        args = [_compile_node(a) for a in node.args]
+        return lambda lookup: func(*(a(lookup) for a in args))
+
+    raise FormulaError(f"Unsupported syntax: {type(node).__name__}")
+
+
+def _vector_power(base, exponent):
+    """Element-wise exponentiation; rows with an oversized exponent become NaN"""
+    exponent = np.asarray(exponent, dtype=float)
+    safe_exponent = np.where(np.abs(exponent) > MAX_EXPONENT, np.nan, exponent)
+    return np.power(base, safe_exponent)
+
+
+def _vector_round(value, ndigits=0):
+    """Element-wise round with a constant number of digits"""
+    return np.round(value, int(ndigits))
+
+
+def _compile_vector_node(node):
+    """Turn a validated AST node into a callable over NumPy columns"""
+    if isinstance(node, ast.Expression):
+        return _compile_vector_node(node.body)
+
+    if isinstance(node, ast.Constant):
+        if isinstance(node.value, bool) or not isinstance(node.value, (int, float)):
+            raise FormulaError(f"Unsupported constant: {node.value!r}")
+        value = float(node.value)
+        return lambda lookup: value
+
+    if isinstance(node, ast.Name):
+        name = node.id
+        return lambda lookup: lookup(name)
+
+    if isinstance(node, ast.BinOp):
+        op_type = type(node.op)
+        if op_type not in _BINARY_OPERATORS:
+            raise FormulaError(f"Unsupported operator: {op_type.__name__}")
+        op = _vector_power if op_type is ast.Pow else _BINARY_OPERATORS[op_type]
+        left = _compile_vector_node(node.left)
+        right = _compile_vector_node(node.right)
+        return lambda lookup: op(left(lookup), right(lookup))
+
+    if isinstance(node, ast.UnaryOp):
+        if isinstance(node.op, ast.Not):
+            operand = _compile_vector_node(node.operand)
+            return lambda lookup: np.logical_not(operand(lookup))
+        if type(node.op) not in _UNARY_OPERATORS:
+            raise FormulaError(f"Unsupported operator: {type(node.op).__name__}")
+        op = _UNARY_OPERATORS[type(node.op)]
+        operand = _compile_vector_node(node.operand)
+        return lambda lookup: op(operand(lookup))
+
+    if isinstance(node, ast.Compare):
+        ops = []
+        for op in node.ops:
+            if type(op) not in _COMPARE_OPERATORS:
+                raise FormulaError(f"Unsupported comparison: {type(op).__name__}")
+            ops.append(_COMPARE_OPERATORS[type(op)])
+        operands = [_compile_vector_node(node.left)] + [_compile_vector_node(c) for c in node.comparators]
+
+        def compare(lookup):
+            values = [operand(lookup) for operand in operands]
+            result = True
+            for op, left, right in zip(ops, values, values[1:]):
+                result = np.logical_and(result, op(left, right))
+            return result
+        return compare
+
+    if isinstance(node, ast.BoolOp):
+        values = [_compile_vector_node(v) for v in node.values]
+        combine = np.logical_and if isinstance(node.op, ast.And) else np.logical_or
+        return lambda lookup: combine.reduce([np.asarray(v(lookup), dtype=bool) for v in values])
+
+    if isinstance(node, ast.IfExp):
+        test = _compile_vector_node(node.test)
+        body = _compile_vector_node(node.body)
+        orelse = _compile_vector_node(node.orelse)
+        return lambda lookup: np.where(test(lookup), body(lookup), orelse(lookup))
+
+    if isinstance(node, ast.Call):
+        if not isinstance(node.func, ast.Name) or node.func.id not in _FUNCTIONS or node.keywords:
+            raise FormulaError("Only min, max, abs and round calls are allowed")
+        args = [_compile_vector_node(a) for a in node.args]
+        name = node.func.id
+        if name in ('min', 'max'):
+            if not args:
+                raise FormulaError(f"{name}() needs at least one argument")
+            reducer = np.minimum if name == 'min' else np.maximum
+            return lambda lookup: reducer.reduce(np.broadcast_arrays(*(a(lookup) for a in args)))
+        if name == 'abs':
+            if len(args) != 1:
+                raise FormulaError("abs() takes exactly one argument")
+            return lambda lookup: np.abs(args[0](lookup))
+        if len(args) == 2 and not isinstance(node.args[1], ast.Constant):
+            raise FormulaError("round() digits must be a constant")
+        if len(args) not in (1, 2):
+            raise FormulaError("round() takes one or two arguments")
+        return lambda lookup: _vector_round(*(a(lookup) for a in args))
+
+    raise FormulaError(f"Unsupported syntax: {type(node).__name__}")
+
+
+def parse_formula(formula):
+    """Parse a formula into an AST, raising FormulaError if it is invalid"""
+    if not formula or not formula.strip():
+        raise FormulaError("Formula is empty")
+    try:
+        return ast.parse(formula.strip(), mode='eval')
+    except SyntaxError as e:
+        raise FormulaError(f"Invalid formula syntax: {e.msg}") from e
+
+
+def compile_formula(formula):
+    """Compile a formula into a callable ``fn(lookup)``"""
+    return _compile_node(parse_formula(formula))
+
+
+def formula_names(formula):
+    """Return the variable names a formula references"""
+    names = set()
+    for node in ast.walk(parse_formula(formula)):
+        if isinstance(node, ast.Name) and node.id not in _FUNCTIONS:
+            names.add(node.id)
+    return names
+
+
+@lru_cache(maxsize=256)
+def resolve_field_order(definitions):
+    """
+    Order report fields so each one follows the fields its formula uses.
+
+    definitions is a tuple of (name, formula) pairs. Returns a tuple of
+    names in evaluation order and a tuple of cycles, each cycle being the
+    names of fields that (directly or indirectly) reference each other.
+    The result is cached, so it is only recomputed when the fields change.
+    """
+    names = [name for name, _ in definitions]
+    known = set(names)
+    dependencies = {}
+    for name, formula in definitions:
+        try:
+            references = formula_names(formula)
+        except FormulaError:
+            references = set()
+        dependencies[name] = sorted(ref for ref in references if ref in known)
+
+    # Tarjan's algorithm emits each strongly connected component after every
+    # component it depends on, which is exactly evaluation order.
+    index = {}
+    lowlink = {}
+    stack = []
+    on_stack = set()
+    order = []
+    cycles = []
+
+    def connect(name):
+        index[name] = lowlink[name] = len(index)
+        stack.append(name)
+        on_stack.add(name)
+        for dependency in dependencies[name]:
+            if dependency not in index:
+                connect(dependency)
+                lowlink[name] = min(lowlink[name], lowlink[dependency])
+            elif dependency in on_stack:
+                lowlink[name] = min(lowlink[name], index[dependency])
+        if lowlink[name] == index[name]:
+            component = []
+            while True:
+                member = stack.pop()
+                on_stack.discard(member)
+                component.append(member)
+                if member == name:
+                    break
+            component.reverse()
+            order.extend(component)
+            if len(component) > 1 or name in dependencies[name]:
+                cycles.append(tuple(component))
+
+    for name in names:
+        if name not in index:
+            connect(name)
+    return tuple(order), tuple(cycles)
+
+
+def check_field_cycles(definitions):
+    """Raise FormulaCycleError if any (name, formula) definitions form a cycle"""
+    _, cycles = resolve_field_order(tuple(definitions))
+    if cycles:
+        raise FormulaCycleError(cycles[0])
+
+
+def validate_formula(formula):
+    """Raise FormulaError unless the formula parses and uses allowed syntax"""
+    compile_formula(formula)
+
+
+@lru_cache(maxsize=1024)
+def compiled_field_formula(field_id, formula):
+    """Return the compiled formula for a ReportField, cached by (id, formula)"""
+    try:
+        return compile_formula(formula)
+    except FormulaError as e:
+        # Cache the failure too so a broken formula is not re-parsed per row
+        error = str(e)
+
+        def invalid(lookup):
+            raise FormulaError(error)
+        return invalid
+
+
+def compile_formula_vectorized(formula):
+    """Compile a formula into a callable ``fn(lookup)`` over NumPy columns"""
+    if np is None:
+        raise FormulaError("NumPy is not installed")
+    return _compile_vector_node(parse_formula(formula))
+
+
+@lru_cache(maxsize=1024)
+def compiled_field_formula_vectorized(field_id, formula):
+    """Return the column-compiled formula for a ReportField, cached by (id, formula)"""
+    try:
+        return compile_formula_vectorized(formula)
+    except FormulaError as e:
+        error = str(e)
+
+        def invalid(lookup):
+            raise FormulaError(error)
+        return invalid
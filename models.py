@@ -170,10 +170,13 @@ class Company(db.Model):
     import_fields = db.relationship('ImportField', backref='company', lazy=True, cascade='all, delete-orphan')
     report_fields = db.relationship('ReportField', backref='company', lazy=True, cascade='all, delete-orphan')
     worker_import_logs = db.relationship('WorkerImportLog', backref='company', lazy=True, cascade='all, delete-orphan')
+    payroll_periods = db.relationship('PayrollPeriod', backref='company', lazy=True, cascade='all, delete-orphan')
     daily_payout_rate = db.Column(db.Float, default=56.0, nullable=False)
     currency = db.Column(db.String(3), default='ZMW', nullable=False)  # ISO 4217 currency code
     currency_symbol = db.Column(db.String(5), default='K', nullable=False)  # Currency symbol
     phone = db.Column(db.String(20), nullable=False)  # Add this line
+    # Bumped on every write that can change a report (see report_cache)
+    report_data_version = db.Column(db.Integer, default=0, nullable=False, server_default='0')
 
 class Worker(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -262,4 +265,71 @@ class Attendance(db.Model):
     task_id = db.Column(db.Integer, db.ForeignKey('task.id'), nullable=False)
     # Added fields
     units_completed = db.Column(db.Integer, nullable=True)
-    hours_worked = db.Column(db.Float, nullable=True)  # Hours worked for per_hour tasks
\ No newline at end of file
+    hours_worked = db.Column(db.Float, nullable=True)  # Hours worked for per_hour tasks
+    # Last insert or edit, for delta report exports; NULL for rows older than the column
+    updated_at = db.Column(db.DateTime, nullable=True, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('idx_attendance_company_updated', 'company_id', 'updated_at'),
+        db.Index('idx_attendance_company_date', 'company_id', 'date'),
+    )
+
+class AttendanceTombstone(db.Model):
+    """Records a deleted Attendance row so delta report exports can report the removal"""
+    __tablename__ = 'attendance_tombstone'
+    __table_args__ = (
+        db.Index('idx_attendance_tombstone_company_deleted', 'company_id', 'deleted_at'),
+    )
+    # Outlives the worker and task it refers to, so no foreign keys
+    id = db.Column(db.Integer, primary_key=True)
+    company_id = db.Column(db.Integer, nullable=False)
+    worker_id = db.Column(db.Integer, nullable=False)
+    task_id = db.Column(db.Integer, nullable=False)
+    date = db.Column(db.Date, nullable=False)
+    deleted_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+class AttendanceDailyRollup(db.Model):
+    """Per-day attendance totals kept in step with Attendance for reporting"""
+    __tablename__ = 'attendance_daily_rollup'
+    __table_args__ = (
+        db.Index('idx_attendance_rollup_company_date', 'company_id', 'date'),
+        db.Index('idx_attendance_rollup_worker_date', 'worker_id', 'date'),
+    )
+    # Derived from Attendance and rebuilt by `flask rollup rebuild`, so no foreign keys
+    company_id = db.Column(db.Integer, primary_key=True)
+    task_id = db.Column(db.Integer, primary_key=True)
+    worker_id = db.Column(db.Integer, primary_key=True)
+    date = db.Column(db.Date, primary_key=True)
+    present = db.Column(db.Boolean, nullable=False, default=False)
+    units = db.Column(db.Integer, nullable=False, default=0)
+    hours = db.Column(db.Float, nullable=False, default=0)
+    # Attendance rows that day, and those marked Present; reports count rows, not days
+    attendance_rows = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    present_rows = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+class PayrollPeriod(db.Model):
+    """A closed payroll period whose report rows are frozen in payroll_snapshot_row"""
+    __tablename__ = 'payroll_period'
+    __table_args__ = (
+        db.UniqueConstraint('company_id', 'start_date', 'end_date', name='uq_payroll_period_company_dates'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    company_id = db.Column(db.Integer, db.ForeignKey('company.id'), nullable=False)
+    start_date = db.Column(db.Date, nullable=False)
+    end_date = db.Column(db.Date, nullable=False)
+    closed_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    closed_by = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
+    # JSON of the import and report field definitions the rows were built with
+    field_layout = db.Column(db.Text, nullable=False)
+    row_count = db.Column(db.Integer, nullable=False, default=0)
+    # Rows go with the period through ON DELETE CASCADE without being loaded
+    rows = db.relationship('PayrollSnapshotRow', lazy=True, cascade='all, delete-orphan', passive_deletes=True)
+
+class PayrollSnapshotRow(db.Model):
+    """One frozen report record of a closed payroll period"""
+    __tablename__ = 'payroll_snapshot_row'
+    # The primary key orders a period's rows for a sequential read
+    period_id = db.Column(db.Integer, db.ForeignKey('payroll_period.id', ondelete='CASCADE'), primary_key=True)
+    payout_type = db.Column(db.String(20), primary_key=True)
+    position = db.Column(db.Integer, primary_key=True)
+    data = db.Column(db.Text, nullable=False)  # JSON of the record
@@ -0,0 +1,201 @@
+"""
+Payroll Periods
+===============
+
+Closing a payroll period freezes a company's computed report records for
+that period in payroll_snapshot_row. Reports for exactly that period are
+then read back from the snapshot in primary key order, instead of
+aggregating attendance and evaluating formulas again. Reopening the period
+deletes the snapshot and reports go back to being computed live.
+
+Rows are stored as JSON together with the field definitions they were built
+with, so later changes to import or report fields do not alter a closed
+period either. The /report/download workbook builds its records by its own
+rules, so its variants are frozen alongside under their own keys (see
+report_pipeline.WORKBOOK_SNAPSHOTS).
+"""
+
+from sqlalchemy import delete, func, insert, select
+from models import db, ImportField, PayrollPeriod, PayrollSnapshotRow, ReportField
+import itertools
+import json
+import logging
+
+# Snapshot rows written per INSERT and fetched per round trip when read
+SNAPSHOT_BATCH_ROWS = 1000
+
+
+class PayrollPeriodError(ValueError):
+    """Raised when a period cannot be closed or reopened"""
+
+
+def find_closed_period(company_id, start_date, end_date):
+    """Return the closed period covering exactly start_date to end_date, or None"""
+    return PayrollPeriod.query.filter_by(company_id=company_id, start_date=start_date, end_date=end_date).first()
+
+
+def _field_layout(import_fields, custom_fields, snapshot_keys):
+    """Serialise the field definitions a snapshot was built with, and the keys its rows are stored under"""
+    return json.dumps({
+        'import_fields': [{'name': field.name, 'field_type': field.field_type} for field in import_fields],
+        'custom_fields': [
+            {'name': field.name, 'field_type': field.field_type, 'payout_type': field.payout_type}
+            for field in custom_fields
+        ],
+        'snapshot_keys': list(snapshot_keys)
+    })
+
+
+def _insert_snapshot_rows(period_id, key, records):
+    """Freeze records under one snapshot key; returns the number written"""
+    table = PayrollSnapshotRow.__table__
+    positions = itertools.count()
+    records = iter(records)
+    row_count = 0
+    while True:
+        batch = [
+            {'period_id': period_id, 'payout_type': key, 'position': next(positions), 'data': json.dumps(record)}
+            for record in itertools.islice(records, SNAPSHOT_BATCH_ROWS)
+        ]
+        if not batch:
+            return row_count
+        db.session.execute(insert(table), batch)
+        row_count += len(batch)
+
+
+def close_payroll_period(company, start_date, end_date, user_id=None):
+    """
+    Build a company's report for a period and freeze it as a snapshot.
+
+    The caller commits. Raises PayrollPeriodError if the dates are invalid
+    or the period is already closed.
+    """
+    from report_engine import PAYMENT_TYPES
+    from report_pipeline import stream_report_records, workbook_rules, WORKBOOK_SNAPSHOTS
+
+    if end_date < start_date:
+        raise PayrollPeriodError('End date must not be before start date')
+    if find_closed_period(company.id, start_date, end_date) is not None:
+        raise PayrollPeriodError(f'Payroll period {start_date} to {end_date} is already closed')
+
+    report = stream_report_records(company, start_date, end_date, payment_types=PAYMENT_TYPES)
+    # Started before the period exists, which would otherwise be read back as their source
+    workbooks = {
+        key: stream_report_records(company, start_date, end_date, payment_types=(payout_type,),
+                                   rules=workbook_rules(report_type))[payout_type]
+        for key, (payout_type, report_type) in WORKBOOK_SNAPSHOTS.items()
+    }
+    period = PayrollPeriod(
+        company_id=company.id,
+        start_date=start_date,
+        end_date=end_date,
+        closed_by=user_id,
+        field_layout=_field_layout(report['import_fields'], report['custom_fields'],
+                                   PAYMENT_TYPES + tuple(WORKBOOK_SNAPSHOTS))
+    )
+    db.session.add(period)
+    db.session.flush()
+
+    row_count = 0
+    for payout_type in PAYMENT_TYPES:
+        row_count += _insert_snapshot_rows(period.id, payout_type, report[payout_type])
+    # row_count is the report's rows; the workbook variants repeat them under other rules
+    for key, records in workbooks.items():
+        _insert_snapshot_rows(period.id, key, records)
+    period.row_count = row_count
+
+    logging.info(f"Closed payroll period {start_date} to {end_date} for company {company.id} with {row_count} rows")
+    return period
+
+
+def reopen_payroll_period(period):
+    """Delete a closed period and its snapshot; the caller commits"""
+    db.session.execute(delete(PayrollSnapshotRow.__table__).where(PayrollSnapshotRow.__table__.c.period_id == period.id))
+    db.session.delete(period)
+    logging.info(f"Reopened payroll period {period.start_date} to {period.end_date} for company {period.company_id}")
+
+
+def snapshot_fields(period):
+    """
+    Return the (import_fields, custom_fields) a closed period was built with.
+
+    They are unsaved model instances rebuilt from the stored layout, so
+    column selection matches the frozen rows.
+    """
+    layout = json.loads(period.field_layout)
+    return (
+        [ImportField(**field) for field in layout['import_fields']],
+        [ReportField(**field) for field in layout['custom_fields']]
+    )
+
+
+def snapshot_keys(period):
+    """Return the keys a closed period's rows are stored under"""
+    from report_engine import PAYMENT_TYPES
+
+    # Periods closed before workbook variants were frozen only hold the report's rows
+    return set(json.loads(period.field_layout).get('snapshot_keys', PAYMENT_TYPES))
+
+
+def load_snapshot(period, payment_types):
+    """Read a closed period's records, shaped like build_report_records"""
+    import_fields, custom_fields = snapshot_fields(period)
+    report = {
+        'import_fields': import_fields,
+        'custom_fields': custom_fields
+    }
+    for payout_type in payment_types:
+        report[payout_type] = []
+
+    table = PayrollSnapshotRow.__table__
+    result = db.session.execute(
+        select(table.c.payout_type, table.c.data)
+        .where(table.c.period_id == period.id, table.c.payout_type.in_(list(payment_types)))
+        .order_by(table.c.payout_type, table.c.position)
+        .execution_options(yield_per=SNAPSHOT_BATCH_ROWS)
+    )
+    for payout_type, data in result:
+        report[payout_type].append(json.loads(data))
+
+    logging.info(
+        f"Report for company {period.company_id} ({period.start_date} to {period.end_date}) read from "
+        f"closed period snapshot: " + ", ".join(f"{payout_type}={len(report[payout_type])}" for payout_type in payment_types)
+    )
+    return report
+
+
+def count_snapshot_rows(period, payout_type):
+    """Count a closed period's frozen rows of one payout type"""
+    table = PayrollSnapshotRow.__table__
+    return db.session.execute(
+        select(func.count()).select_from(table)
+        .where(table.c.period_id == period.id, table.c.payout_type == payout_type)
+    ).scalar() or 0
+
+
+def snapshot_sample(period, payout_type, limit):
+    """Return the first limit frozen records of one payout type"""
+    table = PayrollSnapshotRow.__table__
+    result = db.session.execute(
+        select(table.c.data)
+        .where(table.c.period_id == period.id, table.c.payout_type == payout_type)
+        .order_by(table.c.position)
+        .limit(limit)
+    )
+    return [json.loads(data) for data, in result]
+
+
+def snapshot_values(period, payout_type, key):
+    """Return the distinct non-blank values of a record key in a closed period's rows"""
+    table = PayrollSnapshotRow.__table__
+    result = db.session.execute(
+        select(table.c.data)
+        .where(table.c.period_id == period.id, table.c.payout_type == payout_type)
+        .execution_options(yield_per=SNAPSHOT_BATCH_ROWS)
+    )
+    values = set()
+    for data, in result:
+        value = json.loads(data).get(key)
+        if value not in (None, ''):
+            values.add(value)
+    return values
@@ -0,0 +1,135 @@
+"""
+Report Analytics
+================
+
+Period-over-period payroll comparisons.
+
+Each period is totalled per task or per worker with one grouped query over
+the attendance rollup (see report_engine.sum_period_totals), or from its
+snapshot when it is a closed payroll period, like every other report. The two
+periods are joined in memory, the deltas are computed column by column with
+NumPy when it is installed, and the result is returned as columnar JSON:
+one list per column instead of one object per row.
+"""
+
+from datetime import date, timedelta
+from payroll_periods import find_closed_period
+from report_engine import sum_period_totals
+import calendar
+import logging
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+ANALYTICS_GROUPS = ('task', 'worker')
+ANALYTICS_METRICS = ('days', 'units', 'hours', 'payout')
+
+
+def previous_period(start_date, end_date):
+    """
+    Return the period a comparison defaults to.
+
+    Whole calendar months are compared with the same number of months
+    before them; any other range with the same number of days just before.
+    """
+    last_day = calendar.monthrange(end_date.year, end_date.month)[1]
+    if start_date.day == 1 and end_date.day == last_day:
+        months = (end_date.year - start_date.year) * 12 + end_date.month - start_date.month + 1
+        month_index = start_date.year * 12 + start_date.month - 1 - months
+        previous_start = date(month_index // 12, month_index % 12 + 1, 1)
+        return previous_start, start_date - timedelta(days=1)
+    length = end_date - start_date
+    previous_end = start_date - timedelta(days=1)
+    return previous_end - length, previous_end
+
+
+def _period_totals(company, start_date, end_date, group_by):
+    """Return (totals, source) for one side of a comparison"""
+    from report_pipeline import snapshot_period_totals
+
+    period = find_closed_period(company.id, start_date, end_date)
+    if period is not None:
+        return snapshot_period_totals(period, company, group_by), 'snapshot'
+    totals = sum_period_totals(company.id, start_date, end_date, group_by,
+                               default_rate=company.daily_payout_rate, default_currency=company.currency)
+    return totals, 'live'
+
+
+def _join_periods(current, previous):
+    """Outer-join two periods' totals on (id, currency), in id then currency order"""
+    joined = {}
+    for index, rows in enumerate((current, previous)):
+        for row_id, name, currency, *metrics in rows:
+            entry = joined.setdefault((row_id, currency),
+                                      [name, [0.0] * len(ANALYTICS_METRICS), [0.0] * len(ANALYTICS_METRICS)])
+            entry[index + 1] = [float(value or 0) for value in metrics]
+    return [(key, joined[key]) for key in sorted(joined)]
+
+
+def _deltas(current, previous):
+    """Return (delta, percent change) columns; percent change is None where previous is 0"""
+    if np is not None:
+        current = np.asarray(current, dtype=float)
+        previous = np.asarray(previous, dtype=float)
+        delta = np.round(current - previous, 2)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            percent = np.round((current - previous) / previous * 100, 1)
+        percent = percent.astype(object)
+        percent[previous == 0] = None
+        return delta.tolist(), percent.tolist()
+    delta = [round(a - b, 2) for a, b in zip(current, previous)]
+    percent = [round((a - b) / b * 100, 1) if b else None for a, b in zip(current, previous)]
+    return delta, percent
+
+
+def compare_periods(company, start_date, end_date, previous_start=None, previous_end=None, group_by='task'):
+    """
+    Compare a period's days, units, hours and payout with a previous one.
+
+    The previous period defaults to previous_period(start_date, end_date).
+    Rows are keyed by task or worker and currency, so payouts in different
+    currencies are never added up. Returns a dict whose columns map each
+    column name to a list of values: id, name and currency, then for every
+    metric its current value, <metric>_previous, <metric>_delta and
+    <metric>_pct (percent change, None when the previous value is 0).
+    source, and the source of each period, is 'snapshot' for a closed
+    payroll period and 'live' otherwise.
+    """
+    if group_by not in ANALYTICS_GROUPS:
+        raise ValueError(f"Unknown analytics grouping: {group_by}")
+    if previous_start is None or previous_end is None:
+        previous_start, previous_end = previous_period(start_date, end_date)
+
+    (current, source), (previous, previous_source) = [
+        _period_totals(company, period_start, period_end, group_by)
+        for period_start, period_end in ((start_date, end_date), (previous_start, previous_end))
+    ]
+    joined = _join_periods(current, previous)
+
+    columns = {
+        'id': [row_id for (row_id, _), _ in joined],
+        'name': [name for _, (name, _, _) in joined],
+        'currency': [currency for (_, currency), _ in joined]
+    }
+    for index, metric in enumerate(ANALYTICS_METRICS):
+        current = [entry[1][index] for _, entry in joined]
+        previous = [entry[2][index] for _, entry in joined]
+        columns[metric] = [round(value, 2) for value in current]
+        columns[f'{metric}_previous'] = [round(value, 2) for value in previous]
+        columns[f'{metric}_delta'], columns[f'{metric}_pct'] = _deltas(current, previous)
+
+    logging.info(
+        f"Compared {group_by} totals for company {company.id}: {start_date} to {end_date} against "
+        f"{previous_start} to {previous_end}, {len(joined)} rows"
+    )
+    return {
+        'group_by': group_by,
+        'source': source,
+        'period': {'start_date': start_date.isoformat(), 'end_date': end_date.isoformat(), 'source': source},
+        'previous_period': {'start_date': previous_start.isoformat(), 'end_date': previous_end.isoformat(),
+                            'source': previous_source},
+        'row_count': len(joined),
+        'columns': columns
+    }
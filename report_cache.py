@@ -0,0 +1,195 @@
+"""
+Report Cache
+============
+
+In-process cache of computed report records.
+
+Entries are keyed by (company_id, report_type, start_date, end_date,
+data_version). Company.report_data_version is bumped in the same
+transaction as any write to Attendance, Task, Worker, ImportField,
+ReportField, WorkerCustomFieldValue or Company.daily_payout_rate, so a
+stale entry is never looked up again and simply ages out of the LRU.
+Because the version lives in the database, every process sees the bump.
+Writes the session events cannot see, such as a rollup rebuild, call
+invalidate_company_reports.
+"""
+
+from collections import OrderedDict
+from sqlalchemy import event, select, update
+from sqlalchemy.orm import Session
+from models import db, Attendance, Company, ImportField, ReportField, Task, Worker, WorkerCustomFieldValue
+import itertools
+import logging
+import os
+import sys
+import threading
+
+REPORT_CACHE_MAX_ENTRIES = int(os.environ.get('REPORT_CACHE_MAX_ENTRIES', 256))
+REPORT_CACHE_MAX_BYTES = int(os.environ.get('REPORT_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+
+# Models whose rows carry a company_id and feed into report records
+_COMPANY_SCOPED_MODELS = (Attendance, Task, Worker, ImportField, ReportField)
+
+# Rows sampled when estimating the memory used by a list of records
+_SIZE_SAMPLE_ROWS = 50
+
+
+def _estimate_size(records):
+    """Roughly estimate the memory held by a list of record dicts"""
+    if not records:
+        return sys.getsizeof(records)
+    sample = records[:_SIZE_SAMPLE_ROWS]
+    sample_size = sum(
+        sys.getsizeof(record) + sum(sys.getsizeof(value) for value in record.values())
+        for record in sample
+    )
+    return sys.getsizeof(records) + sample_size * len(records) // len(sample)
+
+
+class ReportCache:
+    """Thread-safe LRU of report records bounded by entry count and size"""
+
+    def __init__(self, max_entries=REPORT_CACHE_MAX_ENTRIES, max_bytes=REPORT_CACHE_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Return a copy of the cached records for key, or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            records = entry[0]
+        # Callers get their own dicts so they cannot modify the cached rows
+        return [dict(record) for record in records]
+
+    def put(self, key, records):
+        """Store a copy of records, evicting least recently used entries"""
+        size = _estimate_size(records)
+        if size > self.max_bytes:
+            logging.info(f"Report for {key} is too large to cache ({size} bytes)")
+            return
+        records = [dict(record) for record in records]
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (records, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+
+    def clear(self):
+        """Drop every cached report"""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """Return entry count, estimated size and hit/miss counters"""
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+
+report_cache = ReportCache()
+
+
+def report_data_version(company_id):
+    """Read a company's current report data version"""
+    return db.session.query(Company.report_data_version).filter(Company.id == company_id).scalar() or 0
+
+
+def _bump_versions(connection, company_ids):
+    """Increment report_data_version for the given companies"""
+    company_ids = [company_id for company_id in company_ids if company_id is not None]
+    if not company_ids:
+        return
+    company = Company.__table__
+    connection.execute(
+        update(company)
+        .where(company.c.id.in_(company_ids))
+        .values(report_data_version=company.c.report_data_version + 1)
+    )
+    logging.debug(f"Bumped report data version for companies {sorted(company_ids)}")
+
+
+def invalidate_company_reports(company_ids=None):
+    """
+    Bump report_data_version for writes the session events cannot see.
+
+    Rollup rebuilds and other Core writes to report inputs call this in
+    their transaction; company_ids None bumps every company. The caller
+    commits.
+    """
+    if company_ids is None:
+        company_ids = [company_id for company_id, in db.session.query(Company.id)]
+    _bump_versions(db.session.connection(), set(company_ids))
+
+
+@event.listens_for(Session, 'before_flush')
+def _collect_report_writes(session, flush_context, instances):
+    """Remember which companies a flush is about to change"""
+    company_ids = session.info.setdefault('report_company_ids', set())
+    worker_ids = session.info.setdefault('report_worker_ids', set())
+
+    for obj in itertools.chain(session.new, session.dirty, session.deleted):
+        if obj in session.dirty and not session.is_modified(obj):
+            continue
+        if isinstance(obj, _COMPANY_SCOPED_MODELS):
+            company_ids.add(obj.company_id)
+        elif isinstance(obj, WorkerCustomFieldValue):
+            if obj.worker_id is not None:
+                worker_ids.add(obj.worker_id)
+            elif obj.worker is not None:
+                company_ids.add(obj.worker.company_id)
+        elif isinstance(obj, Company) and obj in session.dirty:
+            if db.inspect(obj).attrs.daily_payout_rate.history.has_changes():
+                company_ids.add(obj.id)
+
+
+@event.listens_for(Session, 'after_flush')
+def _bump_after_flush(session, flush_context):
+    """Bump report data versions in the flush's transaction"""
+    company_ids = session.info.pop('report_company_ids', set())
+    worker_ids = session.info.pop('report_worker_ids', set())
+    connection = session.connection()
+    if worker_ids:
+        company_ids |= set(connection.execute(
+            select(Worker.__table__.c.company_id).where(Worker.__table__.c.id.in_(worker_ids))
+        ).scalars())
+    _bump_versions(connection, company_ids)
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def _bump_for_bulk_writes(orm_execute_state):
+    """Bump report data versions for bulk UPDATE/DELETE statements"""
+    if not (orm_execute_state.is_update or orm_execute_state.is_delete):
+        return
+    mapper = orm_execute_state.bind_mapper
+    model = mapper.class_ if mapper is not None else None
+    if model not in _COMPANY_SCOPED_MODELS and model is not WorkerCustomFieldValue:
+        return
+
+    whereclause = orm_execute_state.statement.whereclause
+    if model is WorkerCustomFieldValue:
+        query = select(Worker.company_id).join(WorkerCustomFieldValue, WorkerCustomFieldValue.worker_id == Worker.id)
+    else:
+        query = select(model.company_id)
+    if whereclause is not None:
+        query = query.where(whereclause)
+
+    connection = orm_execute_state.session.connection()
+    _bump_versions(connection, set(connection.execute(query.distinct()).scalars()))
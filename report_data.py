@@ -0,0 +1,88 @@
+"""
+Report Data
+===========
+
+Read-only row loading for the report paths.
+
+Reports only read a handful of Worker and Task columns, so instead of
+loading ORM objects (with identity map, change tracking and lazy loaders)
+they select just those columns with Core and keep each worker and task as
+a small __slots__ object shared by all of its buckets. Large results are
+streamed from the database in batches of REPORT_YIELD_PER rows.
+"""
+
+from models import db, Task, Worker
+import os
+
+REPORT_YIELD_PER = int(os.environ.get('REPORT_YIELD_PER', 2000))
+
+
+class WorkerRow:
+    """The Worker columns a report reads"""
+
+    __slots__ = ('id', 'first_name', 'last_name', 'date_of_birth')
+
+    def __init__(self, id, first_name, last_name, date_of_birth):
+        self.id = id
+        self.first_name = first_name
+        self.last_name = last_name
+        self.date_of_birth = date_of_birth
+
+
+class TaskRow:
+    """The Task columns a report reads"""
+
+    __slots__ = ('id', 'name', 'payment_type', 'per_day_payout', 'per_day_currency', 'per_part_payout',
+                 'per_part_currency', 'per_hour_payout', 'per_hour_currency')
+
+    def __init__(self, id, name, payment_type, per_day_payout, per_day_currency, per_part_payout,
+                 per_part_currency, per_hour_payout, per_hour_currency):
+        self.id = id
+        self.name = name
+        self.payment_type = payment_type
+        self.per_day_payout = per_day_payout
+        self.per_day_currency = per_day_currency
+        self.per_part_payout = per_part_payout
+        self.per_part_currency = per_part_currency
+        self.per_hour_payout = per_hour_payout
+        self.per_hour_currency = per_hour_currency
+
+
+# Columns selected for each row type, in constructor order
+WORKER_COLUMNS = tuple(getattr(Worker, name) for name in WorkerRow.__slots__)
+TASK_COLUMNS = tuple(getattr(Task, name) for name in TaskRow.__slots__)
+
+
+class RowObjects:
+    """
+    Builds WorkerRow and TaskRow objects from flat result rows.
+
+    A result row holds WORKER_COLUMNS and TASK_COLUMNS after offset leading
+    columns; each worker and task is built once and then shared.
+    """
+
+    __slots__ = ('offset', 'workers', 'tasks')
+
+    def __init__(self, offset=0):
+        self.offset = offset
+        self.workers = {}
+        self.tasks = {}
+
+    def split(self, row):
+        """Return (leading values, worker, task, trailing values) for a result row"""
+        worker_start = self.offset
+        task_start = worker_start + len(WORKER_COLUMNS)
+        task_end = task_start + len(TASK_COLUMNS)
+
+        worker = self.workers.get(row[worker_start])
+        if worker is None:
+            worker = self.workers[row[worker_start]] = WorkerRow(*row[worker_start:task_start])
+        task = self.tasks.get(row[task_start])
+        if task is None:
+            task = self.tasks[row[task_start]] = TaskRow(*row[task_start:task_end])
+        return row[:worker_start], worker, task, row[task_end:]
+
+
+def stream_rows(statement, yield_per=REPORT_YIELD_PER):
+    """Execute a Core select, fetching its rows yield_per at a time"""
+    return db.session.execute(statement.execution_options(yield_per=yield_per))
@@ -0,0 +1,517 @@
+"""
+Report Engine
+=============
+
+Set-based aggregation for payroll reports.
+
+Instead of querying attendance worker by worker and lazy-loading each
+record's task, every (worker, task) bucket for all payment types is
+computed with a single grouped query over the daily attendance rollup
+(see attendance_rollup) joined to Task. Workers and tasks come back as
+read-only rows (see report_data), not ORM objects.
+"""
+
+from datetime import datetime, time, timedelta
+from sqlalchemy import case, exists, func, literal, select, true, tuple_
+from models import db, Attendance, AttendanceDailyRollup, Task, Worker
+from report_data import RowObjects, TASK_COLUMNS, WORKER_COLUMNS, stream_rows
+import logging
+
+PAYMENT_TYPES = ('per_day', 'per_part', 'per_hour')
+
+
+def _task_started_by(end_date):
+    """Filter matching tasks that started on or before the report end date"""
+    # Task.start_date is a DateTime, so compare against the start of the next day
+    cutoff = datetime.combine(end_date + timedelta(days=1), time.min)
+    return Task.start_date < cutoff
+
+
+def _bucket_subquery(company_id, start_date, end_date, payment_types, worker_range=None, worker_ids=None,
+                     task_ids=None, started_only=True):
+    """Grouped (worker, task) totals from the daily attendance rollup"""
+    rollup = AttendanceDailyRollup
+    query = db.session.query(
+        rollup.worker_id.label('worker_id'),
+        rollup.task_id.label('task_id'),
+        func.sum(rollup.present_rows).label('present_days'),
+        func.sum(rollup.units).label('units'),
+        func.sum(rollup.hours).label('hours')
+    ).join(
+        Task, Task.id == rollup.task_id
+    ).filter(
+        rollup.company_id == company_id,
+        rollup.date.between(start_date, end_date),
+        Task.payment_type.in_(payment_types)
+    )
+    if started_only:
+        query = query.filter(_task_started_by(end_date))
+    if worker_range is not None:
+        query = query.filter(rollup.worker_id.between(*worker_range))
+    if worker_ids is not None:
+        query = query.filter(rollup.worker_id.in_(list(worker_ids)))
+    if task_ids is not None:
+        query = query.filter(rollup.task_id.in_(list(task_ids)))
+    return query.group_by(
+        rollup.worker_id,
+        rollup.task_id
+    ).subquery()
+
+
+def scan_attendance(company_id, start_date, end_date, payment_types=PAYMENT_TYPES, worker_range=None,
+                    worker_ids=None, task_ids=None, keep_empty=True, started_only=True):
+    """
+    Aggregate attendance into (worker, task, quantity) buckets in one scan.
+
+    A single grouped query covers every requested payment type. quantity
+    is the number of Present attendance rows for per_day tasks, the total
+    units completed for per_part tasks and the total hours worked for
+    per_hour tasks. A per_day bucket needs a Present row; per_part and
+    per_hour buckets are kept with 0 units or hours unless keep_empty is
+    False. With started_only, tasks starting after end_date are left out.
+    Returns a dict keyed by payment type whose lists of (WorkerRow, TaskRow,
+    quantity) are ordered by worker then task. worker_range optionally
+    limits the scan to an inclusive (first, last) range of worker ids, and
+    worker_ids and task_ids to those workers and tasks.
+    """
+    buckets = _bucket_subquery(company_id, start_date, end_date, payment_types, worker_range, worker_ids, task_ids,
+                               started_only)
+    statement = select(
+        buckets.c.present_days, buckets.c.units, buckets.c.hours, *WORKER_COLUMNS, *TASK_COLUMNS
+    ).join_from(
+        buckets, Worker, buckets.c.worker_id == Worker.id
+    ).join(
+        Task, Task.id == buckets.c.task_id
+    ).where(
+        Worker.company_id == company_id
+    ).order_by(
+        Worker.id,
+        Task.id
+    )
+
+    result = {payment_type: [] for payment_type in payment_types}
+    objects = RowObjects(offset=3)
+    row_count = 0
+    for row in stream_rows(statement):
+        (present_days, units, hours), worker, task, _ = objects.split(row)
+        quantity = {
+            'per_day': present_days,
+            'per_part': units,
+            'per_hour': hours
+        }[task.payment_type]
+        if quantity or (keep_empty and task.payment_type != 'per_day'):
+            result[task.payment_type].append((worker, task, quantity))
+        row_count += 1
+
+    logging.debug(f"Scanned {row_count} attendance buckets for company {company_id}")
+    return result
+
+
+def iter_worker_id_chunks(company_id, chunk_size):
+    """Yield a company's worker ids in ascending lists of at most chunk_size"""
+    after = None
+    while True:
+        query = db.session.query(Worker.id).filter(Worker.company_id == company_id)
+        if after is not None:
+            query = query.filter(Worker.id > after)
+        ids = [worker_id for worker_id, in query.order_by(Worker.id).limit(chunk_size)]
+        if not ids:
+            return
+        yield ids
+        if len(ids) < chunk_size:
+            return
+        after = ids[-1]
+
+
+def _bucket_quantity(buckets, payment_type):
+    """The bucket column holding the quantity paid for a payment type"""
+    return {
+        'per_day': buckets.c.present_days,
+        'per_part': buckets.c.units,
+        'per_hour': buckets.c.hours
+    }[payment_type]
+
+
+def _bucket_reported(buckets, payment_type):
+    """Filter for the buckets a report keeps, as scan_attendance does with keep_empty"""
+    return buckets.c.present_days != 0 if payment_type == 'per_day' else true()
+
+
+# Keys accepted by scan_attendance_page for sorting
+PAGE_SORT_KEYS = ('worker_id', 'first_name', 'last_name', 'task_name', 'quantity')
+
+
+def scan_attendance_page(company_id, start_date, end_date, payment_type, sort='worker_id',
+                         descending=False, after=None, limit=50):
+    """
+    Return one keyset page of (worker, task, quantity) buckets.
+
+    Rows are ordered by sort (one of PAGE_SORT_KEYS) with worker and task ids
+    as tie-breakers. after is the (sort value, worker id, task id) of the
+    last row already seen, or (worker id, task id) when sorting by
+    worker_id. Each returned (WorkerRow, TaskRow, quantity, key) row also
+    carries its own key for the next page.
+    """
+    buckets = _bucket_subquery(company_id, start_date, end_date, (payment_type,))
+    quantity = _bucket_quantity(buckets, payment_type)
+    sort_columns = {
+        'first_name': func.coalesce(Worker.first_name, ''),
+        'last_name': func.coalesce(Worker.last_name, ''),
+        'task_name': Task.name,
+        'quantity': quantity
+    }
+    keys = [Worker.id, Task.id]
+    if sort != 'worker_id':
+        keys.insert(0, sort_columns[sort])
+
+    statement = select(
+        quantity, *WORKER_COLUMNS, *TASK_COLUMNS, *keys
+    ).join_from(
+        buckets, Worker, buckets.c.worker_id == Worker.id
+    ).join(
+        Task, Task.id == buckets.c.task_id
+    ).where(
+        Worker.company_id == company_id,
+        _bucket_reported(buckets, payment_type)
+    )
+    if after is not None:
+        position = tuple_(*keys)
+        statement = statement.where(position < tuple_(*after) if descending else position > tuple_(*after))
+
+    statement = statement.order_by(*[key.desc() if descending else key.asc() for key in keys]).limit(limit)
+    objects = RowObjects(offset=1)
+    page = []
+    for row in db.session.execute(statement):
+        (row_quantity,), worker, task, key = objects.split(row)
+        page.append((worker, task, row_quantity, tuple(key)))
+    return page
+
+
+def count_attendance_buckets(company_id, start_date, end_date, payment_type):
+    """Count the (worker, task) buckets a payment type's report would contain"""
+    buckets = _bucket_subquery(company_id, start_date, end_date, (payment_type,))
+    return db.session.query(func.count()).select_from(buckets).join(
+        Worker, Worker.id == buckets.c.worker_id
+    ).filter(
+        Worker.company_id == company_id,
+        _bucket_reported(buckets, payment_type)
+    ).scalar() or 0
+
+
+def has_attendance_buckets(company_id, start_date, end_date, payment_type):
+    """Check with an indexed EXISTS whether a payment type's report has any rows"""
+    rollup = AttendanceDailyRollup
+    # Like scan_attendance, only per_day rows need something to pay
+    reported = rollup.present_rows > 0 if payment_type == 'per_day' else true()
+    return db.session.query(
+        exists().where(
+            rollup.company_id == company_id,
+            rollup.date.between(start_date, end_date),
+            Task.id == rollup.task_id,
+            Task.payment_type == payment_type,
+            _task_started_by(end_date),
+            reported
+        )
+    ).scalar()
+
+
+def _payout_expressions(default_rate, default_currency):
+    """(quantity, rate, currency) of a rollup row, chosen by its task's payment type"""
+    rollup = AttendanceDailyRollup
+    per_day = Task.payment_type == 'per_day'
+    per_part = Task.payment_type == 'per_part'
+    quantity = case(
+        (per_day, rollup.present_rows),
+        (per_part, rollup.units),
+        else_=rollup.hours
+    )
+    # Like the report records, a missing or zero daily rate falls back to the company rate
+    rate = case(
+        (per_day, func.coalesce(func.nullif(Task.per_day_payout, 0), literal(default_rate))),
+        (per_part, Task.per_part_payout),
+        else_=Task.per_hour_payout
+    )
+    currency = func.coalesce(
+        func.nullif(case(
+            (per_day, Task.per_day_currency),
+            (per_part, Task.per_part_currency),
+            else_=Task.per_hour_currency
+        ), ''),
+        literal(default_currency)
+    )
+    return quantity, rate, currency
+
+
+def sum_payouts(company_id, start_date, end_date, payment_types=PAYMENT_TYPES, default_rate=None,
+                default_currency=None):
+    """
+    Total quantity and gross pay (quantity times rate) inside the database.
+
+    Returns (tasks, currencies): one dict per task with its currency, rate,
+    quantity, paid workers and gross pay, and one dict per currency with
+    its paid workers and gross pay. Tasks without a rate have no gross pay.
+    Only the totals leave the database, never per-row data.
+    """
+    rollup = AttendanceDailyRollup
+    quantity, rate, currency = _payout_expressions(default_rate, default_currency)
+    paid_worker = case((quantity != 0, rollup.worker_id))
+    filters = (
+        rollup.company_id == company_id,
+        rollup.date.between(start_date, end_date),
+        Task.payment_type.in_(payment_types),
+        _task_started_by(end_date)
+    )
+
+    task_totals = select(
+        currency.label('currency'),
+        Task.id,
+        Task.name,
+        Task.payment_type,
+        rate.label('rate'),
+        func.sum(quantity).label('quantity'),
+        func.count(paid_worker.distinct()).label('workers'),
+        func.sum(quantity * rate).label('gross_pay')
+    ).join_from(
+        rollup, Task, Task.id == rollup.task_id
+    ).where(
+        *filters
+    ).group_by(
+        currency,
+        Task.id
+    ).having(
+        func.sum(quantity) != 0
+    ).order_by(
+        currency,
+        Task.id
+    )
+    tasks = [
+        {
+            'currency': row.currency,
+            'task_id': row.id,
+            'task_name': row.name,
+            'payout_type': row.payment_type,
+            'rate': row.rate,
+            'quantity': row.quantity,
+            'workers': row.workers,
+            'gross_pay': row.gross_pay
+        }
+        for row in db.session.execute(task_totals)
+    ]
+
+    currency_totals = select(
+        currency.label('currency'),
+        func.count(paid_worker.distinct()).label('workers'),
+        func.sum(quantity * rate).label('gross_pay')
+    ).join_from(
+        rollup, Task, Task.id == rollup.task_id
+    ).where(
+        *filters
+    ).group_by(
+        currency
+    ).having(
+        func.sum(quantity) != 0
+    ).order_by(
+        currency
+    )
+    currencies = [
+        {'currency': row.currency, 'workers': row.workers, 'gross_pay': row.gross_pay}
+        for row in db.session.execute(currency_totals)
+    ]
+
+    logging.debug(f"Summed payouts for company {company_id}: {len(tasks)} tasks in {len(currencies)} currencies")
+    return tasks, currencies
+
+
+def latest_attendance(company_id, start_date, end_date, limit):
+    """
+    Return the limit most recent attendance rows between start_date and end_date.
+
+    ORDER BY date DESC LIMIT is pushed down to the (company_id, date) index
+    and worker and task names are joined in the same query, so the cost does
+    not grow with the date range. Each row has date, status, worker_id,
+    first_name, last_name, task_id, task_name and per_day_payout.
+    """
+    statement = select(
+        Attendance.date,
+        Attendance.status,
+        Worker.id.label('worker_id'),
+        Worker.first_name,
+        Worker.last_name,
+        Task.id.label('task_id'),
+        Task.name.label('task_name'),
+        Task.per_day_payout
+    ).join_from(
+        Attendance, Worker, Worker.id == Attendance.worker_id
+    ).join(
+        Task, Task.id == Attendance.task_id
+    ).where(
+        Attendance.company_id == company_id,
+        Attendance.date.between(start_date, end_date)
+    ).order_by(
+        Attendance.date.desc(),
+        Attendance.id.desc()
+    ).limit(limit)
+    return db.session.execute(statement).all()
+
+
+def count_present_days(company_id, start_date, end_date, worker_ids):
+    """Return {worker_id: Present days} for just worker_ids, with one grouped query"""
+    if not worker_ids:
+        return {}
+    rollup = AttendanceDailyRollup
+    return dict(db.session.query(
+        rollup.worker_id,
+        func.sum(rollup.present_rows)
+    ).filter(
+        rollup.company_id == company_id,
+        rollup.date.between(start_date, end_date),
+        rollup.worker_id.in_(set(worker_ids))
+    ).group_by(
+        rollup.worker_id
+    ).all())
+
+
+def sum_period_totals(company_id, start_date, end_date, group_by='task', default_rate=None, default_currency=None):
+    """
+    Total days, units, hours and payout per task or per worker and currency.
+
+    One grouped query over the attendance rollup. days counts Present days
+    on per_day tasks, units and hours are summed on per_part and per_hour
+    tasks, and payout is quantity times rate. Returns (id, name, currency,
+    days, units, hours, payout) tuples, where name is the task name or the
+    worker's full name.
+    """
+    rollup = AttendanceDailyRollup
+    quantity, rate, currency = _payout_expressions(default_rate, default_currency)
+    if group_by == 'worker':
+        keys = (Worker.id, Worker.first_name, Worker.last_name)
+    else:
+        keys = (Task.id, Task.name)
+
+    statement = select(
+        *keys,
+        currency.label('currency'),
+        func.sum(case((Task.payment_type == 'per_day', quantity), else_=0)).label('days'),
+        func.sum(case((Task.payment_type == 'per_part', quantity), else_=0)).label('units'),
+        func.sum(case((Task.payment_type == 'per_hour', quantity), else_=0)).label('hours'),
+        func.sum(quantity * rate).label('payout')
+    ).join_from(
+        rollup, Task, Task.id == rollup.task_id
+    ).where(
+        rollup.company_id == company_id,
+        rollup.date.between(start_date, end_date),
+        Task.payment_type.in_(PAYMENT_TYPES),
+        _task_started_by(end_date)
+    )
+    if group_by == 'worker':
+        statement = statement.join(Worker, Worker.id == rollup.worker_id).where(Worker.company_id == company_id)
+    statement = statement.group_by(currency, *keys)
+
+    rows = []
+    for row in db.session.execute(statement):
+        name = f"{row[1]} {row[2]}" if group_by == 'worker' else row[1]
+        rows.append((row[0], name, row.currency, row.days, row.units, row.hours, row.payout))
+    return rows
+
+
+def _worker_earnings(company_id, worker_id, start_date, end_date, default_rate, default_currency):
+    """Base select and (earnings, currency) of a worker's rollup rows joined to their tasks"""
+    rollup = AttendanceDailyRollup
+    quantity, rate, currency = _payout_expressions(default_rate, default_currency)
+    earnings = func.coalesce(quantity * rate, 0)
+    conditions = [rollup.company_id == company_id, rollup.worker_id == worker_id]
+    if start_date is not None:
+        conditions.append(rollup.date >= start_date)
+    if end_date is not None:
+        conditions.append(rollup.date <= end_date)
+    return quantity, rate, currency, earnings, conditions
+
+
+def worker_history_page(company_id, worker_id, start_date=None, end_date=None, descending=False, after=None,
+                        limit=50, default_rate=None, default_currency=None):
+    """
+    Return one keyset page of a worker's per-day, per-task earnings.
+
+    Rows come from the attendance rollup through its (worker_id, date)
+    index and are ordered by date then task id; after is the (date, task id)
+    of the last row already seen. Earnings are quantity times rate.
+
+    The LIMIT is applied first and the page_running window function only
+    runs over the page's own rows, so a page never rescans the history
+    before it; callers add the running total carried over from earlier
+    pages. Returns (rows, day_totals), where day_totals maps (date,
+    currency) to the whole day's earnings for the dates on the page.
+    """
+    rollup = AttendanceDailyRollup
+    quantity, rate, currency, earnings, conditions = _worker_earnings(
+        company_id, worker_id, start_date, end_date, default_rate, default_currency
+    )
+    keys = (rollup.date, Task.id)
+    if after is not None:
+        position = tuple_(*keys)
+        conditions.append(position < tuple_(*after) if descending else position > tuple_(*after))
+
+    page = select(
+        rollup.date,
+        Task.id.label('task_id'),
+        Task.name.label('task_name'),
+        Task.payment_type,
+        rollup.present,
+        quantity.label('quantity'),
+        rate.label('rate'),
+        currency.label('currency'),
+        earnings.label('earnings')
+    ).join_from(
+        rollup, Task, Task.id == rollup.task_id
+    ).where(
+        *conditions
+    ).order_by(
+        *[key.desc() if descending else key.asc() for key in keys]
+    ).limit(limit).subquery()
+
+    order = [key.desc() if descending else key.asc() for key in (page.c.date, page.c.task_id)]
+    rows = db.session.execute(
+        select(
+            page,
+            func.sum(page.c.earnings).over(partition_by=page.c.currency, order_by=order, rows=(None, 0))
+            .label('page_running')
+        ).order_by(*order)
+    ).all()
+
+    day_totals = {}
+    if rows:
+        _, _, currency, earnings, conditions = _worker_earnings(
+            company_id, worker_id, start_date, end_date, default_rate, default_currency
+        )
+        day_totals = {
+            (day, code): total for day, code, total in db.session.execute(
+                select(rollup.date, currency, func.sum(earnings)).join_from(
+                    rollup, Task, Task.id == rollup.task_id
+                ).where(
+                    *conditions, rollup.date.in_({row.date for row in rows})
+                ).group_by(rollup.date, currency)
+            )
+        }
+    return rows, day_totals
+
+
+def worker_earnings_totals(company_id, worker_id, start_date=None, end_date=None, default_rate=None,
+                           default_currency=None, up_to=None, inclusive=True):
+    """
+    Return {currency: total earnings} for a worker over a date range.
+
+    up_to is a (date, task id) position as in worker_history_page; only rows
+    at or before it (strictly before it unless inclusive) are summed.
+    """
+    rollup = AttendanceDailyRollup
+    _, _, currency, earnings, conditions = _worker_earnings(
+        company_id, worker_id, start_date, end_date, default_rate, default_currency
+    )
+    if up_to is not None:
+        position = tuple_(rollup.date, Task.id)
+        conditions.append(position <= tuple_(*up_to) if inclusive else position < tuple_(*up_to))
+    return dict(db.session.execute(
+        select(currency, func.sum(earnings)).join_from(
+            rollup, Task, Task.id == rollup.task_id
+        ).where(*conditions).group_by(currency)
+    ).all())
@@ -0,0 +1,432 @@
+"""
+Report Export
+=============
+
+Writers that turn report rows into downloadable files without holding the
+whole file in memory.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import codecs
+import csv
+import io
+import itertools
+import logging
+import multiprocessing
+import os
+import shutil
+import struct
+import tempfile
+import threading
+
+# Flush the CSV buffer to the client once it grows past this many characters
+CSV_CHUNK_SIZE = 64 * 1024
+
+XLSX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+# Column widths are sized from the header and this many leading rows, which
+# are the only rows held in memory while a sheet is written
+XLSX_WIDTH_SAMPLE_ROWS = 500
+XLSX_MAX_COLUMN_WIDTH = 50
+
+# Processes rendering XLSX files outside the web worker; 0 renders in-process
+# unless a caller asks render_xlsx to isolate the render
+XLSX_RENDER_PROCESSES = int(os.environ.get('XLSX_RENDER_PROCESSES', 0))
+# Rows per batch handed from the web worker to a render process
+XLSX_RENDER_BATCH_ROWS = 5000
+
+COLUMNAR_MIMETYPES = {
+    'parquet': 'application/vnd.apache.parquet',
+    'arrow': 'application/vnd.apache.arrow.file'
+}
+
+# Rows converted to Arrow at a time; each batch becomes a Parquet row group
+COLUMNAR_BATCH_ROWS = 10000
+
+
+def iter_csv_chunks(rows, fieldnames, chunk_size=CSV_CHUNK_SIZE):
+    """
+    Yield a CSV file as UTF-8 byte chunks, starting with a BOM.
+
+    The BOM keeps Excel from misreading non-ASCII names. rows may be any
+    iterable of dicts and is consumed lazily, one buffer at a time.
+    """
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=fieldnames, restval='', extrasaction='ignore')
+
+    yield codecs.BOM_UTF8
+    writer.writeheader()
+
+    row_count = 0
+    byte_count = len(codecs.BOM_UTF8)
+    for row in rows:
+        writer.writerow(row)
+        row_count += 1
+        if buffer.tell() >= chunk_size:
+            chunk = buffer.getvalue().encode('utf-8')
+            byte_count += len(chunk)
+            yield chunk
+            buffer.seek(0)
+            buffer.truncate(0)
+
+    chunk = buffer.getvalue().encode('utf-8')
+    if chunk:
+        byte_count += len(chunk)
+        yield chunk
+
+    logging.info(f"CSV streamed with {row_count} rows and {len(fieldnames)} columns ({byte_count} bytes)")
+
+
+def _xlsx_named_styles():
+    """Build the shared header, text and number styles for report workbooks"""
+    from openpyxl.styles import Alignment, Border, Font, NamedStyle, PatternFill, Side
+
+    side = Side(style='thin')
+    border = Border(left=side, right=side, top=side, bottom=side)
+    return [
+        NamedStyle(
+            name='report_header',
+            font=Font(bold=True, color='FFFFFF', size=11),
+            fill=PatternFill(start_color='1F4E78', end_color='1F4E78', fill_type='solid'),
+            alignment=Alignment(horizontal='center', vertical='center', wrap_text=True),
+            border=border
+        ),
+        NamedStyle(
+            name='report_text',
+            alignment=Alignment(horizontal='left', vertical='center', wrap_text=True),
+            border=border
+        ),
+        NamedStyle(
+            name='report_number',
+            alignment=Alignment(horizontal='right', vertical='center'),
+            border=border
+        ),
+    ]
+
+
+def _xlsx_cell(sheet, value, style):
+    """Create a write-only cell using one of the shared named styles"""
+    from openpyxl.cell import WriteOnlyCell
+
+    cell = WriteOnlyCell(sheet, value=value)
+    cell.style = style
+    return cell
+
+
+def write_xlsx(output, sheets, width_sample_rows=XLSX_WIDTH_SAMPLE_ROWS):
+    """
+    Write report sheets to an XLSX file in openpyxl write-only mode.
+
+    sheets is an iterable of (title, headers, rows) where rows yields dicts
+    keyed by header. Rows are streamed into the workbook, so memory stays
+    bounded by the width sample rather than the size of the report.
+    """
+    from openpyxl import Workbook
+    from openpyxl.utils import get_column_letter
+
+    workbook = Workbook(write_only=True)
+    for style in _xlsx_named_styles():
+        workbook.add_named_style(style)
+
+    for title, headers, rows in sheets:
+        sheet = workbook.create_sheet(title=title)
+        rows = iter(rows)
+
+        # Column widths must be set before the first row is written
+        sample = list(itertools.islice(rows, width_sample_rows))
+        widths = [len(str(header)) for header in headers]
+        for row in sample:
+            for idx, header in enumerate(headers):
+                value = row.get(header)
+                if value is not None and value != '':
+                    widths[idx] = max(widths[idx], len(str(value)))
+        for idx, width in enumerate(widths, 1):
+            sheet.column_dimensions[get_column_letter(idx)].width = min(width + 3, XLSX_MAX_COLUMN_WIDTH)
+
+        sheet.append([_xlsx_cell(sheet, header, 'report_header') for header in headers])
+        row_count = 0
+        for row in itertools.chain(sample, rows):
+            cells = []
+            for header in headers:
+                value = row.get(header)
+                style = 'report_number' if isinstance(value, (int, float)) and not isinstance(value, bool) else 'report_text'
+                cells.append(_xlsx_cell(sheet, value, style))
+            sheet.append(cells)
+            row_count += 1
+
+        logging.info(f"XLSX sheet '{title}' written with {row_count} rows and {len(headers)} columns")
+
+    workbook.save(output)
+
+
+_render_executor = None
+_render_executor_lock = threading.Lock()
+
+
+def _get_render_executor():
+    """Create the XLSX render pool on first use"""
+    global _render_executor
+    with _render_executor_lock:
+        if _render_executor is None:
+            # Render processes only need this module, so they are spawned rather
+            # than forked from a web worker that may hold threads and connections
+            _render_executor = ProcessPoolExecutor(max_workers=max(XLSX_RENDER_PROCESSES, 1),
+                                                   mp_context=multiprocessing.get_context('spawn'))
+        return _render_executor
+
+
+def _discard_render_executor(executor):
+    """Drop a pool whose process died so the next render starts a new one"""
+    global _render_executor
+    with _render_executor_lock:
+        if _render_executor is executor:
+            _render_executor = None
+    executor.shutdown(wait=False)
+
+
+def _spool_column(pa, values):
+    """
+    Encode one column of a row batch as an Arrow array that round-trips its values.
+
+    A column holding a single Python type becomes a plain typed array; mixed
+    columns (numbers next to 'N/A', say) become a dense union with one child
+    per type, so every cell keeps the type it is written with.
+    """
+    kinds = []
+    for value in values:
+        if value is not None and type(value) not in kinds:
+            kinds.append(type(value))
+    if len(kinds) <= 1:
+        return _plain_array(pa, values)
+
+    codes = {kind: index + 1 for index, kind in enumerate(kinds)}
+    buckets = {kind: [] for kind in kinds}
+    type_ids = []
+    offsets = []
+    null_count = 0
+    for value in values:
+        if value is None:
+            type_ids.append(0)
+            offsets.append(null_count)
+            null_count += 1
+        else:
+            bucket = buckets[type(value)]
+            type_ids.append(codes[type(value)])
+            offsets.append(len(bucket))
+            bucket.append(value)
+    children = [pa.nulls(null_count)] + [_plain_array(pa, buckets[kind]) for kind in kinds]
+    return pa.UnionArray.from_dense(pa.array(type_ids, type=pa.int8()), pa.array(offsets, type=pa.int32()), children)
+
+
+def _plain_array(pa, values):
+    """Build an Arrow array from values of one type, as strings if Arrow has no type for them"""
+    try:
+        return pa.array(values)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return pa.array([None if value is None else str(value) for value in values], type=pa.string())
+
+
+def _spool_sheets(spool, sheets, batch_rows):
+    """
+    Write sheets to spool as Arrow IPC row batches; returns (title, headers) pairs.
+
+    Each batch of batch_rows rows is a length-prefixed IPC stream with one
+    column per header, and a zero length ends a sheet, so rows are never
+    held in memory all at once.
+    """
+    import pyarrow as pa
+
+    layout = []
+    for title, headers, rows in sheets:
+        layout.append((title, list(headers)))
+        names = [str(index) for index in range(len(headers))]
+        rows = iter(rows)
+        while True:
+            batch = list(itertools.islice(rows, batch_rows))
+            if not batch:
+                break
+            record_batch = pa.RecordBatch.from_arrays(
+                [_spool_column(pa, [row.get(header) for row in batch]) for header in headers], names=names
+            )
+            sink = pa.BufferOutputStream()
+            with pa.ipc.new_stream(sink, record_batch.schema) as writer:
+                writer.write_batch(record_batch)
+            data = sink.getvalue()
+            spool.write(struct.pack('<Q', data.size))
+            spool.write(data)
+        spool.write(struct.pack('<Q', 0))
+    return layout
+
+
+def _iter_spooled_rows(spool, headers):
+    """Yield one sheet's rows from a spool as dicts keyed by header"""
+    import pyarrow as pa
+
+    while True:
+        size, = struct.unpack('<Q', spool.read(8))
+        if size == 0:
+            return
+        batch = pa.ipc.open_stream(spool.read(size)).read_next_batch()
+        columns = [batch.column(index).to_pylist() for index in range(len(headers))]
+        for values in zip(*columns):
+            yield dict(zip(headers, values))
+
+
+def _render_spooled_xlsx(spool_path, layout, output_path):
+    """Write an XLSX file from spooled sheets; runs in a render process"""
+    with open(spool_path, 'rb') as spool, open(output_path, 'wb') as output:
+        write_xlsx(output, ((title, headers, _iter_spooled_rows(spool, headers)) for title, headers in layout))
+    return output_path
+
+
+def render_xlsx(output, sheets, batch_rows=XLSX_RENDER_BATCH_ROWS, isolate=None):
+    """
+    Write report sheets to an XLSX file like write_xlsx, optionally in a
+    render process.
+
+    isolate chooses per call whether openpyxl's serialisation, the
+    expensive part, runs in the render pool; by default it does when
+    XLSX_RENDER_PROCESSES is set. Rows are spooled to a temporary file as
+    Arrow IPC batches of batch_rows rows, a render process turns the spool
+    into the workbook, and it is copied to output.
+
+    This only moves the CPU work out of the web worker: the caller still
+    waits for the render to finish. Downloads too large to wait for go
+    through the report job API instead (see report_jobs).
+    """
+    if isolate is None:
+        isolate = XLSX_RENDER_PROCESSES > 0
+    if not isolate:
+        return write_xlsx(output, sheets)
+
+    with tempfile.TemporaryDirectory(prefix='xlsx_render_') as work_dir:
+        spool_path = os.path.join(work_dir, 'rows.arrows')
+        with open(spool_path, 'wb') as spool:
+            layout = _spool_sheets(spool, sheets, batch_rows)
+        executor = _get_render_executor()
+        try:
+            rendered_path = executor.submit(
+                _render_spooled_xlsx, spool_path, layout, os.path.join(work_dir, 'report.xlsx')
+            ).result()
+        except BrokenProcessPool:
+            _discard_render_executor(executor)
+            raise
+        with open(rendered_path, 'rb') as rendered:
+            shutil.copyfileobj(rendered, output)
+    logging.info(f"XLSX workbook with {len(layout)} sheets rendered in a separate process")
+
+
+def _arrow_type(pa, logical_type):
+    """Map a report column's logical type to an Arrow type"""
+    return {
+        'int': pa.int64(),
+        'float': pa.float64(),
+        'date': pa.date32(),
+        'currency': pa.dictionary(pa.int32(), pa.string()),
+        'bool': pa.bool_(),
+        'string': pa.string()
+    }[logical_type]
+
+
+def _arrow_value(value, logical_type):
+    """Coerce a report value for a typed column; blanks and bad numbers become null"""
+    if value is None or value == '':
+        return None
+    try:
+        if logical_type == 'int':
+            return int(value)
+        if logical_type == 'float':
+            return float(value)
+    except (TypeError, ValueError):
+        return None
+    if logical_type in ('date', 'bool'):
+        return value
+    return str(value)
+
+
+def write_columnar(output, rows, columns, format_type, metadata=None, dictionaries=None,
+                   batch_rows=COLUMNAR_BATCH_ROWS):
+    """
+    Write report rows as a Parquet or Arrow IPC file with typed columns.
+
+    columns is a list of (header, logical type) pairs where the type is one
+    of 'int', 'float', 'date', 'bool', 'currency' or 'string'; rows yields
+    dicts keyed by header. Rows are converted in batches of batch_rows, so only
+    one batch is held in memory at a time.
+
+    Currency columns are dictionary encoded. dictionaries (header -> values)
+    seeds a column's dictionary so codes get the same indices in every file;
+    values found in the rows that are not in it are appended as they are
+    seen, and Arrow files carry them as dictionary deltas.
+    """
+    import pyarrow as pa
+
+    known = {
+        header: {str(value): None for value in (dictionaries or {}).get(header, ())}
+        for header, logical_type in columns if logical_type == 'currency'
+    }
+    schema = pa.schema(
+        [pa.field(header, _arrow_type(pa, logical_type)) for header, logical_type in columns],
+        metadata={key: str(value) for key, value in (metadata or {}).items()}
+    )
+    if format_type == 'parquet':
+        import pyarrow.parquet as pq
+        writer = pq.ParquetWriter(output, schema, compression='snappy')
+    elif format_type == 'arrow':
+        writer = pa.ipc.new_file(output, schema, options=pa.ipc.IpcWriteOptions(emit_dictionary_deltas=True))
+    else:
+        raise ValueError(f"Unsupported columnar format: {format_type}")
+
+    row_count = 0
+    rows = iter(rows)
+    with writer:
+        while True:
+            batch = list(itertools.islice(rows, batch_rows))
+            if not batch:
+                break
+            arrays = []
+            for header, logical_type in columns:
+                values = [_arrow_value(row.get(header), logical_type) for row in batch]
+                if logical_type != 'currency':
+                    arrays.append(pa.array(values, type=schema.field(header).type))
+                    continue
+                # The dictionary only grows, so indices from earlier batches stay valid
+                codes = known[header]
+                for value in values:
+                    if value is not None and value not in codes:
+                        codes[value] = None
+                positions = {value: index for index, value in enumerate(codes)}
+                indices = pa.array([None if value is None else positions[value] for value in values], type=pa.int32())
+                arrays.append(pa.DictionaryArray.from_arrays(indices, pa.array(list(codes), type=pa.string())))
+            writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=schema))
+            row_count += len(batch)
+
+    logging.info(f"{format_type.title()} file written with {row_count} rows and {len(columns)} columns")
+
+
+def write_columnar_report(output, rows, columns, format_type, report_type, start_date, end_date, currencies=None):
+    """
+    Write a payroll report's rows with write_columnar.
+
+    Every row gets period_start and period_end date columns, so files from
+    several periods can be combined, and currency codes are dictionary
+    encoded, starting from the sorted currencies. Codes in the rows that
+    are not in currencies are added to the dictionary as they appear.
+    """
+    columns = list(columns) + [('period_start', 'date'), ('period_end', 'date')]
+    dictionaries = {
+        header: sorted(currencies or ()) for header, logical_type in columns if logical_type == 'currency'
+    }
+    write_columnar(
+        output,
+        (dict(row, period_start=start_date, period_end=end_date) for row in rows),
+        columns,
+        format_type,
+        metadata={
+            'report_type': report_type,
+            'start_date': start_date.isoformat(),
+            'end_date': end_date.isoformat()
+        },
+        dictionaries=dictionaries
+    )
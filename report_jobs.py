@@ -0,0 +1,434 @@
+"""
+Report Jobs
+===========
+
+Background report generation for exports too large to build inside a
+request.
+
+Jobs run in a local process pool, so heavy exports do not tie up the web
+worker. Each job has a directory under REPORT_JOBS_DIR holding status.json
+and, once finished, the generated file. Any process can read a job's status
+from disk, and nothing is lost when the pool is recycled.
+
+A running job records the pid of its worker and refreshes heartbeat_at
+every REPORT_JOB_HEARTBEAT_SECONDS with the rows written so far. If the
+worker dies with the web process that owns the pool, read_job finds the
+heartbeat stale (or the pid gone) and marks the job failed, so it is never
+left running forever.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, date
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import uuid
+
+REPORT_JOBS_DIR = os.environ.get('REPORT_JOBS_DIR', os.path.join(tempfile.gettempdir(), 'report_jobs'))
+REPORT_JOB_WORKERS = int(os.environ.get('REPORT_JOB_WORKERS', 2))
+# Finished and failed jobs are removed after this many seconds
+REPORT_JOB_TTL_SECONDS = int(os.environ.get('REPORT_JOB_TTL_SECONDS', 24 * 60 * 60))
+# Running jobs write a heartbeat this often, and are failed once it is this old
+REPORT_JOB_HEARTBEAT_SECONDS = int(os.environ.get('REPORT_JOB_HEARTBEAT_SECONDS', 10))
+REPORT_JOB_STALE_SECONDS = int(os.environ.get('REPORT_JOB_STALE_SECONDS', 120))
+
+JOB_KINDS = ('workbook', 'export')
+JOB_FORMATS = ('csv', 'xlsx', 'parquet', 'arrow')
+
+_executor = None
+_executor_lock = threading.Lock()
+# Serialises status.json updates between a job and its heartbeat thread
+_status_lock = threading.Lock()
+
+
+def _job_dir(job_id):
+    """Return a job's directory, refusing ids that are not plain hex"""
+    if not job_id or not all(c in '0123456789abcdef' for c in job_id):
+        raise ValueError(f"Invalid job id: {job_id!r}")
+    return os.path.join(REPORT_JOBS_DIR, job_id)
+
+
+def _load_status(job_id):
+    """Read a job's status.json as it is on disk, or None"""
+    try:
+        with open(os.path.join(_job_dir(job_id), 'status.json')) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _write_status(job_id, **changes):
+    """Merge changes into a job's status.json, replacing the file atomically"""
+    with _status_lock:
+        path = os.path.join(_job_dir(job_id), 'status.json')
+        status = _load_status(job_id) or {'job_id': job_id}
+        status.update(changes)
+        status['updated_at'] = datetime.utcnow().isoformat()
+        fd, tmp_path = tempfile.mkstemp(dir=_job_dir(job_id), suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(status, f)
+        os.replace(tmp_path, path)
+        return status
+
+
+def _process_gone(host, pid):
+    """Check whether a process recorded on this host has exited"""
+    if not pid or host != socket.gethostname():
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        return False
+    return False
+
+
+def _orphan_reason(status):
+    """Return why a queued or running job can no longer finish, or None"""
+    if status.get('status') == 'queued':
+        if _process_gone(status.get('host'), status.get('submitted_by_pid')):
+            return 'The server restarted before the report started'
+    elif status.get('status') == 'running':
+        if _process_gone(status.get('host'), status.get('pid')):
+            return 'The report worker stopped unexpectedly'
+        heartbeat = status.get('heartbeat_at')
+        if heartbeat and (datetime.utcnow() - datetime.fromisoformat(heartbeat)).total_seconds() > REPORT_JOB_STALE_SECONDS:
+            return 'The report worker stopped responding'
+    return None
+
+
+def read_job(job_id):
+    """
+    Return a job's status dict, or None if it does not exist.
+
+    A queued or running job whose process has gone away is marked failed.
+    """
+    status = _load_status(job_id)
+    if status is None:
+        return None
+    reason = _orphan_reason(status)
+    if reason is not None:
+        logging.warning(f"Report job {job_id} orphaned: {reason}")
+        status = _write_status(job_id, status='failed', message=reason, error=reason)
+    return status
+
+
+def job_artifact_path(job):
+    """Return the path of a finished job's file"""
+    return os.path.join(_job_dir(job['job_id']), job['filename'])
+
+
+def _init_worker():
+    """Drop database connections inherited from the parent process"""
+    from app_init import app
+    from models import db
+    with app.app_context():
+        db.engine.dispose(close=False)
+
+
+def new_report_executor(max_workers):
+    """Create a process pool whose workers can run report code"""
+    # fork reuses the already-imported app instead of initialising it again
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context('fork' if 'fork' in methods else None)
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=context, initializer=_init_worker)
+
+
+def _get_executor():
+    """Create the shared process pool on first use"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = new_report_executor(REPORT_JOB_WORKERS)
+        return _executor
+
+
+def purge_expired_jobs(max_age=REPORT_JOB_TTL_SECONDS):
+    """Delete job directories that have not been updated for max_age seconds"""
+    if not os.path.isdir(REPORT_JOBS_DIR):
+        return 0
+    cutoff = time.time() - max_age
+    removed = 0
+    for name in os.listdir(REPORT_JOBS_DIR):
+        path = os.path.join(REPORT_JOBS_DIR, name)
+        try:
+            if os.path.getmtime(os.path.join(path, 'status.json')) < cutoff:
+                shutil.rmtree(path, ignore_errors=True)
+                removed += 1
+        except OSError:
+            continue
+    if removed:
+        logging.info(f"Removed {removed} expired report jobs")
+    return removed
+
+
+def submit_report_job(company_id, kind, params):
+    """
+    Queue a report job and return its initial status.
+
+    kind is 'workbook' for the /report/download workbook or 'export' for a
+    single report type in params['format'], or report_type 'all' for the
+    combined payroll workbook. params holds ISO start_date and end_date plus
+    the optional report_type.
+    """
+    if kind not in JOB_KINDS:
+        raise ValueError(f"Unknown report job kind: {kind}")
+    purge_expired_jobs()
+
+    job_id = uuid.uuid4().hex
+    os.makedirs(_job_dir(job_id))
+    status = _write_status(
+        job_id,
+        company_id=company_id,
+        kind=kind,
+        params=params,
+        status='queued',
+        progress=0,
+        message='Waiting for a worker',
+        host=socket.gethostname(),
+        submitted_by_pid=os.getpid(),
+        created_at=datetime.utcnow().isoformat()
+    )
+
+    try:
+        future = _get_executor().submit(run_report_job, job_id)
+    except Exception as e:
+        logging.error(f"Could not queue report job {job_id}: {str(e)}")
+        return _write_status(job_id, status='failed', message='Could not queue the report', error=str(e))
+
+    def _record_crash(future):
+        # Exceptions inside the job are recorded by the job itself; this
+        # catches workers that died before they could write a status
+        error = future.exception()
+        if error is not None:
+            _write_status(job_id, status='failed', message='The report worker stopped unexpectedly', error=str(error))
+
+    future.add_done_callback(_record_crash)
+    logging.info(f"Queued {kind} report job {job_id} for company {company_id}")
+    return status
+
+
+def _counted(records, counter):
+    """Yield records, adding one to counter[0] for each"""
+    for record in records:
+        counter[0] += 1
+        yield record
+
+
+class _JobProgress:
+    """
+    A running job's rows written so far, reported to status.json.
+
+    counter is the record counter _counted keeps; progress is that count
+    against expected_rows, the rows the report is known to have. A
+    background thread writes it with a fresh heartbeat every
+    REPORT_JOB_HEARTBEAT_SECONDS, so status.json shows real progress and
+    stays recognisably alive while the job runs.
+    """
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.counter = [0]
+        self.expected_rows = None
+        self.message = 'Building report'
+        self._stop = threading.Event()
+        self._thread = None
+
+    def percent(self):
+        """Rows written as a percentage of the expected rows, below 100 until finished"""
+        if not self.expected_rows:
+            return 0
+        return min(99, self.counter[0] * 100 // self.expected_rows)
+
+    def report(self, message=None):
+        """Write the current progress and a fresh heartbeat"""
+        if message is not None:
+            self.message = message
+        _write_status(
+            self.job_id,
+            progress=self.percent(),
+            rows_written=self.counter[0],
+            expected_rows=self.expected_rows,
+            message=self.message,
+            heartbeat_at=datetime.utcnow().isoformat()
+        )
+
+    def _beat(self):
+        while not self._stop.wait(REPORT_JOB_HEARTBEAT_SECONDS):
+            self.report()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._beat, name=f'report-job-{self.job_id}', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+def _render(company, kind, params, output_dir, progress):
+    """Build a job's report and write it to output_dir; returns (filename, mimetype, row_count)"""
+    from report_engine import PAYMENT_TYPES
+    from report_export import write_xlsx, XLSX_MIMETYPE
+    from report_pipeline import (payroll_workbook_sheets, stream_report_records, workbook_payment_types,
+                                 workbook_records, workbook_sheets)
+    from report_preflight import count_report_rows
+
+    start_date = date.fromisoformat(params['start_date'])
+    end_date = date.fromisoformat(params['end_date'])
+    report_type = params.get('report_type')
+
+    if kind == 'workbook':
+        payment_types = workbook_payment_types(report_type)
+    elif report_type == 'all':
+        payment_types = PAYMENT_TYPES
+    else:
+        payment_types = (report_type,)
+    progress.expected_rows = sum(count_report_rows(company, start_date, end_date, payment_type)
+                                 for payment_type in payment_types)
+    progress.report('Writing file')
+
+    if kind == 'workbook':
+        report = workbook_records(company, start_date, end_date, report_type)
+    else:
+        report = stream_report_records(company, start_date, end_date, payment_types=payment_types)
+    if kind == 'export' and report_type != 'all':
+        return _write_export(company, report, report_type, params.get('format'), start_date, end_date, output_dir,
+                             counter=progress.counter)
+
+    for payout_type in payment_types:
+        report[payout_type] = _counted(report[payout_type], progress.counter)
+    if kind == 'workbook':
+        filename = f'report_{start_date}_to_{end_date}.xlsx'
+        sheets = workbook_sheets(report, report_type)
+    else:
+        filename = f'payroll_report_{start_date}_to_{end_date}.xlsx'
+        sheets = payroll_workbook_sheets(report, company)
+    with open(os.path.join(output_dir, filename), 'wb') as output:
+        write_xlsx(output, sheets)
+    return filename, XLSX_MIMETYPE, progress.counter[0]
+
+
+def _write_export(company, report, report_type, format_type, start_date, end_date, output_dir, counter=None):
+    """
+    Write one report type as its records are produced; returns (filename, mimetype, row_count).
+
+    counter, if given, is a [count] list advanced as records are written.
+    """
+    from report_export import iter_csv_chunks, write_columnar_report, write_xlsx, COLUMNAR_MIMETYPES, XLSX_MIMETYPE
+    from report_pipeline import report_columns, report_currencies, project_record, typed_columns, EXPORT_COLUMNS
+
+    columns = report_columns(EXPORT_COLUMNS, report_type, report['import_fields'], report['custom_fields'])
+    fieldnames = [header for _, header in columns]
+    counter = counter if counter is not None else [0]
+    first_count = counter[0]
+    rows = (project_record(record, columns) for record in _counted(report[report_type], counter))
+    if format_type in COLUMNAR_MIMETYPES:
+        filename = f'{report_type}_report_{start_date}_to_{end_date}.{format_type}'
+        with open(os.path.join(output_dir, filename), 'wb') as output:
+            write_columnar_report(output, rows, typed_columns(columns, report['import_fields'], report['custom_fields']),
+                                  format_type, report_type, start_date, end_date,
+                                  currencies=report_currencies(company.id, report_type, start_date, end_date))
+        return filename, COLUMNAR_MIMETYPES[format_type], counter[0] - first_count
+    if format_type == 'xlsx':
+        filename = f'{report_type}_report_{start_date}_to_{end_date}.xlsx'
+        with open(os.path.join(output_dir, filename), 'wb') as output:
+            write_xlsx(output, [('Report', fieldnames, rows)])
+        return filename, XLSX_MIMETYPE, counter[0] - first_count
+
+    filename = f'{report_type}_report_{start_date}_to_{end_date}.csv'
+    with open(os.path.join(output_dir, filename), 'wb') as output:
+        for chunk in iter_csv_chunks(rows, fieldnames):
+            output.write(chunk)
+    return filename, 'text/csv; charset=utf-8', counter[0] - first_count
+
+
+def run_report_job(job_id):
+    """Generate a queued report; runs inside a pool worker"""
+    from app_init import app
+    from models import db, Company
+
+    job = read_job(job_id)
+    if job is None:
+        logging.error(f"Report job {job_id} disappeared before it started")
+        return
+    if job.get('status') != 'queued':
+        logging.error(f"Report job {job_id} is {job.get('status')}, not queued; not running it")
+        return
+
+    started = time.time()
+    _write_status(job_id, status='running', progress=0, message='Building report', host=socket.gethostname(),
+                  pid=os.getpid(), heartbeat_at=datetime.utcnow().isoformat())
+    progress = _JobProgress(job_id)
+    progress.start()
+    with app.app_context():
+        try:
+            company = db.session.get(Company, job['company_id'])
+            if company is None:
+                raise ValueError('Company not found')
+            filename, mimetype, row_count = _render(company, job['kind'], job['params'], _job_dir(job_id), progress)
+            progress.stop()
+            _write_status(
+                job_id,
+                status='finished',
+                progress=100,
+                message='Report ready',
+                filename=filename,
+                mimetype=mimetype,
+                row_count=row_count,
+                rows_written=row_count,
+                duration_seconds=round(time.time() - started, 2)
+            )
+            logging.info(f"Report job {job_id} finished with {row_count} rows in {time.time() - started:.1f}s")
+        except Exception as e:
+            progress.stop()
+            logging.error(f"Report job {job_id} failed: {str(e)}", exc_info=True)
+            _write_status(job_id, status='failed', message='Failed to generate report', error=str(e))
+        finally:
+            db.session.remove()
+
+
+def generate_company_reports(company_id, start_date, end_date, output_dir, format_type='csv'):
+    """
+    Write a company's per_day, per_part and per_hour reports to output_dir.
+
+    Used by `flask reports generate-all`; runs inside a pool worker. All
+    three types come from one attendance scan, or for large companies are
+    streamed a chunk of workers at a time. Returns a summary dict with the
+    files written, their row counts and the time taken, or the error.
+    """
+    from app_init import app
+    from models import db, Company
+    from report_engine import PAYMENT_TYPES
+    from report_pipeline import stream_report_records
+
+    started = time.time()
+    result = {'company_id': company_id, 'files': [], 'row_count': 0, 'error': None}
+    with app.app_context():
+        try:
+            company = db.session.get(Company, company_id)
+            if company is None:
+                raise ValueError('Company not found')
+            result['company_name'] = company.name
+            os.makedirs(output_dir, exist_ok=True)
+            report = stream_report_records(company, start_date, end_date, payment_types=PAYMENT_TYPES)
+            for report_type in PAYMENT_TYPES:
+                filename, _, row_count = _write_export(company, report, report_type, format_type, start_date, end_date,
+                                                       output_dir)
+                result['files'].append(os.path.join(output_dir, filename))
+                result['row_count'] += row_count
+        except Exception as e:
+            logging.error(f"Bulk report generation failed for company {company_id}: {str(e)}", exc_info=True)
+            result['error'] = str(e)
+        finally:
+            db.session.remove()
+    result['seconds'] = round(time.time() - started, 2)
+    return result
@@ -0,0 +1,937 @@
+"""
+Report Pipeline
+===============
+
+Single-pass payroll pipeline shared by the /reports page, the
+/report/download workbook and the /api/reports export.
+
+Attendance is scanned once (see report_engine.scan_attendance) and every
+per_day, per_part and per_hour record is built together. Endpoints only
+choose which columns to show and what to call them.
+
+Large reports evaluate custom fields column by column with NumPy/pandas
+instead of row by row. Finished records are kept in report_cache until the
+company's data changes, and closed payroll periods are read from their
+snapshot (see payroll_periods). Exports for large companies use
+stream_report_records, which builds records a chunk of workers at a time.
+"""
+
+from attendance_changes import changed_attendance_pairs
+from datetime import date
+from formula_engine import compiled_field_formula, compiled_field_formula_vectorized, formula_names, resolve_field_order
+from custom_field_matrix import load_custom_field_matrix
+from models import db, ImportField, ReportField, Task, Worker
+from payroll_periods import find_closed_period, load_snapshot, snapshot_fields, snapshot_keys, snapshot_values
+from report_cache import report_cache, report_data_version
+from report_engine import (PAYMENT_TYPES, iter_worker_id_chunks, scan_attendance, scan_attendance_page, count_attendance_buckets,
+                           count_present_days, latest_attendance, sum_payouts, worker_earnings_totals,
+                           worker_history_page)
+import itertools
+import logging
+import os
+
+try:
+    import numpy as np
+    import pandas as pd
+except ImportError:
+    np = None
+    pd = None
+
+# Reports with at least this many rows per payout type use column evaluation
+VECTORIZE_MIN_ROWS = 200
+
+# Rows per report on the first screen of the reports page and per
+# /api/reports/rows page
+REPORT_PAGE_ROWS = int(os.environ.get('REPORT_PAGE_ROWS', 50))
+
+# Companies with more workers than this are streamed a chunk of workers at a
+# time by stream_report_records instead of being built (and cached) whole
+REPORT_WORKER_CHUNK = int(os.environ.get('REPORT_WORKER_CHUNK', 1000))
+
+# Record key holding the quantity paid for each payout type
+QUANTITY_KEYS = {
+    'per_day': 'attendance_days',
+    'per_part': 'units_completed',
+    'per_hour': 'hours_worked'
+}
+
+# (record key, column header) pairs for the /api/reports CSV/Excel export
+EXPORT_COLUMNS = {
+    'per_day': [
+        ('first_name', 'first_name'),
+        ('last_name', 'last_name'),
+        ('task_name', 'task_name'),
+        ('attendance_days', 'attendance_days'),
+        ('daily_rate', 'daily_rate'),
+        ('per_day_currency', 'currency')
+    ],
+    'per_part': [
+        ('first_name', 'first_name'),
+        ('last_name', 'last_name'),
+        ('task_name', 'task_name'),
+        ('units_completed', 'units_completed'),
+        ('per_part_rate', 'per_part_rate'),
+        ('per_part_currency', 'currency')
+    ],
+    'per_hour': [
+        ('first_name', 'first_name'),
+        ('last_name', 'last_name'),
+        ('task_name', 'task_name'),
+        ('hours_worked', 'hours_worked'),
+        ('per_hour_rate', 'per_hour_rate'),
+        ('per_hour_currency', 'currency')
+    ]
+}
+
+# Logical types of record keys for typed (Parquet/Arrow) exports. Import
+# fields are text; custom fields are floats when numeric, text otherwise
+RECORD_KEY_TYPES = {
+    'worker_id': 'int',
+    'task_id': 'int',
+    'age': 'int',
+    'attendance_days': 'int',
+    'units_completed': 'int',
+    'hours_worked': 'float',
+    'daily_rate': 'float',
+    'per_part_rate': 'float',
+    'per_hour_rate': 'float',
+    'per_day_currency': 'currency',
+    'per_part_currency': 'currency',
+    'per_hour_currency': 'currency',
+    'deleted': 'bool'
+}
+
+# (record key, column header) pairs for the /report/download workbook
+WORKBOOK_COLUMNS = {
+    'per_day': [
+        ('first_name', 'First Name'),
+        ('last_name', 'Last Name'),
+        ('task_name', 'Task Name'),
+        ('attendance_days', 'Attendance Days'),
+        ('daily_rate', 'Daily Rate')
+    ],
+    'per_part': [
+        ('first_name', 'First Name'),
+        ('last_name', 'Last Name'),
+        ('task_name', 'Task Name'),
+        ('units_completed', 'Units Completed'),
+        ('per_part_rate', 'Per Part Rate'),
+        ('per_part_currency', 'Per Part Currency')
+    ],
+    'per_hour': [
+        ('first_name', 'First Name'),
+        ('last_name', 'Last Name'),
+        ('task_name', 'Task Name'),
+        ('hours_worked', 'Hours Worked'),
+        ('per_hour_rate', 'Per Hour Rate'),
+        ('per_hour_currency', 'Per Hour Currency')
+    ]
+}
+
+WORKBOOK_SHEET_TITLES = {
+    'per_day': 'Per Day',
+    'per_part': 'Per Part',
+    'per_hour': 'Per Hour'
+}
+
+# Record keys of the rate and currency for each payout type
+RATE_KEYS = {
+    'per_day': ('daily_rate', 'per_day_currency'),
+    'per_part': ('per_part_rate', 'per_part_currency'),
+    'per_hour': ('per_hour_rate', 'per_hour_currency')
+}
+
+SUMMARY_HEADERS = ['Currency', 'Payout Type', 'Rows', 'Workers', 'Quantity', 'Gross Pay']
+
+# How records are built for /api/reports, the reports page and payroll
+# snapshots; the /report/download workbook keeps its own (see workbook_rules)
+REPORT_RULES = {
+    'company_rate': False,  # the per-day rate is always the company's, not the task's
+    'all_fields': (),  # payout types whose records compute every report field, not only their own
+    'keep_empty': True,  # keep per_part and per_hour rows with 0 units or hours
+    'started_only': True  # leave out tasks that start after the report end date
+}
+
+
+def calculate_age(date_of_birth, today=None):
+    """Return a worker's age in whole years, or 0 when unknown"""
+    if not date_of_birth:
+        return 0
+    today = today or date.today()
+    try:
+        return today.year - date_of_birth.year - ((today.month, today.day) < (date_of_birth.month, date_of_birth.day))
+    except Exception:
+        return 0
+
+
+def evaluate_formula(field, context):
+    """Evaluate a ReportField's compiled formula against a record context"""
+    try:
+        result = compiled_field_formula(field.id, field.formula)(lambda name: context.get(name, 0))
+        return round(result, 2)
+    except Exception as e:
+        logging.error(f"Error evaluating formula {field.formula}: {str(e)}")
+        return 0.00
+
+
+def order_fields(fields):
+    """
+    Return numeric report fields in dependency order.
+
+    Also returns the names of fields caught in a reference cycle; those
+    cannot be computed and are reported as 0.
+    """
+    numeric_fields = [field for field in fields if field.field_type == 'numeric']
+    order, cycles = resolve_field_order(tuple((field.name, field.formula) for field in numeric_fields))
+    fields_by_name = {field.name: field for field in numeric_fields}
+    cyclic = {name for cycle in cycles for name in cycle}
+    if cyclic:
+        logging.warning(f"Report fields with circular references will be reported as 0: {sorted(cyclic)}")
+    return [fields_by_name[name] for name in order], cyclic
+
+
+def fields_for_payout_type(custom_fields, payout_type):
+    """Return the report fields that apply to a payout type"""
+    return [f for f in custom_fields if f.payout_type in (payout_type, 'both')]
+
+
+def report_columns(layout, payout_type, import_fields, custom_fields):
+    """Return (record key, header) pairs for a layout and payout type"""
+    columns = list(layout[payout_type])
+    columns += [(field.name, field.name) for field in import_fields]
+    columns += [(field.name, field.name) for field in fields_for_payout_type(custom_fields, payout_type)]
+    return columns
+
+
+def typed_columns(columns, import_fields, custom_fields):
+    """Return (header, logical type) pairs for (record key, header) columns"""
+    import_names = {field.name for field in import_fields}
+    numeric_names = {field.name for field in custom_fields if field.field_type == 'numeric'}
+    typed = []
+    for key, header in columns:
+        if key in import_names:
+            logical_type = 'string'
+        elif key in numeric_names:
+            logical_type = 'float'
+        else:
+            logical_type = RECORD_KEY_TYPES.get(key, 'string')
+        typed.append((header, logical_type))
+    return typed
+
+
+def project_record(record, columns):
+    """Select and rename a record's values for output"""
+    return {header: record.get(key) for key, header in columns}
+
+
+def project_rows(records, columns):
+    """Lazily project records for output; columns are bound when called"""
+    for record in records:
+        yield project_record(record, columns)
+
+
+def workbook_payment_types(report_type=None):
+    """Return the payment types in a /report/download workbook"""
+    return (report_type,) if report_type in ('per_day', 'per_part') else ('per_day', 'per_part')
+
+
+def workbook_rules(report_type=None):
+    """
+    Return the record rules of a /report/download workbook.
+
+    The workbook keeps the rules it had before it shared this pipeline:
+    the per-day rate, in the sheet and in formulas, is the company's daily
+    payout rate; a Per Part row needs units; tasks are not filtered by start
+    date; and without a report type the Per Day rows compute every numeric
+    report field.
+    """
+    return dict(REPORT_RULES, company_rate=True, keep_empty=False, started_only=False,
+                all_fields=() if report_type in ('per_day', 'per_part') else ('per_day',))
+
+
+# Snapshot keys of the workbook records frozen with a closed payroll period,
+# mapped to their (payout type, report type); per_part rows are the same
+# with or without a report type
+WORKBOOK_SNAPSHOTS = {
+    'workbook_per_day_all': ('per_day', None),
+    'workbook_per_day': ('per_day', 'per_day'),
+    'workbook_per_part': ('per_part', None)
+}
+
+
+def _workbook_snapshot_key(payout_type, report_type):
+    """Return the WORKBOOK_SNAPSHOTS key holding a workbook's records of one payout type"""
+    if payout_type == 'per_day' and report_type != 'per_day':
+        return 'workbook_per_day_all'
+    return f'workbook_{payout_type}'
+
+
+def workbook_records(company, start_date, end_date, report_type=None):
+    """
+    Return the records of a /report/download workbook, like stream_report_records.
+
+    Records follow workbook_rules(report_type). A closed payroll period is
+    read from the workbook variants frozen with it, so its workbook is the
+    same before and after closing; periods closed before those were kept
+    fall back to the report's own snapshot rows.
+    """
+    payment_types = workbook_payment_types(report_type)
+    period = find_closed_period(company.id, start_date, end_date)
+    if period is not None:
+        keys = {payout_type: _workbook_snapshot_key(payout_type, report_type) for payout_type in payment_types}
+        if set(keys.values()) <= snapshot_keys(period):
+            frozen = load_snapshot(period, tuple(keys.values()))
+            report = {'import_fields': frozen['import_fields'], 'custom_fields': frozen['custom_fields']}
+            for payout_type, key in keys.items():
+                report[payout_type] = frozen[key]
+            return report
+    return stream_report_records(company, start_date, end_date, payment_types=payment_types,
+                                 rules=workbook_rules(report_type))
+
+
+def workbook_sheets(report, report_type=None):
+    """
+    Return the (title, headers, rows) sheets of the /report/download workbook.
+
+    report_type 'per_day' or 'per_part' limits the workbook to that sheet;
+    otherwise both are included, with an age column and every numeric field
+    on the Per Day sheet (see workbook_records). Only numeric report fields
+    are written. Rows are projected lazily as they are written.
+    """
+    numeric_fields = [field for field in report['custom_fields'] if field.field_type == 'numeric']
+    sheets = []
+    for payout_type in workbook_payment_types(report_type):
+        title = WORKBOOK_SHEET_TITLES[payout_type]
+        columns = list(WORKBOOK_COLUMNS[payout_type])
+        if report_type not in ('per_day', 'per_part'):
+            columns.append(('age', 'age'))
+            fields = numeric_fields if payout_type == 'per_day' else fields_for_payout_type(numeric_fields, payout_type)
+        else:
+            fields = fields_for_payout_type(numeric_fields, payout_type)
+        columns += [(field.name, field.name) for field in report['import_fields']]
+        columns += [(field.name, field.name) for field in fields]
+        sheets.append((title, [header for _, header in columns], project_rows(report[payout_type], columns)))
+    return sheets
+
+
+class PayrollSummary:
+    """
+    Per-currency totals gathered while a payroll workbook's sheets are written.
+
+    Gross pay is quantity times rate; custom formula fields are not summed,
+    since their meaning varies by company.
+    """
+
+    def __init__(self, default_currency):
+        self.default_currency = default_currency
+        self._totals = {}
+
+    def track(self, payout_type, records):
+        """Pass records through, adding each one to the totals"""
+        quantity_key = QUANTITY_KEYS[payout_type]
+        rate_key, currency_key = RATE_KEYS[payout_type]
+        for record in records:
+            currency = record.get(currency_key) or self.default_currency
+            totals = self._totals.get((currency, payout_type))
+            if totals is None:
+                totals = self._totals[(currency, payout_type)] = [0, set(), 0, 0.0]
+            quantity = record.get(quantity_key) or 0
+            totals[0] += 1
+            totals[1].add(record['worker_id'])
+            totals[2] += quantity
+            totals[3] += quantity * (record.get(rate_key) or 0)
+            yield record
+
+    def rows(self):
+        """Yield the summary rows: one per currency and payout type, then a total per currency"""
+        for currency in sorted({currency for currency, _ in self._totals}):
+            workers = set()
+            gross = 0.0
+            row_count = 0
+            for payout_type in PAYMENT_TYPES:
+                totals = self._totals.get((currency, payout_type))
+                if totals is None:
+                    continue
+                rows, payout_workers, quantity, payout_gross = totals
+                workers |= payout_workers
+                gross += payout_gross
+                row_count += rows
+                yield {'Currency': currency, 'Payout Type': WORKBOOK_SHEET_TITLES[payout_type], 'Rows': rows,
+                       'Workers': len(payout_workers), 'Quantity': round(quantity, 2),
+                       'Gross Pay': round(payout_gross, 2)}
+            yield {'Currency': currency, 'Payout Type': 'Total', 'Rows': row_count, 'Workers': len(workers),
+                   'Quantity': None, 'Gross Pay': round(gross, 2)}
+
+
+def payroll_workbook_sheets(report, company):
+    """
+    Return the sheets of the combined type=all payroll workbook.
+
+    Per Day, Per Part and Per Hour sheets are followed by a Summary sheet
+    whose totals are gathered as the other sheets' rows are written, so it
+    must be consumed last (as write_xlsx does).
+    """
+    summary = PayrollSummary(company.currency)
+    sheets = []
+    for payout_type in PAYMENT_TYPES:
+        columns = report_columns(WORKBOOK_COLUMNS, payout_type, report['import_fields'], report['custom_fields'])
+        rows = project_rows(summary.track(payout_type, report[payout_type]), columns)
+        sheets.append((WORKBOOK_SHEET_TITLES[payout_type], [header for _, header in columns], rows))
+    # rows() is a generator, so the totals are only read once the sheets above are written
+    sheets.append(('Summary', SUMMARY_HEADERS, summary.rows()))
+    return sheets
+
+
+def _base_record(worker, task, payout_type, quantity, company, company_rate=False):
+    """
+    Build the worker/task/quantity part of a report record.
+
+    The per-day rate is the task's, falling back to the company's daily
+    payout rate, or always the company's when company_rate is set.
+    """
+    record = {
+        'worker_id': worker.id,
+        'task_id': task.id,
+        'first_name': getattr(worker, 'first_name', ''),
+        'last_name': getattr(worker, 'last_name', ''),
+        'task_name': getattr(task, 'name', ''),
+    }
+    if payout_type == 'per_day':
+        record['attendance_days'] = quantity
+        if company_rate:
+            record['daily_rate'] = getattr(company, 'daily_payout_rate', None)
+        else:
+            record['daily_rate'] = getattr(task, 'per_day_payout', None) or getattr(company, 'daily_payout_rate', None)
+        record['per_day_currency'] = getattr(task, 'per_day_currency', None)
+    elif payout_type == 'per_part':
+        record['units_completed'] = quantity
+        record['per_part_rate'] = getattr(task, 'per_part_payout', None)
+        record['per_part_currency'] = getattr(task, 'per_part_currency', None)
+    else:
+        record['hours_worked'] = quantity
+        record['per_hour_rate'] = getattr(task, 'per_hour_payout', None)
+        record['per_hour_currency'] = getattr(task, 'per_hour_currency', None)
+    return record
+
+
+def _apply_custom_fields(record, fields, ordered_fields, cyclic):
+    """Evaluate the numeric report fields for a record in place"""
+    for field in fields:
+        if field.field_type != 'numeric':
+            record[field.name] = ''
+    # Dependencies come first, so each field is computed exactly once
+    for field in ordered_fields:
+        if field.name in cyclic:
+            record[field.name] = 0.00
+            continue
+        try:
+            result = evaluate_formula(field, record)
+            if field.max_limit is not None:
+                result = min(result, field.max_limit)
+            record[field.name] = result
+        except Exception as e:
+            logging.error(f"Error calculating field {field.name}: {str(e)}")
+            record[field.name] = 0.00
+
+
+def _apply_custom_fields_vectorized(records, fields, ordered_fields, cyclic):
+    """Evaluate the numeric report fields for all records column by column"""
+    frame = pd.DataFrame.from_records(records)
+    row_count = len(records)
+    columns = {}
+
+    def column(name):
+        if name not in columns:
+            if name in frame.columns:
+                columns[name] = pd.to_numeric(frame[name], errors='coerce').to_numpy(dtype=float)
+            else:
+                columns[name] = np.zeros(row_count)
+        return columns[name]
+
+    def evaluate(field):
+        try:
+            with np.errstate(all='ignore'):
+                compiled = compiled_field_formula_vectorized(field.id, field.formula)
+                result = np.array(np.broadcast_to(compiled(column), (row_count,)), dtype=float)
+                # A non-numeric input fails the whole formula for that row, as in row mode
+                for name in formula_names(field.formula):
+                    if name in frame.columns:
+                        result[np.isnan(column(name))] = np.nan
+                result = np.round(result, 2)
+            result[~np.isfinite(result)] = 0.0
+            return result
+        except Exception as e:
+            logging.error(f"Error evaluating formula {field.formula}: {str(e)}")
+            return np.zeros(row_count)
+
+    for field in fields:
+        if field.field_type != 'numeric':
+            for record in records:
+                record[field.name] = ''
+    for field in ordered_fields:
+        if field.name in cyclic:
+            values = np.zeros(row_count)
+        else:
+            values = evaluate(field)
+            if field.max_limit is not None:
+                values = values.clip(max=field.max_limit)
+        columns[field.name] = values
+        for record, value in zip(records, values.tolist()):
+            record[field.name] = value
+
+
+def _build_records(company, payout_type, buckets, custom_fields, import_values, today, vectorized=None,
+                   rules=REPORT_RULES):
+    """
+    Turn (worker, task, quantity) buckets into records with custom fields applied.
+
+    rules (see REPORT_RULES) chooses the per-day rate and which report
+    fields are computed.
+    """
+    if payout_type in rules['all_fields']:
+        fields = custom_fields
+    else:
+        fields = fields_for_payout_type(custom_fields, payout_type)
+    ordered_fields, cyclic = order_fields(fields)
+    records = []
+    for worker, task, quantity in buckets:
+        record = _base_record(worker, task, payout_type, quantity, company, rules['company_rate'])
+        record['age'] = calculate_age(worker.date_of_birth, today)
+        record.update(import_values.as_dict(worker.id, default='N/A'))
+        records.append(record)
+
+    use_columns = np is not None and records and (
+        vectorized if vectorized is not None else len(records) >= VECTORIZE_MIN_ROWS
+    )
+    if use_columns:
+        _apply_custom_fields_vectorized(records, fields, ordered_fields, cyclic)
+    else:
+        for record in records:
+            _apply_custom_fields(record, fields, ordered_fields, cyclic)
+    return records
+
+
+def build_report_records(company, start_date, end_date, payment_types=PAYMENT_TYPES, vectorized=None, use_cache=True,
+                         rules=REPORT_RULES):
+    """
+    Build per_day, per_part and per_hour report records in one pass.
+
+    Returns a dict with the company's import_fields and custom_fields plus
+    one list of records per payment type. Custom fields are evaluated column
+    by column when vectorized is True, or automatically for reports of
+    VECTORIZE_MIN_ROWS rows or more when it is None. Payment types already
+    in report_cache for the company's current data version are not rebuilt,
+    and a closed payroll period is read from its snapshot. rules (see
+    REPORT_RULES) chooses which buckets become rows and how they are built.
+    """
+    period = find_closed_period(company.id, start_date, end_date)
+    if period is not None:
+        return load_snapshot(period, payment_types)
+
+    import_fields = ImportField.query.filter_by(company_id=company.id).all()
+    custom_fields = ReportField.query.filter_by(company_id=company.id).all()
+
+    today = date.today()
+    report = {
+        'import_fields': import_fields,
+        'custom_fields': custom_fields
+    }
+
+    # Ages depend on today's date, so it is part of the key as well
+    version = report_data_version(company.id)
+    cache_keys = {
+        payout_type: (company.id, payout_type, start_date, end_date, version, today, rules['company_rate'],
+                      payout_type in rules['all_fields'], rules['keep_empty'], rules['started_only'])
+        for payout_type in payment_types
+    }
+    if use_cache:
+        for payout_type in payment_types:
+            cached = report_cache.get(cache_keys[payout_type])
+            if cached is not None:
+                report[payout_type] = cached
+
+    missing_types = tuple(payout_type for payout_type in payment_types if payout_type not in report)
+    if not missing_types:
+        logging.info(f"Report pipeline for company {company.id} ({start_date} to {end_date}) served from cache")
+        return report
+
+    buckets = scan_attendance(company.id, start_date, end_date, missing_types, keep_empty=rules['keep_empty'],
+                              started_only=rules['started_only'])
+    import_values = load_custom_field_matrix(company.id, import_fields)
+
+    for payout_type in missing_types:
+        records = _build_records(company, payout_type, buckets[payout_type], custom_fields,
+                                 import_values, today, vectorized, rules)
+        report[payout_type] = records
+        if use_cache:
+            report_cache.put(cache_keys[payout_type], records)
+
+    logging.info(
+        f"Report pipeline for company {company.id} ({start_date} to {end_date}): " +
+        ", ".join(f"{payout_type}={len(report[payout_type])}" for payout_type in payment_types)
+    )
+    return report
+
+
+def build_report_delta(company, start_date, end_date, payout_type, since):
+    """
+    Build the rows of a report whose attendance changed after since.
+
+    Returns (report, deleted) where report is shaped like
+    build_report_records but report[payout_type] only holds the current
+    rows of (worker, task) pairs with attendance inserted, edited or deleted
+    after since, and deleted lists the changed (worker_id, task_id) pairs
+    that no longer have a row. Changes to tasks, workers or fields that do
+    not touch attendance are not tracked; a full export picks those up.
+    """
+    pairs = changed_attendance_pairs(company.id, start_date, end_date, since)
+    period = find_closed_period(company.id, start_date, end_date)
+    if period is not None:
+        report = load_snapshot(period, (payout_type,))
+    else:
+        # Only the changed workers and tasks are aggregated and built
+        report = {
+            'import_fields': ImportField.query.filter_by(company_id=company.id).all(),
+            'custom_fields': ReportField.query.filter_by(company_id=company.id).all(),
+            payout_type: []
+        }
+        if pairs:
+            worker_ids = {worker_id for worker_id, _ in pairs}
+            buckets = scan_attendance(company.id, start_date, end_date, (payout_type,), worker_ids=worker_ids,
+                                      task_ids={task_id for _, task_id in pairs})
+            import_values = load_custom_field_matrix(company.id, report['import_fields'], worker_ids=worker_ids)
+            report[payout_type] = _build_records(company, payout_type, buckets[payout_type], report['custom_fields'],
+                                                 import_values, date.today())
+    report[payout_type] = [
+        record for record in report[payout_type] if (record['worker_id'], record['task_id']) in pairs
+    ]
+
+    # Pairs of other payout types are not this report's removals
+    missing = pairs - {(record['worker_id'], record['task_id']) for record in report[payout_type]}
+    task_types = dict(
+        db.session.query(Task.id, Task.payment_type).filter(Task.id.in_({task_id for _, task_id in missing}))
+    ) if missing else {}
+    deleted = sorted(pair for pair in missing if task_types.get(pair[1], payout_type) == payout_type)
+
+    logging.info(
+        f"Delta {payout_type} report for company {company.id} since {since.isoformat()}: "
+        f"{len(report[payout_type])} changed rows, {len(deleted)} removed"
+    )
+    return report, deleted
+
+
+def report_fields(company, start_date, end_date):
+    """Return the (import_fields, custom_fields) a period's report is built with"""
+    period = find_closed_period(company.id, start_date, end_date)
+    if period is not None:
+        return snapshot_fields(period)
+    return (ImportField.query.filter_by(company_id=company.id).all(),
+            ReportField.query.filter_by(company_id=company.id).all())
+
+
+def _iter_records_by_worker_chunk(company, start_date, end_date, payout_type, import_fields, custom_fields,
+                                  chunk_size, rules=REPORT_RULES):
+    """Yield a payout type's records, scanning one chunk of workers at a time"""
+    today = date.today()
+    record_count = 0
+    for worker_ids in iter_worker_id_chunks(company.id, chunk_size):
+        buckets = scan_attendance(company.id, start_date, end_date, (payout_type,),
+                                  worker_range=(worker_ids[0], worker_ids[-1]), keep_empty=rules['keep_empty'],
+                                  started_only=rules['started_only'])
+        import_values = load_custom_field_matrix(company.id, import_fields, worker_ids=worker_ids)
+        records = _build_records(company, payout_type, buckets[payout_type], custom_fields, import_values, today,
+                                 rules=rules)
+        record_count += len(records)
+        yield from records
+    logging.info(f"Streamed {record_count} {payout_type} records for company {company.id} ({start_date} to {end_date})")
+
+
+def stream_report_records(company, start_date, end_date, payment_types=PAYMENT_TYPES, chunk_size=REPORT_WORKER_CHUNK,
+                          rules=REPORT_RULES):
+    """
+    Like build_report_records, but for large companies each payment type is
+    an iterator that builds records chunk_size workers at a time.
+
+    Companies with at most chunk_size workers, and closed payroll periods,
+    get the lists from build_report_records. Otherwise only one chunk of
+    records is held in memory at once, so rows should be consumed as they
+    are written; streamed records are not cached.
+    """
+    worker_count = db.session.query(Worker.id).filter(Worker.company_id == company.id).count()
+    if worker_count <= chunk_size or find_closed_period(company.id, start_date, end_date) is not None:
+        return build_report_records(company, start_date, end_date, payment_types=payment_types, rules=rules)
+
+    report = {
+        'import_fields': ImportField.query.filter_by(company_id=company.id).all(),
+        'custom_fields': ReportField.query.filter_by(company_id=company.id).all()
+    }
+    for payout_type in payment_types:
+        report[payout_type] = _iter_records_by_worker_chunk(
+            company, start_date, end_date, payout_type, report['import_fields'], report['custom_fields'], chunk_size,
+            rules
+        )
+    return report
+
+
+def peek_records(records):
+    """Return (first record or None, iterator over all of records)"""
+    records = iter(records)
+    first = next(records, None)
+    if first is None:
+        return None, iter(())
+    return first, itertools.chain([first], records)
+
+
+def report_currencies(company_id, payout_type, start_date=None, end_date=None):
+    """
+    Return the currency codes a payout type's report can contain, sorted.
+
+    For a closed payroll period the codes come from its snapshot rows, which
+    can differ from the tasks as they are now.
+    """
+    if start_date is not None and end_date is not None:
+        period = find_closed_period(company_id, start_date, end_date)
+        if period is not None:
+            return sorted(str(code) for code in snapshot_values(period, payout_type, RATE_KEYS[payout_type][1]))
+    currency = getattr(Task, f'{payout_type}_currency')
+    return sorted(code for code, in db.session.query(currency).filter(
+        Task.company_id == company_id, Task.payment_type == payout_type, currency.isnot(None)
+    ).distinct() if code != '')
+
+
+def _snapshot_payout_totals(period, company, payment_types):
+    """Total a closed period's frozen records, shaped like sum_payouts"""
+    report = load_snapshot(period, payment_types)
+    tasks = {}
+    currencies = {}
+    for payout_type in payment_types:
+        quantity_key = QUANTITY_KEYS[payout_type]
+        rate_key, currency_key = RATE_KEYS[payout_type]
+        for record in report[payout_type]:
+            currency = record.get(currency_key) or company.currency
+            quantity = record.get(quantity_key) or 0
+            rate = record.get(rate_key)
+            task = tasks.get((currency, record['task_id']))
+            if task is None:
+                task = tasks[(currency, record['task_id'])] = {
+                    'currency': currency, 'task_id': record['task_id'], 'task_name': record.get('task_name'),
+                    'payout_type': payout_type, 'rate': rate, 'quantity': 0, 'workers': set(), 'gross_pay': None
+                }
+            totals = currencies.setdefault(currency, {'currency': currency, 'workers': set(), 'gross_pay': None})
+            task['quantity'] += quantity
+            task['workers'].add(record['worker_id'])
+            totals['workers'].add(record['worker_id'])
+            if rate is not None:
+                task['gross_pay'] = (task['gross_pay'] or 0) + quantity * rate
+                totals['gross_pay'] = (totals['gross_pay'] or 0) + quantity * rate
+
+    for totals in itertools.chain(tasks.values(), currencies.values()):
+        totals['workers'] = len(totals['workers'])
+    return ([tasks[key] for key in sorted(tasks)], [currencies[key] for key in sorted(currencies)])
+
+
+def snapshot_period_totals(period, company, group_by='task'):
+    """Total a closed period's frozen records per task or worker and currency, shaped like sum_period_totals"""
+    report = load_snapshot(period, PAYMENT_TYPES)
+    metric_index = {'per_day': 0, 'per_part': 1, 'per_hour': 2}
+    totals = {}
+    for payout_type in PAYMENT_TYPES:
+        quantity_key = QUANTITY_KEYS[payout_type]
+        rate_key, currency_key = RATE_KEYS[payout_type]
+        for record in report[payout_type]:
+            currency = record.get(currency_key) or company.currency
+            if group_by == 'worker':
+                key = (record['worker_id'], currency)
+                name = f"{record.get('first_name')} {record.get('last_name')}"
+            else:
+                key = (record['task_id'], currency)
+                name = record.get('task_name')
+            entry = totals.get(key)
+            if entry is None:
+                entry = totals[key] = [name, 0, 0, 0, None]
+            quantity = record.get(quantity_key) or 0
+            entry[1 + metric_index[payout_type]] += quantity
+            rate = record.get(rate_key)
+            if rate is not None:
+                entry[4] = (entry[4] or 0) + quantity * rate
+    return [(row_id, entry[0], currency, *entry[1:]) for (row_id, currency), entry in totals.items()]
+
+
+def payout_totals(company, start_date, end_date, payment_types=PAYMENT_TYPES):
+    """
+    Return per-task and per-currency payout totals for a period.
+
+    Totals are summed in the database from the attendance rollup, without
+    building report records. Closed payroll periods are totalled from their
+    snapshot instead, so they match the frozen reports. Gross pay is
+    quantity times rate; custom formula fields are not included.
+    """
+    period = find_closed_period(company.id, start_date, end_date)
+    if period is not None:
+        tasks, currencies = _snapshot_payout_totals(period, company, payment_types)
+    else:
+        tasks, currencies = sum_payouts(company.id, start_date, end_date, payment_types,
+                                        default_rate=company.daily_payout_rate, default_currency=company.currency)
+
+    for totals in itertools.chain(tasks, currencies):
+        if totals['gross_pay'] is not None:
+            totals['gross_pay'] = round(totals['gross_pay'], 2)
+    for task in tasks:
+        task['quantity'] = round(task['quantity'], 2)
+    return {
+        'tasks': tasks,
+        'currencies': currencies,
+        'source': 'snapshot' if period is not None else 'live'
+    }
+
+
+# Largest number of rows a report preview returns
+PREVIEW_MAX_ROWS = 50
+
+
+def build_report_preview(company, start_date, end_date, limit=5):
+    """
+    Return the most recent attendance rows of a period for the report preview.
+
+    Each row carries its worker's Present days in the period, counted for
+    only the previewed workers, so the cost depends on limit rather than on
+    the size of the period.
+    """
+    rows = latest_attendance(company.id, start_date, end_date, min(limit, PREVIEW_MAX_ROWS))
+    attendance_days = count_present_days(company.id, start_date, end_date, [row.worker_id for row in rows])
+    return [
+        {
+            'worker_id': row.worker_id,
+            'worker_name': f"{row.first_name} {row.last_name}",
+            'task_id': row.task_id,
+            'task_name': row.task_name,
+            'date': row.date.strftime('%Y-%m-%d'),
+            'status': row.status,
+            'daily_rate': row.per_day_payout or company.daily_payout_rate,
+            'attendance_days': attendance_days.get(row.worker_id, 0)
+        }
+        for row in rows
+    ]
+
+
+def build_worker_history(company, worker_id, start_date=None, end_date=None, descending=False, after=None,
+                         limit=50):
+    """
+    Return one page of a worker's per-day earnings, with running totals.
+
+    Entries are ordered by date then task; after is the (date, task id) of
+    the last entry already seen. running_total counts earnings from
+    start_date. Returns {'entries': [...], 'next': position}, where next
+    holds the ISO date and task id of this page's last entry, or is None on
+    the last page.
+
+    The totals before the page are summed per currency by one grouped query
+    up to after, so they never come from the client. Ascending entries add
+    the page's own earnings to them; descending pages start from the total
+    before after and each entry subtracts the earnings following it.
+    """
+    defaults = {'default_rate': company.daily_payout_rate, 'default_currency': company.currency}
+    if after is not None:
+        totals = worker_earnings_totals(company.id, worker_id, start_date, end_date, **defaults, up_to=after,
+                                        inclusive=not descending)
+    elif descending:
+        totals = worker_earnings_totals(company.id, worker_id, start_date, end_date, **defaults)
+    else:
+        totals = {}
+    rows, day_totals = worker_history_page(company.id, worker_id, start_date, end_date, descending=descending,
+                                           after=after, limit=limit + 1, **defaults)
+
+    entries = []
+    for row in rows[:limit]:
+        base = totals.get(row.currency, 0)
+        if descending:
+            running_total = base - (row.page_running - row.earnings)
+        else:
+            running_total = base + row.page_running
+        entries.append({
+            'date': row.date.isoformat(),
+            'task_id': row.task_id,
+            'task_name': row.task_name,
+            'payout_type': row.payment_type,
+            'present': bool(row.present),
+            'quantity': row.quantity,
+            'rate': row.rate,
+            'currency': row.currency,
+            'earnings': round(row.earnings, 2),
+            'day_total': round(day_totals.get((row.date, row.currency), 0), 2),
+            'running_total': round(running_total, 2)
+        })
+
+    next_position = None
+    if len(rows) > limit:
+        next_position = {'after': [entries[-1]['date'], entries[-1]['task_id']]}
+    return {'entries': entries, 'next': next_position}
+
+
+def available_columns(payout_type, import_fields, custom_fields):
+    """Return the record keys a payout type's rows can be projected to"""
+    columns = ['worker_id', 'task_id'] + [key for key, _ in EXPORT_COLUMNS[payout_type]] + ['age']
+    columns += [field.name for field in import_fields]
+    columns += [field.name for field in fields_for_payout_type(custom_fields, payout_type)]
+    return list(dict.fromkeys(columns))
+
+
+def _record_sort_key(record, sort):
+    """Comparable, JSON-friendly keyset position of a record for an in-memory sort"""
+    value = record.get(sort)
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        rank = (0, value)
+    else:
+        rank = (1, '' if value is None else str(value))
+    return (rank, record['worker_id'], record['task_id'])
+
+
+def build_report_page(company, start_date, end_date, payout_type, columns, sort='worker_id',
+                      descending=False, after=None, limit=50, include_total=False):
+    """
+    Build one keyset page of report rows with only the requested columns.
+
+    Sorting by worker_id, first_name, last_name, task_name or the quantity
+    column is pushed into SQL, so only the page's rows are built. Any other
+    sort key, or a closed payroll period, needs every record; the full
+    report is built (and kept in report_cache for the following pages) and
+    sorted in memory.
+
+    Returns a dict with rows, next (the keyset position to pass as after,
+    or None on the last page) and, when include_total is set, total.
+    """
+    sql_sorts = {'worker_id': 'worker_id', 'first_name': 'first_name', 'last_name': 'last_name',
+                 'task_name': 'task_name', QUANTITY_KEYS[payout_type]: 'quantity'}
+    page = {}
+
+    # A closed period's rows only exist in its snapshot
+    if sort in sql_sorts and find_closed_period(company.id, start_date, end_date) is None:
+        import_fields = ImportField.query.filter_by(company_id=company.id).all()
+        custom_fields = ReportField.query.filter_by(company_id=company.id).all()
+        scanned = scan_attendance_page(company.id, start_date, end_date, payout_type, sql_sorts[sort],
+                                       descending, after, limit + 1)
+        has_more = len(scanned) > limit
+        scanned = scanned[:limit]
+        import_values = load_custom_field_matrix(company.id, import_fields,
+                                                 worker_ids={worker.id for worker, _, _, _ in scanned})
+        records = _build_records(company, payout_type, [row[:3] for row in scanned], custom_fields,
+                                 import_values, date.today())
+        page['next'] = list(scanned[-1][3]) if has_more else None
+        if include_total:
+            page['total'] = count_attendance_buckets(company.id, start_date, end_date, payout_type)
+    else:
+        report = build_report_records(company, start_date, end_date, payment_types=(payout_type,))
+        keyed = sorted(((_record_sort_key(record, sort), record) for record in report[payout_type]),
+                       key=lambda item: item[0], reverse=descending)
+        if after is not None:
+            after = tuple(tuple(part) if isinstance(part, list) else part for part in after)
+            keyed = [item for item in keyed if (item[0] < after if descending else item[0] > after)]
+        has_more = len(keyed) > limit
+        keyed = keyed[:limit]
+        records = [record for _, record in keyed]
+        page['next'] = list(keyed[-1][0]) if has_more else None
+        if include_total:
+            page['total'] = len(report[payout_type])
+
+    page['rows'] = [{key: record.get(key) for key in columns} for record in records]
+    return page
@@ -0,0 +1,135 @@
+"""
+Report Preflight
+================
+
+Cheap checks run before a report download: whether there is anything to
+report, how many rows the file will have, roughly how large it will be,
+how long it will take, and whether it should be generated inline or queued
+as a background job (see report_jobs).
+
+Everything is answered from the daily attendance rollup with an indexed
+EXISTS and a grouped COUNT, or for a closed payroll period from a COUNT of
+its snapshot rows. Only a small sample of rows is actually built (or read),
+and it is used to measure the average row size.
+"""
+
+from models import ImportField, ReportField
+from payroll_periods import count_snapshot_rows, find_closed_period, snapshot_fields, snapshot_sample
+from report_engine import count_attendance_buckets, has_attendance_buckets
+from report_export import iter_csv_chunks
+import logging
+import os
+
+# Reports expected to take longer than this are queued instead of built inline
+REPORT_INLINE_MAX_SECONDS = float(os.environ.get('REPORT_INLINE_MAX_SECONDS', 30))
+
+# Conservative rows generated per second for each format
+REPORT_ROWS_PER_SECOND = {
+    'csv': 5000,
+    'xlsx': 2000,
+    'parquet': 5000,
+    'arrow': 5000
+}
+
+# An XLSX file is a fixed package overhead plus slightly less than the CSV
+XLSX_BASE_BYTES = 6000
+XLSX_SIZE_FACTOR = 0.85
+
+# Parquet and Arrow files: schema overhead plus compressed, typed columns
+COLUMNAR_BASE_BYTES = 4000
+COLUMNAR_SIZE_FACTOR = 0.4
+
+# Rows built to measure the average row size
+SIZE_SAMPLE_ROWS = 20
+
+
+def _estimate_bytes(columns, sample, row_count):
+    """Estimate the CSV size from a small sample of built rows"""
+    keys = [key for key, _ in columns]
+    header_bytes = len(b''.join(iter_csv_chunks([], [header for _, header in columns])))
+    if not sample:
+        return header_bytes
+    sample_bytes = len(b''.join(iter_csv_chunks(sample, keys))) - len(b''.join(iter_csv_chunks([], keys)))
+    return header_bytes + sample_bytes * row_count // len(sample)
+
+
+def count_report_rows(company, start_date, end_date, payment_type):
+    """Count the rows a report download will have, from the snapshot for a closed period"""
+    period = find_closed_period(company.id, start_date, end_date)
+    if period is not None:
+        return count_snapshot_rows(period, payment_type)
+    return count_attendance_buckets(company.id, start_date, end_date, payment_type)
+
+
+def _count_and_sample(company, start_date, end_date, payment_type):
+    """
+    Return (row_count, columns, sample rows, source) for a report.
+
+    A closed payroll period is downloaded from its snapshot, so its rows
+    and field layout are read from there rather than from live attendance.
+    """
+    from report_pipeline import build_report_page, report_columns, EXPORT_COLUMNS
+
+    period = find_closed_period(company.id, start_date, end_date)
+    if period is not None:
+        import_fields, custom_fields = snapshot_fields(period)
+        columns = report_columns(EXPORT_COLUMNS, payment_type, import_fields, custom_fields)
+        row_count = count_snapshot_rows(period, payment_type)
+        sample = snapshot_sample(period, payment_type, SIZE_SAMPLE_ROWS) if row_count else []
+        return row_count, columns, sample, 'snapshot'
+
+    if not has_attendance_buckets(company.id, start_date, end_date, payment_type):
+        return 0, [], [], 'live'
+    import_fields = ImportField.query.filter_by(company_id=company.id).all()
+    custom_fields = ReportField.query.filter_by(company_id=company.id).all()
+    columns = report_columns(EXPORT_COLUMNS, payment_type, import_fields, custom_fields)
+    row_count = count_attendance_buckets(company.id, start_date, end_date, payment_type)
+    sample = build_report_page(company, start_date, end_date, payment_type, [key for key, _ in columns],
+                               limit=SIZE_SAMPLE_ROWS)['rows']
+    return row_count, columns, sample, 'live'
+
+
+def preflight_report(company, start_date, end_date, payment_type, format_type='csv'):
+    """
+    Describe the report a download would produce without building it.
+
+    Returns has_data, row_count, estimated_bytes, estimated_seconds, mode,
+    which is 'inline' when the download can run inside the request and
+    'queued' when it should go through the report job API, and source,
+    'snapshot' for a closed payroll period and 'live' otherwise.
+    """
+    format_type = 'xlsx' if format_type == 'excel' else format_type
+    result = {
+        'report_type': payment_type,
+        'format': format_type,
+        'has_data': False,
+        'row_count': 0,
+        'estimated_bytes': 0,
+        'estimated_seconds': 0.0,
+        'mode': 'inline'
+    }
+
+    row_count, columns, sample, source = _count_and_sample(company, start_date, end_date, payment_type)
+    result['source'] = source
+    if not row_count:
+        return result
+
+    estimated_bytes = _estimate_bytes(columns, sample, row_count)
+    if format_type == 'xlsx':
+        estimated_bytes = XLSX_BASE_BYTES + int(estimated_bytes * XLSX_SIZE_FACTOR)
+    elif format_type in ('parquet', 'arrow'):
+        estimated_bytes = COLUMNAR_BASE_BYTES + int(estimated_bytes * COLUMNAR_SIZE_FACTOR)
+    estimated_seconds = round(row_count / REPORT_ROWS_PER_SECOND[format_type], 1)
+
+    result.update(
+        has_data=row_count > 0,
+        row_count=row_count,
+        estimated_bytes=estimated_bytes,
+        estimated_seconds=estimated_seconds,
+        mode='queued' if estimated_seconds > REPORT_INLINE_MAX_SECONDS else 'inline'
+    )
+    logging.info(
+        f"Report preflight for company {company.id} {payment_type} {start_date} to {end_date}: "
+        f"{row_count} rows, ~{estimated_bytes} bytes, ~{estimated_seconds}s, {result['mode']}"
+    )
+    return result
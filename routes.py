@@ -1,23 +1,37 @@
 from models import WorkerImportLog, ImportField, WorkerCustomFieldValue, ReportField, ActivityLog
-from models import Attendance, Task, Worker, Company, User, Workspace, UserWorkspace, MasterAdmin
+from models import Attendance, Task, Worker, Company, User, Workspace, UserWorkspace, MasterAdmin, AttendanceDailyRollup
+from models import PayrollPeriod
 from flask import render_template, session, redirect, url_for, make_response, abort, request, jsonify, send_file, send_from_directory
+from flask import Response, stream_with_context
 from app_init import app, db
 from datetime import timedelta
 from sqlalchemy import and_
+import base64
 import json
 from abilities import upload_file_to_storage, download_file_from_storage
 import pandas as pd
 import logging
 import traceback
 import os
-from datetime import datetime
+from datetime import datetime, timezone
 from sqlalchemy import and_
 import io
+import itertools
 import re
 from app_init import master_admin_required
 from sqlalchemy import func, desc
 from subscription_middleware import subscription_required, check_subscription_status, admin_required, feature_required, worker_limit_check
 from tier_config import get_tier_spec, get_price_by_product_and_amount, STRIPE_PRICE_MAPPING
+from report_engine import PAYMENT_TYPES, count_attendance_buckets, has_attendance_buckets
+from attendance_rollup import refresh_attendance_rollup
+from attendance_changes import next_watermark, oldest_usable_watermark
+from custom_field_matrix import load_custom_field_matrix
+from formula_engine import FormulaError, check_field_cycles, validate_formula
+from report_export import iter_csv_chunks, render_xlsx, write_columnar_report, COLUMNAR_MIMETYPES, XLSX_MIMETYPE
+from report_preflight import preflight_report
+from report_pipeline import build_report_delta, report_columns, project_record, typed_columns, workbook_sheets, EXPORT_COLUMNS
+from report_pipeline import peek_records, report_currencies, stream_report_records
+from report_pipeline import workbook_payment_types, workbook_records
 import stripe
 import hmac
 import hashlib
@@ -1813,6 +1827,7 @@ def handle_workers():
             
             # Get custom fields for this company
             custom_fields = ImportField.query.filter_by(company_id=company.id).all()
+            custom_values = load_custom_field_matrix(company.id, custom_fields)
             
             workers_data = []
             for worker in workers:
@@ -1822,17 +1837,9 @@ def handle_workers():
                     'last_name': worker.last_name,
                     'date_of_birth': worker.date_of_birth.isoformat() if worker.date_of_birth else None,
                     'created_at': worker.created_at.isoformat() if worker.created_at else None,
-                    'custom_fields': {}
+                    'custom_fields': custom_values.as_dict(worker.id)
                 }
                 
-                # Add custom field values
-                for field in custom_fields:
-                    custom_value = WorkerCustomFieldValue.query.filter_by(
-                        worker_id=worker.id,
-                        custom_field_id=field.id
-                    ).first()
-                    worker_data['custom_fields'][field.name] = custom_value.value if custom_value else None
-                
                 workers_data.append(worker_data)
             
             return jsonify({'workers': workers_data, 'custom_fields': [{'id': f.id, 'name': f.name, 'type': f.field_type} for f in custom_fields]})
@@ -1880,31 +1887,15 @@ def verify_report_data():
             logging.error(f"Invalid date format: {str(e)}")
             return jsonify({'has_data': False, 'message': 'Invalid date format'}), 400
         
-        # Check for data based on report type
-        if report_type == 'per_day':
-            # Look for attendance records marked as Present for per_day tasks
-            count = Attendance.query.filter(
-                Attendance.company_id == company.id,
-                Attendance.date.between(start_date_obj, end_date_obj),
-                Attendance.status == 'Present',
-                Attendance.task_id.isnot(None)
-            ).count()
-            logging.debug(f"Per day report verification: found {count} Present records")
-        elif report_type == 'per_part':
-            # Look for any attendance records with units completed for per_part tasks
-            count = Attendance.query.filter(
-                Attendance.company_id == company.id,
-                Attendance.date.between(start_date_obj, end_date_obj),
-                Attendance.units_completed.isnot(None)
-            ).count()
-            logging.debug(f"Per part report verification: found {count} records with units")
-        else:
+        if report_type not in PAYMENT_TYPES:
             logging.warning(f"Invalid report type: {report_type}")
             return jsonify({'has_data': False, 'message': 'Invalid report type'}), 400
         
-        has_data = count > 0
+        # Indexed EXISTS on the attendance rollup before counting report rows
+        has_data = has_attendance_buckets(company.id, start_date_obj, end_date_obj, report_type)
+        count = count_attendance_buckets(company.id, start_date_obj, end_date_obj, report_type) if has_data else 0
         
-        logging.info(f"Report verification for {report_type}: {count} records found for company {company.id}")
+        logging.info(f"Report verification for {report_type}: {count} rows found for company {company.id}")
         
         return jsonify({
             'has_data': has_data,
@@ -1915,23 +1906,185 @@ def verify_report_data():
     except Exception as e:
         logging.error(f"Error verifying report data: {str(e)}")
         logging.error(traceback.format_exc())
-        # Return success=true even on error to allow download attempt - backend will catch real errors
         return jsonify({
-            'has_data': True,
-            'message': 'Unable to verify, but attempting download',
+            'has_data': False,
+            'message': 'Unable to verify report data',
             'error': str(e)
-        }), 200
+        }), 500
+
+@app.route("/api/reports/preflight", methods=['GET'])
+@subscription_required
+@feature_required('advanced_reporting')
+def report_preflight():
+    """Estimate a report's rows, size and generation time before downloading it"""
+    try:
+        report_type = request.args.get('type', 'per_day')
+        start_date = request.args.get('start_date')
+        end_date = request.args.get('end_date')
+        format_type = request.args.get('format', 'csv').lower()
+        
+        if report_type not in PAYMENT_TYPES:
+            return jsonify({'error': 'Invalid report type'}), 400
+        if format_type not in ['csv', 'excel', 'xlsx', 'parquet', 'arrow']:
+            return jsonify({'error': 'Invalid format. Supported formats: csv, excel, xlsx, parquet, arrow'}), 400
+        if not start_date or not end_date:
+            return jsonify({'error': 'Start date and end date are required'}), 400
+        try:
+            start_date_obj = datetime.strptime(start_date, '%Y-%m-%d').date()
+            end_date_obj = datetime.strptime(end_date, '%Y-%m-%d').date()
+        except ValueError:
+            return jsonify({'error': 'Invalid date format. Use YYYY-MM-DD'}), 400
+        
+        company = get_current_company()
+        if not company:
+            return jsonify({'error': 'Company not found'}), 404
+        
+        preflight = preflight_report(company, start_date_obj, end_date_obj, report_type, format_type)
+        if preflight['mode'] == 'queued':
+            preflight['job_url'] = url_for('create_report_job')
+        else:
+            preflight['download_url'] = url_for('download_reports', type=report_type, start_date=start_date,
+                                                end_date=end_date, format=format_type)
+        return jsonify(preflight), 200
+        
+    except Exception as e:
+        logging.error(f"Error running report preflight: {str(e)}")
+        logging.error(traceback.format_exc())
+        return jsonify({'error': 'Failed to check report'}), 500
+
+@app.route("/api/reports/summary", methods=['GET'])
+@subscription_required
+@feature_required('advanced_reporting')
+def report_summary():
+    """Payout totals per task and per currency, summed in the database"""
+    try:
+        from report_pipeline import payout_totals
+        
+        report_type = request.args.get('type', 'all')
+        start_date = request.args.get('start_date')
+        end_date = request.args.get('end_date')
+        
+        if report_type != 'all' and report_type not in PAYMENT_TYPES:
+            return jsonify({'error': 'Invalid report type'}), 400
+        if not start_date or not end_date:
+            return jsonify({'error': 'Start date and end date are required'}), 400
+        try:
+            start_date_obj = datetime.strptime(start_date, '%Y-%m-%d').date()
+            end_date_obj = datetime.strptime(end_date, '%Y-%m-%d').date()
+        except ValueError:
+            return jsonify({'error': 'Invalid date format. Use YYYY-MM-DD'}), 400
+        
+        company = get_current_company()
+        if not company:
+            return jsonify({'error': 'Company not found'}), 404
+        
+        payment_types = PAYMENT_TYPES if report_type == 'all' else (report_type,)
+        summary = payout_totals(company, start_date_obj, end_date_obj, payment_types)
+        summary.update(report_type=report_type, start_date=start_date, end_date=end_date)
+        return jsonify(summary), 200
+        
+    except Exception as e:
+        logging.error(f"Error building report summary: {str(e)}")
+        logging.error(traceback.format_exc())
+        return jsonify({'error': 'Failed to build report summary'}), 500
+
+@app.route("/api/reports/preview", methods=['GET'])
+@subscription_required
+@feature_required('advanced_reporting')
+def report_preview():
+    """The most recent attendance rows of a period, with each worker's Present days"""
+    try:
+        from report_pipeline import build_report_preview, PREVIEW_MAX_ROWS
+        
+        start_date = request.args.get('start_date')
+        end_date = request.args.get('end_date')
+        if not start_date or not end_date:
+            return jsonify({'error': 'Start date and end date are required'}), 400
+        try:
+            start_date_obj = datetime.strptime(start_date, '%Y-%m-%d').date()
+            end_date_obj = datetime.strptime(end_date, '%Y-%m-%d').date()
+        except ValueError:
+            return jsonify({'error': 'Invalid date format. Use YYYY-MM-DD'}), 400
+        try:
+            limit = int(request.args.get('limit', 5))
+        except ValueError:
+            return jsonify({'error': 'limit must be a number'}), 400
+        if limit < 1 or limit > PREVIEW_MAX_ROWS:
+            return jsonify({'error': f'limit must be between 1 and {PREVIEW_MAX_ROWS}'}), 400
+        
+        company = get_current_company()
+        if not company:
+            return jsonify({'error': 'Company not found'}), 404
+        
+        records = build_report_preview(company, start_date_obj, end_date_obj, limit)
+        return jsonify({'records': records, 'start_date': start_date, 'end_date': end_date}), 200
+        
+    except Exception as e:
+        logging.error(f"Error building report preview: {str(e)}")
+        logging.error(traceback.format_exc())
+        return jsonify({'error': 'Failed to build report preview'}), 500
+
+@app.route("/api/reports/compare", methods=['GET'])
+@subscription_required
+@feature_required('advanced_reporting')
+def report_compare():
+    """Compare a period's days, units, hours and payouts with the previous period"""
+    try:
+        from report_analytics import compare_periods, ANALYTICS_GROUPS
+        
+        start_date = request.args.get('start_date')
+        end_date = request.args.get('end_date')
+        previous_start = request.args.get('previous_start_date')
+        previous_end = request.args.get('previous_end_date')
+        group_by = request.args.get('by', 'task')
+        
+        if group_by not in ANALYTICS_GROUPS:
+            return jsonify({'error': 'Invalid grouping. Supported: task, worker'}), 400
+        if not start_date or not end_date:
+            return jsonify({'error': 'Start date and end date are required'}), 400
+        if bool(previous_start) != bool(previous_end):
+            return jsonify({'error': 'Previous start and end dates must be given together'}), 400
+        try:
+            start_date_obj = datetime.strptime(start_date, '%Y-%m-%d').date()
+            end_date_obj = datetime.strptime(end_date, '%Y-%m-%d').date()
+            previous_start_obj = datetime.strptime(previous_start, '%Y-%m-%d').date() if previous_start else None
+            previous_end_obj = datetime.strptime(previous_end, '%Y-%m-%d').date() if previous_end else None
+        except ValueError:
+            return jsonify({'error': 'Invalid date format. Use YYYY-MM-DD'}), 400
+        if end_date_obj < start_date_obj or (previous_start_obj and previous_end_obj < previous_start_obj):
+            return jsonify({'error': 'End date must not be before start date'}), 400
+        
+        company = get_current_company()
+        if not company:
+            return jsonify({'error': 'Company not found'}), 404
+        
+        comparison = compare_periods(company, start_date_obj, end_date_obj, previous_start_obj, previous_end_obj,
+                                     group_by=group_by)
+        return jsonify(comparison), 200
+        
+    except Exception as e:
+        logging.error(f"Error comparing report periods: {str(e)}")
+        logging.error(traceback.format_exc())
+        return jsonify({'error': 'Failed to compare periods'}), 500
 
 @app.route("/api/reports", methods=['GET'])
 @subscription_required
 @feature_required('advanced_reporting')
 def download_reports():
-    """Download reports based on type and date range"""
+    """
+    Download reports based on type and date range.
+
+    Every response carries an X-Report-Watermark header. With since set to
+    a previous watermark, only rows whose attendance changed after it are
+    returned, keyed by worker_id and task_id, with deleted set on rows that
+    no longer exist. Watermarks older than the tombstone retention get 410.
+    """
     try:
         report_type = request.args.get('type', 'per_day')
         start_date = request.args.get('start_date')
         end_date = request.args.get('end_date')
         format_type = request.args.get('format', 'csv').lower()
+        since = request.args.get('since')
         
         logging.info(f"Report download request: type={report_type}, format={format_type}, dates={start_date} to {end_date}")
         
@@ -1939,8 +2092,8 @@ def download_reports():
             return jsonify({'error': 'Start date and end date are required'}), 400
         
         # Validate format
-        if format_type not in ['csv', 'excel', 'xlsx']:
-            return jsonify({'error': 'Invalid format. Supported formats: csv, excel, xlsx'}), 400
+        if format_type not in ['csv', 'excel', 'xlsx', 'parquet', 'arrow']:
+            return jsonify({'error': 'Invalid format. Supported formats: csv, excel, xlsx, parquet, arrow'}), 400
         
         # Get current company from workspace
         company = get_current_company()
@@ -1957,31 +2110,75 @@ def download_reports():
             logging.error(f"Invalid date format: {str(e)}")
             return jsonify({'error': 'Invalid date format. Use YYYY-MM-DD'}), 400
         
+        if since:
+            try:
+                since_obj = datetime.fromisoformat(since)
+            except ValueError:
+                return jsonify({'error': 'Invalid since watermark. Use an ISO timestamp'}), 400
+            # Attendance.updated_at is naive UTC, so offsets such as Z are converted and dropped
+            if since_obj.tzinfo is not None:
+                since_obj = since_obj.astimezone(timezone.utc).replace(tzinfo=None)
+            # Older deletions may have been purged, so the delta could miss them
+            if since_obj < oldest_usable_watermark():
+                return jsonify({'error': 'Watermark has expired. Download the full report again'}), 410
+        
+        if report_type == 'all':
+            if since:
+                return jsonify({'error': 'Delta exports need a single report type'}), 400
+            if format_type not in ['excel', 'xlsx']:
+                return jsonify({'error': 'The combined report is only available as an Excel workbook'}), 400
+            queued = _queued_xlsx_response(company, 'export', 'all', start_date_obj, end_date_obj, PAYMENT_TYPES)
+            if queued is not None:
+                return queued
+            return generate_payroll_workbook_response(company, start_date_obj, end_date_obj)
+        
         # Generate report data based on type
-        if report_type == 'per_day':
-            logging.info(f"Generating per_day report for company {company.id} from {start_date_obj} to {end_date_obj}")
-            report_data = generate_per_day_report(company, start_date_obj, end_date_obj)
-        elif report_type == 'per_part':
-            logging.info(f"Generating per_part report for company {company.id} from {start_date_obj} to {end_date_obj}")
-            report_data = generate_per_part_report(company, start_date_obj, end_date_obj)
-        elif report_type == 'per_hour':
-            logging.info(f"Generating per_hour report for company {company.id} from {start_date_obj} to {end_date_obj}")
-            report_data = generate_per_hour_report(company, start_date_obj, end_date_obj)
-        else:
+        if report_type not in PAYMENT_TYPES:
             return jsonify({'error': 'Invalid report type'}), 400
         
-        logging.info(f"Report generated with {len(report_data) if report_data else 0} records")
-        
-        # Check if we have data
-        if not report_data:
+        if format_type in ['excel', 'xlsx'] and not since:
+            queued = _queued_xlsx_response(company, 'export', report_type, start_date_obj, end_date_obj, (report_type,))
+            if queued is not None:
+                return queued
+        
+        logging.info(f"Generating {report_type} report for company {company.id} from {start_date_obj} to {end_date_obj}")
+        # Taken before reading, so nothing committed meanwhile is skipped by the next delta
+        watermark = next_watermark()
+        if since:
+            report, deleted = build_report_delta(company, start_date_obj, end_date_obj, report_type, since_obj)
+            columns = [('worker_id', 'worker_id'), ('task_id', 'task_id')]
+            columns += report_columns(EXPORT_COLUMNS, report_type, report['import_fields'], report['custom_fields'])
+            columns += [('deleted', 'deleted')]
+            records = [dict(record, deleted=False) for record in report[report_type]]
+            records += [{'worker_id': worker_id, 'task_id': task_id, 'deleted': True} for worker_id, task_id in deleted]
+        else:
+            # Large companies are built a chunk of workers at a time while the file is written
+            report = stream_report_records(company, start_date_obj, end_date_obj, payment_types=(report_type,))
+            columns = report_columns(EXPORT_COLUMNS, report_type, report['import_fields'], report['custom_fields'])
+            records = report[report_type]
+        
+        # Check if we have data; an empty delta just means nothing changed
+        first_record, records = peek_records(records)
+        if first_record is None and not since:
             logging.warning(f"No data found for {report_type} report from {start_date_obj} to {end_date_obj}")
             return jsonify({'error': 'No data available for the selected date range'}), 400
         
-        # Generate file based on format
+        # Generate file based on format; rows are projected lazily as they are written
+        report_data = (project_record(record, columns) for record in records)
         if format_type == 'csv':
-            response = generate_csv_response(report_data, report_type, start_date_obj, end_date_obj)
+            response = generate_csv_response(report_data, report_type, start_date_obj, end_date_obj,
+                                             fieldnames=[header for _, header in columns])
         elif format_type in ['excel', 'xlsx']:
-            response = generate_excel_response(report_data, report_type, start_date_obj, end_date_obj)
+            response = generate_excel_response(report_data, report_type, start_date_obj, end_date_obj,
+                                               fieldnames=[header for _, header in columns])
+        elif format_type in COLUMNAR_MIMETYPES:
+            currencies = report_currencies(company.id, report_type, start_date_obj, end_date_obj)
+            response = generate_columnar_response(report_data, report_type, format_type, start_date_obj, end_date_obj,
+                                                  typed_columns(columns, report['import_fields'], report['custom_fields']),
+                                                  currencies=currencies)
+        
+        if isinstance(response, Response):
+            response.headers['X-Report-Watermark'] = watermark.isoformat()
         
         logging.info(f"Report successfully generated and ready for download")
         return response
@@ -1991,412 +2188,469 @@ def download_reports():
         logging.error(traceback.format_exc())
         return jsonify({'error': 'Failed to generate report'}), 500
 
-def generate_csv_response(report_data, report_type, start_date, end_date):
-    """Generate CSV file response"""
-    import io
-    import csv
-    
+def _encode_rows_cursor(sort, descending, after):
+    """Opaque /api/reports/rows cursor for a keyset position, or None on the last page"""
+    if after is None:
+        return None
+    return base64.urlsafe_b64encode(json.dumps({
+        'sort': sort,
+        'descending': descending,
+        'after': after
+    }).encode()).decode()
+
+
+def _decode_rows_cursor(cursor, sort, descending):
+    """Return the keyset position in a cursor; raises ValueError if it is invalid"""
     try:
-        filename = f'{report_type}_report_{start_date}_to_{end_date}.csv'
+        position = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if position['sort'] != sort or position['descending'] != descending:
+            raise ValueError('cursor was issued for a different sort')
+        return position['after']
+    except Exception as e:
+        raise ValueError(f'Invalid cursor: {e}') from e
+
+
+@app.route("/api/reports/rows", methods=['GET'])
+@subscription_required
+@feature_required('advanced_reporting')
+def report_rows():
+    """Return one page of report rows, for loading the reports page incrementally"""
+    try:
+        from report_pipeline import available_columns, build_report_page, report_fields, REPORT_PAGE_ROWS
         
-        output = io.StringIO()
+        report_type = request.args.get('type', 'per_day')
+        start_date = request.args.get('start_date')
+        end_date = request.args.get('end_date')
+        sort = request.args.get('sort', 'worker_id')
+        cursor = request.args.get('cursor')
         
-        if report_data and len(report_data) > 0:
-            # Get fieldnames from first record
-            fieldnames = list(report_data[0].keys())
-            
-            # Create CSV writer with explicit parameters
-            writer = csv.DictWriter(output, fieldnames=fieldnames, restval='', extrasaction='ignore')
-            
-            # Write header
-            writer.writeheader()
-            
-            # Write data rows
-            for row in report_data:
-                writer.writerow(row)
-            
-            logging.info(f"CSV generated with {len(report_data)} rows and {len(fieldnames)} columns")
+        if report_type not in PAYMENT_TYPES:
+            return jsonify({'error': 'Invalid report type'}), 400
+        if not start_date or not end_date:
+            return jsonify({'error': 'Start date and end date are required'}), 400
+        try:
+            start_date_obj = datetime.strptime(start_date, '%Y-%m-%d').date()
+            end_date_obj = datetime.strptime(end_date, '%Y-%m-%d').date()
+        except ValueError:
+            return jsonify({'error': 'Invalid date format. Use YYYY-MM-DD'}), 400
+        try:
+            limit = min(max(int(request.args.get('limit', REPORT_PAGE_ROWS)), 1), 500)
+        except ValueError:
+            return jsonify({'error': 'limit must be a number'}), 400
+        
+        company = get_current_company()
+        if not company:
+            return jsonify({'error': 'Company not found'}), 404
+        
+        import_fields, custom_fields = report_fields(company, start_date_obj, end_date_obj)
+        allowed_columns = available_columns(report_type, import_fields, custom_fields)
+        
+        # A leading '-' sorts descending, e.g. sort=-attendance_days
+        descending = sort.startswith('-')
+        sort = sort.lstrip('-')
+        if sort not in allowed_columns:
+            return jsonify({'error': f'Cannot sort by {sort}'}), 400
+        
+        if request.args.get('columns'):
+            columns = [column.strip() for column in request.args['columns'].split(',') if column.strip()]
+            unknown = [column for column in columns if column not in allowed_columns]
+            if unknown:
+                return jsonify({'error': f"Unknown columns: {', '.join(unknown)}"}), 400
         else:
-            logging.warning("No data to write to CSV")
+            columns = [key for key, _ in report_columns(EXPORT_COLUMNS, report_type, import_fields, custom_fields)]
         
-        output.seek(0)
-        csv_content = output.getvalue()
+        # The cursor is the keyset position of the previous page's last row
+        after = None
+        if cursor:
+            try:
+                after = _decode_rows_cursor(cursor, sort, descending)
+            except ValueError:
+                return jsonify({'error': 'Invalid cursor'}), 400
         
-        # Create response with proper encoding
-        response = make_response(csv_content.encode('utf-8-sig'))  # utf-8-sig includes BOM for Excel compatibility
-        response.headers['Content-Type'] = 'text/csv; charset=utf-8'
-        response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
-        response.headers['Content-Length'] = len(response.get_data())
+        page = build_report_page(company, start_date_obj, end_date_obj, report_type, columns,
+                                 sort=sort, descending=descending, after=after, limit=limit,
+                                 include_total=after is None)
         
-        logging.info(f"CSV response prepared: {filename} ({len(response.get_data())} bytes)")
+        next_cursor = _encode_rows_cursor(sort, descending, page['next'])
         
-        return response
+        response = {
+            'type': report_type,
+            'columns': columns,
+            'available_columns': allowed_columns,
+            'sort': ('-' if descending else '') + sort,
+            'rows': page['rows'],
+            'next_cursor': next_cursor
+        }
+        if 'total' in page:
+            response['total'] = page['total']
+        return jsonify(response), 200
         
     except Exception as e:
-        logging.error(f"Error generating CSV response: {str(e)}")
+        logging.error(f"Error loading report rows: {str(e)}")
         logging.error(traceback.format_exc())
-        raise
+        return jsonify({'error': 'Failed to load report rows'}), 500
+
+def _payroll_period_payload(period):
+    """Public view of a closed payroll period"""
+    return {
+        'id': period.id,
+        'start_date': period.start_date.isoformat(),
+        'end_date': period.end_date.isoformat(),
+        'closed_at': period.closed_at.isoformat(),
+        'closed_by': period.closed_by,
+        'row_count': period.row_count,
+        'reopen_url': url_for('reopen_payroll_period_route', period_id=period.id)
+    }
 
-def generate_excel_response(report_data, report_type, start_date, end_date):
-    """Generate Excel file response"""
+@app.route("/api/payroll-periods", methods=['GET'])
+@subscription_required
+@feature_required('advanced_reporting')
+def list_payroll_periods():
+    """List the current company's closed payroll periods"""
     try:
-        import pandas as pd
-        from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
-        from openpyxl.utils import get_column_letter
-        import io
+        company = get_current_company()
+        if not company:
+            return jsonify({'error': 'Company not found'}), 404
         
-        filename = f'{report_type}_report_{start_date}_to_{end_date}.xlsx'
+        periods = PayrollPeriod.query.filter_by(company_id=company.id).order_by(PayrollPeriod.start_date.desc()).all()
+        return jsonify({'periods': [_payroll_period_payload(period) for period in periods]}), 200
         
-        # Create DataFrame from report data
-        if report_data and len(report_data) > 0:
-            df = pd.DataFrame(report_data)
-            logging.info(f"Created DataFrame with {len(df)} rows and {len(df.columns)} columns")
-        else:
-            logging.warning("No data provided for Excel generation, creating empty workbook")
-            df = pd.DataFrame()
+    except Exception as e:
+        logging.error(f"Error listing payroll periods: {str(e)}")
+        logging.error(traceback.format_exc())
+        return jsonify({'error': 'Failed to list payroll periods'}), 500
+
+@app.route("/api/payroll-periods/close", methods=['POST'])
+@subscription_required
+@feature_required('advanced_reporting')
+@admin_required
+def close_payroll_period_route():
+    """Close a payroll period, freezing its report rows"""
+    try:
+        from payroll_periods import close_payroll_period, PayrollPeriodError
         
-        # Create Excel file in memory
-        output = io.BytesIO()
+        data = request.get_json(silent=True) or request.form
+        start_date = data.get('start_date')
+        end_date = data.get('end_date')
+        if not start_date or not end_date:
+            return jsonify({'error': 'Start date and end date are required'}), 400
+        try:
+            start_date_obj = datetime.strptime(start_date, '%Y-%m-%d').date()
+            end_date_obj = datetime.strptime(end_date, '%Y-%m-%d').date()
+        except ValueError:
+            return jsonify({'error': 'Invalid date format. Use YYYY-MM-DD'}), 400
         
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            # Write data to 'Report' sheet
-            df.to_excel(writer, sheet_name='Report', index=False)
-            
-            # Get the workbook and worksheet for formatting
-            workbook = writer.book
-            worksheet = writer.sheets['Report']
-            
-            # Define styles
-            header_fill = PatternFill(start_color='1F4E78', end_color='1F4E78', fill_type='solid')
-            header_font = Font(bold=True, color='FFFFFF', size=11)
-            border = Border(
-                left=Side(style='thin'),
-                right=Side(style='thin'),
-                top=Side(style='thin'),
-                bottom=Side(style='thin')
-            )
-            
-            # Format header row
-            for cell in worksheet[1]:
-                cell.fill = header_fill
-                cell.font = header_font
-                cell.alignment = Alignment(horizontal='center', vertical='center', wrap_text=True)
-                cell.border = border
-            
-            # Format data rows
-            for row in worksheet.iter_rows(min_row=2, max_row=worksheet.max_row, min_col=1, max_col=worksheet.max_column):
-                for cell in row:
-                    cell.border = border
-                    cell.alignment = Alignment(horizontal='left', vertical='center', wrap_text=True)
-                    
-                    # Right-align numbers
-                    if isinstance(cell.value, (int, float)):
-                        cell.alignment = Alignment(horizontal='right', vertical='center')
-            
-            # Auto-adjust column widths
-            for idx, column in enumerate(worksheet.columns, 1):
-                max_length = 0
-                column_letter = get_column_letter(idx)
-                
-                for cell in column:
-                    try:
-                        if cell.value:
-                            cell_length = len(str(cell.value))
-                            if cell_length > max_length:
-                                max_length = cell_length
-                    except:
-                        pass
-                
-                adjusted_width = min(max_length + 3, 50)  # Cap at 50 characters
-                worksheet.column_dimensions[column_letter].width = adjusted_width
-            
-            # Set row height for header
-            worksheet.row_dimensions[1].height = 25
-            
-            logging.info(f"Excel formatting completed: {worksheet.max_row} rows, {worksheet.max_column} columns")
+        company = get_current_company()
+        if not company:
+            return jsonify({'error': 'Company not found'}), 404
         
-        output.seek(0)
-        excel_bytes = output.getvalue()
+        user = User.query.filter_by(email=session['user']['user_email']).first()
+        try:
+            period = close_payroll_period(company, start_date_obj, end_date_obj, user_id=user.id if user else None)
+        except PayrollPeriodError as e:
+            return jsonify({'error': str(e)}), 409
+        db.session.commit()
         
-        # Create response
-        response = make_response(excel_bytes)
-        response.headers['Content-Type'] = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-        response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
-        response.headers['Content-Length'] = len(excel_bytes)
+        return jsonify(_payroll_period_payload(period)), 201
         
-        logging.info(f"Excel response prepared: {filename} ({len(excel_bytes)} bytes)")
+    except Exception as e:
+        db.session.rollback()
+        logging.error(f"Error closing payroll period: {str(e)}")
+        logging.error(traceback.format_exc())
+        return jsonify({'error': 'Failed to close payroll period'}), 500
+
+@app.route("/api/payroll-periods/<int:period_id>/reopen", methods=['POST'])
+@subscription_required
+@feature_required('advanced_reporting')
+@admin_required
+def reopen_payroll_period_route(period_id):
+    """Reopen a closed payroll period, discarding its snapshot"""
+    try:
+        from payroll_periods import reopen_payroll_period
         
-        return response
+        company = get_current_company()
+        if not company:
+            return jsonify({'error': 'Company not found'}), 404
+        
+        period = PayrollPeriod.query.filter_by(id=period_id, company_id=company.id).first()
+        if not period:
+            return jsonify({'error': 'Payroll period not found'}), 404
+        
+        reopen_payroll_period(period)
+        db.session.commit()
+        
+        return jsonify({'message': 'Payroll period reopened successfully'}), 200
         
-    except ImportError as e:
-        logging.warning(f"pandas or openpyxl not available, falling back to CSV: {str(e)}")
-        return generate_csv_response(report_data, report_type, start_date, end_date)
     except Exception as e:
-        logging.error(f"Error generating Excel file: {str(e)}")
+        db.session.rollback()
+        logging.error(f"Error reopening payroll period: {str(e)}")
         logging.error(traceback.format_exc())
-        # Fallback to CSV on error
-        try:
-            return generate_csv_response(report_data, report_type, start_date, end_date)
-        except Exception as csv_error:
-            logging.error(f"CSV fallback also failed: {str(csv_error)}")
-            return jsonify({'error': 'Failed to generate report file'}), 500
+        return jsonify({'error': 'Failed to reopen payroll period'}), 500
 
-def generate_per_day_report(company, start_date, end_date):
-    """Generate per day report data"""
+@app.route("/api/reports/jobs", methods=['POST'])
+@subscription_required
+@feature_required('advanced_reporting')
+def create_report_job():
+    """Queue a report to be generated in the background"""
     try:
-        logging.info(f"Starting per_day report generation for company {company.id}")
+        from report_jobs import submit_report_job, JOB_KINDS, JOB_FORMATS
         
-        # Get all workers for the company
-        workers = Worker.query.filter_by(company_id=company.id).all()
-        logging.info(f"Found {len(workers)} workers")
+        data = request.get_json(silent=True) or request.form
+        kind = data.get('kind', 'workbook')
+        report_type = data.get('report_type') or data.get('type')
+        format_type = (data.get('format') or 'csv').lower()
+        start_date = data.get('start_date')
+        end_date = data.get('end_date')
         
-        # Get custom fields for this company
-        import_fields = ImportField.query.filter_by(company_id=company.id).all()
-        custom_fields = ReportField.query.filter_by(company_id=company.id).all()
+        if kind not in JOB_KINDS:
+            return jsonify({'error': f"Invalid job kind. Supported kinds: {', '.join(JOB_KINDS)}"}), 400
+        if not start_date or not end_date:
+            return jsonify({'error': 'Start date and end date are required'}), 400
+        try:
+            start_date_obj = datetime.strptime(start_date, '%Y-%m-%d').date()
+            end_date_obj = datetime.strptime(end_date, '%Y-%m-%d').date()
+        except ValueError:
+            return jsonify({'error': 'Invalid date format. Use YYYY-MM-DD'}), 400
         
-        report_data = []
+        if kind == 'export':
+            if format_type == 'excel':
+                format_type = 'xlsx'
+            if report_type not in PAYMENT_TYPES and not (report_type == 'all' and format_type == 'xlsx'):
+                return jsonify({'error': 'Invalid report type'}), 400
+            if format_type not in JOB_FORMATS:
+                return jsonify({'error': f"Invalid format. Supported formats: {', '.join(JOB_FORMATS)}"}), 400
         
-        for worker in workers:
-            # Find all attendance records for this worker in the date range
-            attendance_records = Attendance.query.filter(
-                Attendance.worker_id == worker.id,
-                Attendance.company_id == company.id,
-                Attendance.date.between(start_date, end_date),
-                Attendance.status == 'Present'
-            ).all()
-            
-            logging.debug(f"Worker {worker.id}: Found {len(attendance_records)} attendance records")
-            
-            # Group by task (only per_day tasks)
-            per_day_tasks = {}
-            for att in attendance_records:
-                if att.task and getattr(att.task, 'payment_type', None) == 'per_day':
-                    # Only count if task started before or during the end date of the report
-                    if att.task.start_date.date() <= end_date:
-                        task_id = att.task.id
-                        if task_id not in per_day_tasks:
-                            per_day_tasks[task_id] = {
-                                'task': att.task,
-                                'days': 0
-                            }
-                        per_day_tasks[task_id]['days'] += 1
-            
-            # Create record for each per_day task
-            for task_id, task_data in per_day_tasks.items():
-                task = task_data['task']
-                days = task_data['days']
-                
-                record = {
-                    'first_name': getattr(worker, 'first_name', ''),
-                    'last_name': getattr(worker, 'last_name', ''),
-                    'task_name': getattr(task, 'name', ''),
-                    'attendance_days': days,
-                    'daily_rate': getattr(task, 'per_day_payout', None) or getattr(company, 'daily_payout_rate', None),
-                    'currency': getattr(task, 'per_day_currency', 'USD')
-                }
-                
-                # Add import field values
-                for field in import_fields:
-                    custom_value = WorkerCustomFieldValue.query.filter_by(
-                        worker_id=worker.id,
-                        custom_field_id=field.id
-                    ).first()
-                    record[field.name] = custom_value.value if custom_value else 'N/A'
-                
-                # Add custom report fields
-                for field in custom_fields:
-                    if field.field_type == 'numeric' and field.formula:
-                        try:
-                            formula = field.formula
-                            formula = formula.replace('attendance_days', str(days))
-                            formula = formula.replace('daily_rate', str(record['daily_rate'] or 0))
-                            record[field.name] = eval(formula)
-                        except Exception as e:
-                            logging.warning(f"Failed to evaluate formula for field {field.name}: {str(e)}")
-                            record[field.name] = 0
-                    else:
-                        record[field.name] = field.value or ''
-                
-                report_data.append(record)
+        company = get_current_company()
+        if not company:
+            return jsonify({'error': 'Company not found'}), 404
         
-        logging.info(f"Per_day report generation complete: {len(report_data)} records")
-        return report_data
+        job = submit_report_job(company.id, kind, {
+            'report_type': report_type,
+            'format': format_type if kind == 'export' else 'xlsx',
+            'start_date': start_date_obj.isoformat(),
+            'end_date': end_date_obj.isoformat()
+        })
+        return jsonify(_report_job_payload(job)), 202
         
     except Exception as e:
-        logging.error(f"Error generating per day report: {str(e)}")
+        logging.error(f"Error queuing report job: {str(e)}")
         logging.error(traceback.format_exc())
-        return []
+        return jsonify({'error': 'Failed to queue report'}), 500
+
+def _report_job_payload(job):
+    """Public view of a report job's status"""
+    payload = {key: job.get(key) for key in ('job_id', 'kind', 'params', 'status', 'progress', 'message',
+                                              'rows_written', 'expected_rows', 'created_at', 'updated_at',
+                                              'heartbeat_at', 'row_count', 'error')}
+    payload['status_url'] = url_for('report_job_status', job_id=job['job_id'])
+    if job.get('status') == 'finished':
+        payload['download_url'] = url_for('download_report_job', job_id=job['job_id'])
+    return payload
+
+def _current_company_job(job_id):
+    """Load a report job if it belongs to the current company"""
+    from report_jobs import read_job
+    
+    company = get_current_company()
+    try:
+        job = read_job(job_id)
+    except ValueError:
+        return None
+    if not company or not job or job.get('company_id') != company.id:
+        return None
+    return job
 
-def generate_per_part_report(company, start_date, end_date):
-    """Generate per part report data"""
+@app.route("/api/reports/jobs/<job_id>", methods=['GET'])
+@subscription_required
+@feature_required('advanced_reporting')
+def report_job_status(job_id):
+    """Poll the progress of a background report"""
+    job = _current_company_job(job_id)
+    if not job:
+        return jsonify({'error': 'Report job not found'}), 404
+    return jsonify(_report_job_payload(job)), 200
+
+@app.route("/api/reports/jobs/<job_id>/download", methods=['GET'])
+@subscription_required
+@feature_required('advanced_reporting')
+def download_report_job(job_id):
+    """Download the file produced by a finished background report"""
     try:
-        logging.info(f"Starting per_part report generation for company {company.id}")
+        from report_jobs import job_artifact_path
         
-        # Get all workers for the company
-        workers = Worker.query.filter_by(company_id=company.id).all()
-        logging.info(f"Found {len(workers)} workers")
+        job = _current_company_job(job_id)
+        if not job:
+            return jsonify({'error': 'Report job not found'}), 404
+        if job.get('status') != 'finished':
+            return jsonify({'error': f"Report is not ready (status: {job.get('status')})"}), 409
         
-        import_fields = ImportField.query.filter_by(company_id=company.id).all()
-        custom_fields = ReportField.query.filter_by(company_id=company.id).all()
+        return send_file(
+            job_artifact_path(job),
+            mimetype=job['mimetype'],
+            as_attachment=True,
+            download_name=job['filename']
+        )
+    except Exception as e:
+        logging.error(f"Error downloading report job {job_id}: {str(e)}")
+        return jsonify({'error': 'Failed to download report'}), 500
+
+def generate_csv_response(report_data, report_type, start_date, end_date, fieldnames=None):
+    """Generate a streamed CSV file response"""
+    try:
+        filename = f'{report_type}_report_{start_date}_to_{end_date}.csv'
         
-        report_data = []
+        rows = iter(report_data or [])
+        if fieldnames is None:
+            # Get fieldnames from first record
+            first_row = next(rows, None)
+            if first_row is None:
+                logging.warning("No data to write to CSV")
+                fieldnames = []
+            else:
+                fieldnames = list(first_row.keys())
+                rows = itertools.chain([first_row], rows)
         
-        for worker in workers:
-            # Find all attendance records for this worker in the date range for per_part tasks
-            attendance_records = Attendance.query.filter(
-                Attendance.worker_id == worker.id,
-                Attendance.company_id == company.id,
-                Attendance.date.between(start_date, end_date)
-            ).all()
-            
-            logging.debug(f"Worker {worker.id}: Found {len(attendance_records)} attendance records")
-            
-            # Group by task (only per_part tasks)
-            per_part_tasks = {}
-            for att in attendance_records:
-                if att.task and getattr(att.task, 'payment_type', None) == 'per_part':
-                    # Only count if task started before or during the end date of the report
-                    if att.task.start_date.date() <= end_date:
-                        task_id = att.task.id
-                        if task_id not in per_part_tasks:
-                            per_part_tasks[task_id] = {
-                                'task': att.task,
-                                'units': 0
-                            }
-                        # Sum up the units completed
-                        units = getattr(att, 'units_completed', 0) or 0
-                        per_part_tasks[task_id]['units'] += units
-            
-            # Create record for each per_part task
-            for task_id, task_data in per_part_tasks.items():
-                task = task_data['task']
-                units = task_data['units']
-                
-                record = {
-                    'first_name': getattr(worker, 'first_name', ''),
-                    'last_name': getattr(worker, 'last_name', ''),
-                    'task_name': getattr(task, 'name', ''),
-                    'units_completed': units,
-                    'per_part_rate': getattr(task, 'per_part_payout', None),
-                    'currency': getattr(task, 'per_part_currency', 'USD')
-                }
-                
-                # Add import field values
-                for field in import_fields:
-                    custom_value = WorkerCustomFieldValue.query.filter_by(
-                        worker_id=worker.id,
-                        custom_field_id=field.id
-                    ).first()
-                    record[field.name] = custom_value.value if custom_value else ''
-                
-                # Add custom report fields
-                for field in custom_fields:
-                    if field.field_type == 'numeric' and field.formula:
-                        try:
-                            formula = field.formula
-                            formula = formula.replace('units_completed', str(units))
-                            formula = formula.replace('per_part_rate', str(record['per_part_rate'] or 0))
-                            record[field.name] = eval(formula)
-                        except Exception as e:
-                            logging.warning(f"Failed to evaluate formula for field {field.name}: {str(e)}")
-                            record[field.name] = 0
-                    else:
-                        record[field.name] = field.value or ''
-                
-                report_data.append(record)
+        # Rows are written and sent chunk by chunk, so the file is never held in memory
+        response = Response(
+            stream_with_context(iter_csv_chunks(rows, fieldnames)),
+            mimetype='text/csv'
+        )
+        response.headers['Content-Type'] = 'text/csv; charset=utf-8'
+        response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+        
+        logging.info(f"CSV response streaming: {filename}")
         
-        logging.info(f"Per_part report generation complete: {len(report_data)} records")
-        return report_data
+        return response
         
     except Exception as e:
-        logging.error(f"Error generating per_part report: {str(e)}", exc_info=True)
-        return []
+        logging.error(f"Error generating CSV response: {str(e)}")
+        logging.error(traceback.format_exc())
+        raise
 
-def generate_per_hour_report(company, start_date, end_date):
-    """Generate per hour report data"""
+def _queued_xlsx_response(company, kind, report_type, start_date, end_date, payment_types):
+    """
+    Queue an XLSX download as a background report job when the request asks
+    for one with async=1, or when preflight expects it to take too long to
+    render inline.
+
+    Returns a 202 response pointing at the job's status URL, or None if the
+    workbook should be rendered in this request.
+    """
+    from report_jobs import submit_report_job
+    from report_preflight import REPORT_INLINE_MAX_SECONDS
+    
+    if request.args.get('async', '').lower() not in ('1', 'true', 'yes'):
+        estimated_seconds = sum(
+            preflight_report(company, start_date, end_date, payment_type, 'xlsx')['estimated_seconds']
+            for payment_type in payment_types
+        )
+        if estimated_seconds <= REPORT_INLINE_MAX_SECONDS:
+            return None
+    
+    job = submit_report_job(company.id, kind, {
+        'report_type': report_type,
+        'format': 'xlsx',
+        'start_date': start_date.isoformat(),
+        'end_date': end_date.isoformat()
+    })
+    logging.info(f"XLSX download for company {company.id} queued as report job {job['job_id']}")
+    return jsonify(_report_job_payload(job)), 202
+
+def generate_payroll_workbook_response(company, start_date, end_date):
+    """Generate the combined Per Day, Per Part, Per Hour and Summary workbook"""
+    import tempfile
+    from report_pipeline import payroll_workbook_sheets
+    
+    # All three sheets come from a single attendance scan, or a chunk of workers at a time
+    report = stream_report_records(company, start_date, end_date, payment_types=PAYMENT_TYPES)
+    has_data = False
+    for payout_type in PAYMENT_TYPES:
+        first_record, report[payout_type] = peek_records(report[payout_type])
+        has_data = has_data or first_record is not None
+    if not has_data:
+        logging.warning(f"No data found for combined report from {start_date} to {end_date}")
+        return jsonify({'error': 'No data available for the selected date range'}), 400
+    
+    filename = f'payroll_report_{start_date}_to_{end_date}.xlsx'
+    output = tempfile.TemporaryFile()
+    render_xlsx(output, payroll_workbook_sheets(report, company))
+    output.seek(0)
+    
+    logging.info(f"Combined payroll workbook prepared: {filename}")
+    return send_file(
+        output,
+        mimetype=XLSX_MIMETYPE,
+        as_attachment=True,
+        download_name=filename
+    )
+
+def generate_columnar_response(report_data, report_type, format_type, start_date, end_date, columns, currencies=None):
+    """Generate a typed Parquet or Arrow file response"""
     try:
-        logging.info(f"Starting per_hour report generation for company {company.id}")
+        import tempfile
         
-        # Get all workers for the company
-        workers = Worker.query.filter_by(company_id=company.id).all()
-        logging.info(f"Found {len(workers)} workers")
+        filename = f'{report_type}_report_{start_date}_to_{end_date}.{format_type}'
         
-        import_fields = ImportField.query.filter_by(company_id=company.id).all()
-        custom_fields = ReportField.query.filter_by(company_id=company.id).all()
+        output = tempfile.TemporaryFile()
+        write_columnar_report(output, report_data, columns, format_type, report_type, start_date, end_date,
+                              currencies=currencies)
+        output.seek(0)
         
-        report_data = []
+        logging.info(f"{format_type} response prepared: {filename}")
+        return send_file(
+            output,
+            mimetype=COLUMNAR_MIMETYPES[format_type],
+            as_attachment=True,
+            download_name=filename
+        )
         
-        for worker in workers:
-            # Find all attendance records for this worker in the date range for per_hour tasks
-            attendance_records = Attendance.query.filter(
-                Attendance.worker_id == worker.id,
-                Attendance.company_id == company.id,
-                Attendance.date.between(start_date, end_date)
-            ).all()
-            
-            logging.debug(f"Worker {worker.id}: Found {len(attendance_records)} attendance records")
-            
-            # Group by task (only per_hour tasks)
-            per_hour_tasks = {}
-            for att in attendance_records:
-                if att.task and getattr(att.task, 'payment_type', None) == 'per_hour':
-                    # Only count if task started before or during the end date of the report
-                    if att.task.start_date.date() <= end_date:
-                        task_id = att.task.id
-                        if task_id not in per_hour_tasks:
-                            per_hour_tasks[task_id] = {
-                                'task': att.task,
-                                'hours': 0
-                            }
-                        # Sum up the hours worked
-                        hours = getattr(att, 'hours_worked', 0) or 0
-                        per_hour_tasks[task_id]['hours'] += hours
-            
-            # Create record for each per_hour task
-            for task_id, task_data in per_hour_tasks.items():
-                task = task_data['task']
-                hours = task_data['hours']
-                
-                record = {
-                    'first_name': getattr(worker, 'first_name', ''),
-                    'last_name': getattr(worker, 'last_name', ''),
-                    'task_name': getattr(task, 'name', ''),
-                    'hours_worked': hours,
-                    'per_hour_rate': getattr(task, 'per_hour_payout', None),
-                    'currency': getattr(task, 'per_hour_currency', 'USD')
-                }
-                
-                # Add import field values
-                for field in import_fields:
-                    custom_value = WorkerCustomFieldValue.query.filter_by(
-                        worker_id=worker.id,
-                        custom_field_id=field.id
-                    ).first()
-                    record[field.name] = custom_value.value if custom_value else ''
-                
-                # Add custom report fields
-                for field in custom_fields:
-                    if field.field_type == 'numeric' and field.formula:
-                        try:
-                            formula = field.formula
-                            formula = formula.replace('hours_worked', str(hours))
-                            formula = formula.replace('per_hour_rate', str(record['per_hour_rate'] or 0))
-                            record[field.name] = eval(formula)
-                        except Exception as e:
-                            logging.warning(f"Failed to evaluate formula for field {field.name}: {str(e)}")
-                            record[field.name] = 0
-                    else:
-                        record[field.name] = field.value or ''
-                
-                report_data.append(record)
+    except ImportError as e:
+        logging.error(f"pyarrow not available for {format_type} export: {str(e)}")
+        return jsonify({'error': f'{format_type} export is not available on this server'}), 501
+
+def generate_excel_response(report_data, report_type, start_date, end_date, fieldnames=None):
+    """Generate Excel file response"""
+    try:
+        import tempfile
+        
+        filename = f'{report_type}_report_{start_date}_to_{end_date}.xlsx'
+        
+        if fieldnames is None:
+            fieldnames = list(report_data[0].keys()) if report_data else []
+            if not fieldnames:
+                logging.warning("No data provided for Excel generation, creating empty workbook")
+        
+        # Rows stream into a write-only workbook spooled to disk, not memory
+        output = tempfile.TemporaryFile()
+        render_xlsx(output, [('Report', fieldnames, report_data or [])])
+        output.seek(0)
+        
+        response = send_file(
+            output,
+            mimetype=XLSX_MIMETYPE,
+            as_attachment=True,
+            download_name=filename
+        )
+        
+        logging.info(f"Excel response prepared: {filename}")
         
-        logging.info(f"Per_hour report generation complete: {len(report_data)} records")
-        return report_data
+        return response
         
+    except ImportError as e:
+        logging.warning(f"openpyxl not available, falling back to CSV: {str(e)}")
+        return generate_csv_response(report_data, report_type, start_date, end_date, fieldnames=fieldnames)
     except Exception as e:
-        logging.error(f"Error generating per part report: {str(e)}")
+        logging.error(f"Error generating Excel file: {str(e)}")
         logging.error(traceback.format_exc())
-        return []
+        # Streamed rows are already partly consumed and cannot be written again
+        if not isinstance(report_data, list):
+            return jsonify({'error': 'Failed to generate report file'}), 500
+        # Fallback to CSV on error
+        try:
+            return generate_csv_response(report_data, report_type, start_date, end_date, fieldnames=fieldnames)
+        except Exception as csv_error:
+            logging.error(f"CSV fallback also failed: {str(csv_error)}")
+            return jsonify({'error': 'Failed to generate report file'}), 500
 
 @app.route("/api/worker", methods=['POST'])
 @subscription_required
@@ -3048,6 +3302,8 @@ def task_attendance_route(task_id):
                     task_id=task.id
                 )
                 db.session.add(new_attendance)
+        if db.session.new:
+            refresh_attendance_rollup(company_id=company.id, task_id=task.id, start_date=selected_date, end_date=selected_date)
         db.session.commit()
 
         # Fetch attendance records again to ensure up-to-date list
@@ -3655,6 +3911,7 @@ def attendance_route():
 def reports_route():
     try:
         from datetime import date, timedelta, datetime
+        from report_pipeline import available_columns, build_report_page, report_fields, REPORT_PAGE_ROWS
         # Get current company from workspace
         company = get_current_company()
 
@@ -3674,239 +3931,24 @@ def reports_route():
             end_date = date.today()
             start_date = end_date - timedelta(days=30)
 
-        # Get custom report fields
-        custom_fields = ReportField.query.filter_by(company_id=company.id).all()
-        # Get import fields (custom worker fields)
-        import_fields = ImportField.query.filter_by(company_id=company.id).all()
-        # Get all tasks for the company
-        tasks = Task.query.filter_by(company_id=company.id).all()
-        # Get all workers for the company
-        workers = Worker.query.filter_by(company_id=company.id).all()
-
-        # Helper for formula evaluation
-        def evaluate_formula(formula, context, custom_fields_dict=None, visited=None):
-            if visited is None:
-                visited = set()
-            try:
-                import re
-                eval_formula = formula
-                field_regex = r'[a-zA-Z_][a-zA-Z0-9_]*'
-                field_matches = re.findall(field_regex, eval_formula)
-                for field_name in field_matches:
-                    if field_name in visited:
-                        continue
-                    if field_name in context:
-                        value = context[field_name]
-                    elif custom_fields_dict and field_name in custom_fields_dict:
-                        visited.add(field_name)
-                        custom_field_formula = custom_fields_dict[field_name]
-                        value = evaluate_formula(custom_field_formula, context, custom_fields_dict, visited)
-                        visited.remove(field_name)
-                    else:
-                        value = 0
-                    eval_formula = re.sub(r'\b' + re.escape(field_name) + r'\b', str(value), eval_formula)
-                result = eval(eval_formula)
-                return round(result, 2)
-            except Exception as e:
-                logging.error(f"Error evaluating formula {formula}: {str(e)}")
-                return 0.00
-
-        # Prepare per_day, per_part, and per_hour records
-        per_day_records = []
-        per_part_records = []
-        per_hour_records = []
-
-        for worker in workers:
-            # For Per Day: attendance and payout
-            attendance_days = 0
-            # For Per Part: units completed
-            total_units_completed = 0
-            # For Per Hour: hours worked
-            total_hours_worked = 0
-            # Find all attendance records for this worker in the date range
-            attendance_records = Attendance.query.filter(
-                Attendance.worker_id == worker.id,
-                Attendance.company_id == company.id,
-                Attendance.date.between(start_date, end_date)
-            ).all()
-            # Group by task payment type
-            per_day_attendance = {}
-            per_part_units = {}
-            per_hour_hours = {}
-            for att in attendance_records:
-                if att.task and getattr(att.task, 'payment_type', None) == 'per_day':
-                    # Only count attendance if the task is active during the report period
-                    # Check if task started before or during the end date of the report
-                    if att.task.start_date.date() <= end_date:
-                        # Task is relevant to the report period
-                        if att.status == 'Present':
-                            per_day_attendance.setdefault(att.task_id, 0)
-                            per_day_attendance[att.task_id] += 1
-                elif att.task and getattr(att.task, 'payment_type', None) == 'per_part':
-                    # Only count units if the task is active during the report period
-                    if att.task.start_date.date() <= end_date:
-                        # Task is relevant to the report period
-                        if att.units_completed:
-                            per_part_units.setdefault(att.task_id, 0)
-                            per_part_units[att.task_id] += att.units_completed
-                elif att.task and getattr(att.task, 'payment_type', None) == 'per_hour':
-                    # Only count hours if the task is active during the report period
-                    if att.task.start_date.date() <= end_date:
-                        # Task is relevant to the report period
-                        if att.hours_worked:
-                            per_hour_hours.setdefault(att.task_id, 0)
-                            per_hour_hours[att.task_id] += att.hours_worked
-            # For each per_day task, add a record
-            for task_id, days in per_day_attendance.items():
-                task = Task.query.get(task_id) if task_id else None
-                # Compute age
-                try:
-                    from datetime import date
-                    if worker.date_of_birth:
-                        today = date.today()
-                        age = today.year - worker.date_of_birth.year - ((today.month, today.day) < (worker.date_of_birth.month, worker.date_of_birth.day))
-                    else:
-                        age = 0
-                except Exception:
-                    age = 0
-                record = {
-                    'first_name': getattr(worker, 'first_name', ''),
-                    'last_name': getattr(worker, 'last_name', ''),
-                    'task_name': getattr(task, 'name', '') if task else '',
-                    'attendance_days': days,
-                    'daily_rate': getattr(company, 'daily_payout_rate', None),
-                    'age': age,
-                }
-                # Add import field values
-                for field in import_fields:
-                    custom_value = WorkerCustomFieldValue.query.filter_by(
-                        worker_id=worker.id,
-                        custom_field_id=field.id
-                    ).first()
-                    record[field.name] = custom_value.value if custom_value else 'N/A'
-                # Add custom report fields
-                custom_fields_dict = {field.name: field.formula for field in custom_fields if field.field_type == 'numeric'}
-                for field in custom_fields:
-                    if field.field_type == 'numeric':
-                        try:
-                            context = {
-                                'attendance_days': days,
-                                'daily_rate': getattr(company, 'daily_payout_rate', None),
-                                **record
-                            }
-                            result = evaluate_formula(field.formula, context, custom_fields_dict)
-                            if field.max_limit is not None:
-                                result = min(result, field.max_limit)
-                            record[field.name] = result
-                        except Exception as e:
-                            logging.error(f"Error calculating field {field.name}: {str(e)}")
-                            record[field.name] = 0.00
-                per_day_records.append(record)
-            # For each per_part task, add a record
-            for task_id, units in per_part_units.items():
-                task = Task.query.get(task_id) if task_id else None
-                # Compute age
-                try:
-                    from datetime import date
-                    if worker.date_of_birth:
-                        today = date.today()
-                        age = today.year - worker.date_of_birth.year - ((today.month, today.day) < (worker.date_of_birth.month, worker.date_of_birth.day))
-                    else:
-                        age = 0
-                except Exception:
-                    age = 0
-                record = {
-                    'first_name': getattr(worker, 'first_name', ''),
-                    'last_name': getattr(worker, 'last_name', ''),
-                    'task_name': getattr(task, 'name', '') if task else '',
-                    'units_completed': units,
-                    'per_part_rate': getattr(task, 'per_part_payout', None) if task else None,
-                    'per_part_currency': getattr(task, 'per_part_currency', None) if task else None,
-                    'age': age,
-                }
-                # Add import field values
-                for field in import_fields:
-                    custom_value = WorkerCustomFieldValue.query.filter_by(
-                        worker_id=worker.id,
-                        custom_field_id=field.id
-                    ).first()
-                    record[field.name] = custom_value.value if custom_value else 'N/A'
-                # Add custom report fields for per_part
-                per_part_custom_fields = [f for f in custom_fields if f.payout_type in ('per_part', 'both')]
-                custom_fields_dict = {field.name: field.formula for field in per_part_custom_fields if field.field_type == 'numeric'}
-                for field in per_part_custom_fields:
-                    if field.field_type == 'numeric':
-                        try:
-                            context = {
-                                'units_completed': units,
-                                'per_part_rate': record['per_part_rate'],
-                                **record
-                            }
-                            result = evaluate_formula(field.formula, context, custom_fields_dict)
-                            if field.max_limit is not None:
-                                result = min(result, field.max_limit)
-                            record[field.name] = result
-                        except Exception as e:
-                            logging.error(f"Error calculating field {field.name}: {str(e)}")
-                            record[field.name] = 0.00
-                per_part_records.append(record)
-            
-            # For each per_hour task, add a record
-            for task_id, hours in per_hour_hours.items():
-                task = Task.query.get(task_id) if task_id else None
-                # Compute age
-                try:
-                    from datetime import date
-                    if worker.date_of_birth:
-                        today = date.today()
-                        age = today.year - worker.date_of_birth.year - ((today.month, today.day) < (worker.date_of_birth.month, worker.date_of_birth.day))
-                    else:
-                        age = 0
-                except Exception:
-                    age = 0
-                record = {
-                    'first_name': getattr(worker, 'first_name', ''),
-                    'last_name': getattr(worker, 'last_name', ''),
-                    'task_name': getattr(task, 'name', '') if task else '',
-                    'hours_worked': hours,
-                    'per_hour_rate': getattr(task, 'per_hour_payout', None) if task else None,
-                    'per_hour_currency': getattr(task, 'per_hour_currency', None) if task else None,
-                    'age': age,
-                }
-                # Add import field values
-                for field in import_fields:
-                    custom_value = WorkerCustomFieldValue.query.filter_by(
-                        worker_id=worker.id,
-                        custom_field_id=field.id
-                    ).first()
-                    record[field.name] = custom_value.value if custom_value else 'N/A'
-                # Add custom report fields for per_hour
-                per_hour_custom_fields = [f for f in custom_fields if f.payout_type in ('per_hour', 'both')]
-                custom_fields_dict = {field.name: field.formula for field in per_hour_custom_fields if field.field_type == 'numeric'}
-                for field in per_hour_custom_fields:
-                    if field.field_type == 'numeric':
-                        try:
-                            context = {
-                                'hours_worked': hours,
-                                'per_hour_rate': record['per_hour_rate'],
-                                **record
-                            }
-                            result = evaluate_formula(field.formula, context, custom_fields_dict)
-                            if field.max_limit is not None:
-                                result = min(result, field.max_limit)
-                            record[field.name] = result
-                        except Exception as e:
-                            logging.error(f"Error calculating field {field.name}: {str(e)}")
-                            record[field.name] = 0.00
-                per_hour_records.append(record)
+        # The first screen of each report is the first /api/reports/rows page;
+        # the page loads the rest from there with the cursors
+        import_fields, custom_fields = report_fields(company, start_date, end_date)
+        pages = {}
+        for payout_type in PAYMENT_TYPES:
+            page = build_report_page(company, start_date, end_date, payout_type,
+                                     available_columns(payout_type, import_fields, custom_fields),
+                                     limit=REPORT_PAGE_ROWS, include_total=True)
+            pages[payout_type] = dict(page, cursor=_encode_rows_cursor('worker_id', False, page['next']))
 
         return render_template('reports.html', 
             report_data={}, 
             custom_fields=custom_fields,
             import_fields=import_fields,
-            per_day_records=per_day_records,
-            per_part_records=per_part_records,
-            per_hour_records=per_hour_records,
+            per_day_records=pages['per_day']['rows'],
+            per_part_records=pages['per_part']['rows'],
+            per_hour_records=pages['per_hour']['rows'],
+            report_pages=pages,
             start_date=start_date.strftime('%Y-%m-%d'),
             end_date=end_date.strftime('%Y-%m-%d')
         )
@@ -4254,17 +4296,9 @@ def handle_single_worker(worker_id):
                 'last_name': worker.last_name,
                 'date_of_birth': worker.date_of_birth.isoformat() if worker.date_of_birth else None,
                 'created_at': worker.created_at.isoformat() if worker.created_at else None,
-                'custom_fields': {}
+                'custom_fields': load_custom_field_matrix(company.id, custom_fields, worker_ids=[worker.id]).as_dict(worker.id)
             }
             
-            # Add custom field values
-            for field in custom_fields:
-                custom_value = WorkerCustomFieldValue.query.filter_by(
-                    worker_id=worker.id,
-                    custom_field_id=field.id
-                ).first()
-                worker_data['custom_fields'][field.name] = custom_value.value if custom_value else None
-            
             return jsonify(worker_data)
         
         elif request.method == 'PUT':
@@ -4303,6 +4337,7 @@ def delete_worker(worker_id):
             
         # Delete worker (cascade deletes will handle attendance and custom fields)
         db.session.delete(worker)
+        refresh_attendance_rollup(company_id=company.id, worker_ids=[worker_id])
         db.session.commit()
         
         logging.info(f"Worker {worker_id} deleted successfully from company {company.id}")
@@ -4366,11 +4401,14 @@ def update_worker(worker_id):
         worker.first_name = data.get('first_name', worker.first_name)
         worker.last_name = data.get('last_name', worker.last_name)
         
-        # Update custom fields
+        # Update custom fields, loading the worker's existing values once
+        existing_values = {}
+        for custom_value in WorkerCustomFieldValue.query.filter_by(worker_id=worker.id).order_by(WorkerCustomFieldValue.id):
+            existing_values.setdefault(custom_value.custom_field_id, custom_value)
         for field in import_fields:
             if field.name in data or f'custom_field_{field.id}' in data:
                 field_value = data.get(field.name) or data.get(f'custom_field_{field.id}')
-                custom_value = WorkerCustomFieldValue.query.filter_by(worker_id=worker.id, custom_field_id=field.id).first()
+                custom_value = existing_values.get(field.id)
                 if custom_value:
                     custom_value.value = field_value
                 else:
@@ -4385,6 +4423,73 @@ def update_worker(worker_id):
         db.session.rollback()
         return jsonify({'error': 'Failed to update worker'}), 500
 
+@app.route("/api/worker/<int:worker_id>/history", methods=['GET'])
+@subscription_required
+@feature_required('advanced_reporting')
+def worker_history(worker_id):
+    """One page of a worker's daily attendance and earnings, with running totals"""
+    try:
+        from report_pipeline import build_worker_history
+        
+        company = get_current_company()
+        if not company:
+            return jsonify({'error': 'Company not found'}), 404
+        
+        worker = Worker.query.filter_by(id=worker_id, company_id=company.id).first()
+        if not worker:
+            return jsonify({'error': 'Worker not found'}), 404
+        
+        start_date = request.args.get('start_date')
+        end_date = request.args.get('end_date')
+        order = request.args.get('order', 'desc')
+        cursor = request.args.get('cursor')
+        
+        if order not in ('asc', 'desc'):
+            return jsonify({'error': 'order must be asc or desc'}), 400
+        try:
+            start_date_obj = datetime.strptime(start_date, '%Y-%m-%d').date() if start_date else None
+            end_date_obj = datetime.strptime(end_date, '%Y-%m-%d').date() if end_date else None
+        except ValueError:
+            return jsonify({'error': 'Invalid date format. Use YYYY-MM-DD'}), 400
+        try:
+            limit = min(max(int(request.args.get('limit', 50)), 1), 500)
+        except ValueError:
+            return jsonify({'error': 'limit must be a number'}), 400
+        
+        # The cursor is the (date, task id) of the previous page's last entry
+        after = None
+        if cursor:
+            try:
+                position = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+                if position['order'] != order:
+                    raise ValueError('cursor was issued for a different order')
+                after = (datetime.strptime(position['after'][0], '%Y-%m-%d').date(), int(position['after'][1]))
+            except Exception:
+                return jsonify({'error': 'Invalid cursor'}), 400
+        
+        page = build_worker_history(company, worker.id, start_date_obj, end_date_obj,
+                                    descending=order == 'desc', after=after, limit=limit)
+        
+        next_cursor = None
+        if page['next'] is not None:
+            next_cursor = base64.urlsafe_b64encode(json.dumps({
+                'order': order,
+                **page['next']
+            }).encode()).decode()
+        
+        return jsonify({
+            'worker_id': worker.id,
+            'worker_name': f"{worker.first_name} {worker.last_name}",
+            'order': order,
+            'entries': page['entries'],
+            'next_cursor': next_cursor
+        }), 200
+        
+    except Exception as e:
+        logging.error(f"Error loading history for worker {worker_id}: {str(e)}")
+        logging.error(traceback.format_exc())
+        return jsonify({'error': 'Failed to load worker history'}), 500
+
 @app.route("/api/task/<int:task_id>/attendance", methods=['POST'])
 def update_task_attendance(task_id):
     try:
@@ -4465,6 +4570,7 @@ def update_task_attendance(task_id):
                 created_count += 1
                 logging.info(f"Created new attendance for worker {worker_id}: status={status}, units={units_completed}, hours={hours_worked}")
         
+        refresh_attendance_rollup(company_id=company.id, task_id=task.id, start_date=selected_date, end_date=selected_date)
         db.session.commit()
         
         # Verify the records were actually saved
@@ -4624,6 +4730,8 @@ def add_worker_to_task(task_id):
                 )
                 db.session.add(attendance)
         
+        refresh_attendance_rollup(company_id=company.id, task_id=task.id, worker_ids=[worker_id],
+                                  start_date=start_date, end_date=current_date)
         db.session.commit()
         
         return jsonify({
@@ -4681,6 +4789,7 @@ def bulk_delete_workers():
         # Delete workers (cascade deletes will handle attendance and custom fields)
         for worker in workers:
             db.session.delete(worker)
+        refresh_attendance_rollup(company_id=company.id, worker_ids=[worker.id for worker in workers])
         
         db.session.commit()
         
@@ -4721,6 +4830,7 @@ def delete_all_workers():
         # Delete all workers (cascade deletes will handle attendance and custom fields)
         for worker in workers:
             db.session.delete(worker)
+        refresh_attendance_rollup(company_id=company.id, worker_ids=[worker.id for worker in workers])
         
         db.session.commit()
         
@@ -4759,6 +4869,7 @@ def update_task_date(task_id):
             company_id=company.id, 
             date=task.start_date.date()
         ).delete()
+        refresh_attendance_rollup(company_id=company.id, start_date=task.start_date.date(), end_date=task.start_date.date())
         
         db.session.commit()
         
@@ -4789,6 +4900,7 @@ def manage_task(task_id):
             Attendance.query.filter_by(
                 task_id=task.id
             ).delete()
+            refresh_attendance_rollup(task_id=task.id)
             
             # Delete task
             db.session.delete(task)
@@ -4904,236 +5016,34 @@ def download_report():
         from datetime import datetime
         start_date = datetime.strptime(start_date, '%Y-%m-%d').date()
         end_date = datetime.strptime(end_date, '%Y-%m-%d').date()
-        # Get all workers for the company
-        workers = Worker.query.filter_by(company_id=company.id).all()
-        import_fields = ImportField.query.filter_by(company_id=company.id).all()
-        custom_fields = ReportField.query.filter_by(company_id=company.id).all()
-
         report_type = request.args.get('report_type')
-        # Filter custom fields by report type
-        if report_type == 'per_day':
-            relevant_custom_fields = [f for f in custom_fields if f.payout_type in ('per_day', 'both')]
-        elif report_type == 'per_part':
-            relevant_custom_fields = [f for f in custom_fields if f.payout_type in ('per_part', 'both')]
-        else:
-            relevant_custom_fields = custom_fields  # fallback: include all
-
-        # Helper for formula evaluation
-        def evaluate_formula(formula, context, custom_fields_dict=None, visited=None):
-            if visited is None:
-                visited = set()
-            try:
-                import re
-                eval_formula = formula
-                field_regex = r'[a-zA-Z_][a-zA-Z0-9_]*'
-                field_matches = re.findall(field_regex, eval_formula)
-                for field_name in field_matches:
-                    if field_name in visited:
-                        continue
-                    if field_name in context:
-                        value = context[field_name]
-                    elif custom_fields_dict and field_name in custom_fields_dict:
-                        visited.add(field_name)
-                        custom_field_formula = custom_fields_dict[field_name]
-                        value = evaluate_formula(custom_field_formula, context, custom_fields_dict, visited)
-                        visited.remove(field_name)
-                    else:
-                        value = 0
-                    eval_formula = re.sub(r'\b' + re.escape(field_name) + r'\b', str(value), eval_formula)
-                result = eval(eval_formula)
-                return round(result, 2)
-            except Exception as e:
-                logging.error(f"Error evaluating formula {formula}: {str(e)}")
-                return 0.00
-
-        # Prepare per_day and per_part records
-        per_day_records = []
-        per_part_records = []
-        for worker in workers:
-            attendance_records = Attendance.query.filter(
-                Attendance.worker_id == worker.id,
-                Attendance.company_id == company.id,
-                Attendance.date.between(start_date, end_date)
-            ).all()
-            per_day_attendance = {}
-            per_part_units = {}
-            for att in attendance_records:
-                if att.task and getattr(att.task, 'payment_type', None) == 'per_day':
-                    if att.status == 'Present':
-                        per_day_attendance.setdefault(att.task_id, 0)
-                        per_day_attendance[att.task_id] += 1
-                elif att.task and getattr(att.task, 'payment_type', None) == 'per_part':
-                    if att.units_completed:
-                        per_part_units.setdefault(att.task_id, 0)
-                        per_part_units[att.task_id] += att.units_completed
-            # Only add records if there is actual attendance or units completed in the range
-            if per_day_attendance:
-                for task_id, days in per_day_attendance.items():
-                    task = Task.query.get(task_id) if task_id else None
-                    # Compute age
-                    try:
-                        from datetime import date
-                        if worker.date_of_birth:
-                            today = date.today()
-                            age = today.year - worker.date_of_birth.year - ((today.month, today.day) < (worker.date_of_birth.month, worker.date_of_birth.day))
-                        else:
-                            age = 0
-                    except Exception:
-                        age = 0
-                    row = {
-                        'First Name': getattr(worker, 'first_name', ''),
-                        'Last Name': getattr(worker, 'last_name', ''),
-                        'Task Name': getattr(task, 'name', '') if task else '',
-                        'Attendance Days': days,
-                        'Daily Rate': getattr(company, 'daily_payout_rate', None),
-                        'age': age,
-                    }
-                    for field in import_fields:
-                        custom_value = WorkerCustomFieldValue.query.filter_by(
-                            worker_id=worker.id,
-                            custom_field_id=field.id
-                        ).first()
-                        row[field.name] = custom_value.value if custom_value else 'N/A'
-                    # Only add relevant custom fields
-                    custom_fields_dict = {field.name: field.formula for field in relevant_custom_fields if field.field_type == 'numeric'}
-                    for field in relevant_custom_fields:
-                        if field.field_type == 'numeric':
-                            try:
-                                context = {
-                                    'attendance_days': days,
-                                    'daily_rate': getattr(company, 'daily_payout_rate', None),
-                                    **row
-                                }
-                                result = evaluate_formula(field.formula, context, custom_fields_dict)
-                                if field.max_limit is not None:
-                                    result = min(result, field.max_limit)
-                                row[field.name] = result
-                            except Exception as e:
-                                logging.error(f"Error calculating field {field.name}: {str(e)}")
-                                row[field.name] = 0.00
-                    per_day_records.append(row)
-            if per_part_units:
-                for task_id, units in per_part_units.items():
-                    task = Task.query.get(task_id) if task_id else None
-                    # Compute age
-                    try:
-                        from datetime import date
-                        if worker.date_of_birth:
-                            today = date.today()
-                            age = today.year - worker.date_of_birth.year - ((today.month, today.day) < (worker.date_of_birth.month, worker.date_of_birth.day))
-                        else:
-                            age = 0
-                    except Exception:
-                        age = 0
-                    row = {
-                        'First Name': getattr(worker, 'first_name', ''),
-                        'Last Name': getattr(worker, 'last_name', ''),
-                        'Task Name': getattr(task, 'name', '') if task else '',
-                        'Units Completed': units,
-                        'Per Part Rate': getattr(task, 'per_part_payout', None) if task else None,
-                        'Per Part Currency': getattr(task, 'per_part_currency', None) if task else None,
-                        'age': age,
-                    }
-                    for field in import_fields:
-                        custom_value = WorkerCustomFieldValue.query.filter_by(
-                            worker_id=worker.id,
-                            custom_field_id=field.id
-                        ).first()
-                        row[field.name] = custom_value.value if custom_value else 'N/A'
-                    # Add custom report fields for per_part
-                    per_part_custom_fields = [f for f in custom_fields if f.payout_type in ('per_part', 'both')]
-                    custom_fields_dict = {field.name: field.formula for field in per_part_custom_fields if field.field_type == 'numeric'}
-                    for field in per_part_custom_fields:
-                        if field.field_type == 'numeric':
-                            try:
-                                context = {
-                                    'units_completed': units,
-                                    'per_part_rate': row['Per Part Rate'],
-                                    **row
-                                }
-                                result = evaluate_formula(field.formula, context, custom_fields_dict)
-                                if field.max_limit is not None:
-                                    result = min(result, field.max_limit)
-                                row[field.name] = result
-                            except Exception as e:
-                                logging.error(f"Error calculating field {field.name}: {str(e)}")
-                                row[field.name] = 0.00
-                    per_part_records.append(row)
-        # Create Excel file with two sheets
-        import pandas as pd
-        import io
-        output = io.BytesIO()
+        queued = _queued_xlsx_response(company, 'workbook', report_type, start_date, end_date,
+                                       workbook_payment_types(report_type))
+        if queued is not None:
+            return queued
+        # Per Day and Per Part sheets come from a single attendance scan, or a chunk of workers at a time
+        report = workbook_records(company, start_date, end_date, report_type)
+        first_per_day, report['per_day'] = peek_records(report.get('per_day', ()))
+        first_per_part, report['per_part'] = peek_records(report.get('per_part', ()))
         # Check for empty report
-        if (report_type == 'per_day' and len(per_day_records) == 0) or (report_type == 'per_part' and len(per_part_records) == 0) or (not report_type and len(per_day_records) == 0 and len(per_part_records) == 0):
+        if (report_type == 'per_day' and first_per_day is None) or (report_type == 'per_part' and first_per_part is None) or (not report_type and first_per_day is None and first_per_part is None):
             return jsonify({'error': "This report is empty. Are you sure you've selected the correct date range?"}), 400
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            if report_type == 'per_day':
-                df_day = pd.DataFrame(per_day_records)
-                # Only include relevant columns (base + import fields + relevant custom fields)
-                if per_day_records:
-                    base_cols = ['First Name', 'Last Name', 'Task Name', 'Attendance Days', 'Daily Rate']
-                    import_cols = [f.name for f in import_fields]
-                    custom_cols = [f.name for f in relevant_custom_fields if f.payout_type in ('per_day', 'both')]
-                    cols = base_cols + import_cols + custom_cols
-                    df_day = df_day.loc[:, [c for c in cols if c in df_day.columns]]
-                df_day.to_excel(writer, index=False, sheet_name='Per Day')
-            elif report_type == 'per_part':
-                df_part = pd.DataFrame(per_part_records)
-                if per_part_records:
-                    base_cols = ['First Name', 'Last Name', 'Task Name', 'Units Completed', 'Per Part Rate', 'Per Part Currency']
-                    import_cols = [f.name for f in import_fields]
-                    custom_cols = [f.name for f in relevant_custom_fields if f.payout_type in ('per_part', 'both')]
-                    cols = base_cols + import_cols + custom_cols
-                    df_part = df_part.loc[:, [c for c in cols if c in df_part.columns]]
-                df_part.to_excel(writer, index=False, sheet_name='Per Part')
-            else:
-                # Both sheets, include all relevant fields
-                df_day = pd.DataFrame(per_day_records)
-                df_part = pd.DataFrame(per_part_records)
-                df_day.to_excel(writer, index=False, sheet_name='Per Day')
-                df_part.to_excel(writer, index=False, sheet_name='Per Part')
+        # Write-only workbook spooled to disk, rows projected as they are written
+        import tempfile
+        output = tempfile.TemporaryFile()
+        render_xlsx(output, workbook_sheets(report, report_type))
         output.seek(0)
         from flask import send_file
         from datetime import datetime as dt
         return send_file(
             output,
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+            mimetype=XLSX_MIMETYPE,
             as_attachment=True,
             download_name=f'report_{dt.now().strftime("%Y%m%d")}.xlsx'
         )
     except Exception as e:
         logging.error(f"Error generating report: {str(e)}")
         return jsonify({'error': f"Failed to generate report: {str(e)}"}), 500
-        # Calculate attendance days for each worker
-        worker_attendance = {}
-        attendance_records = Attendance.query.filter(
-            Attendance.company_id == company.id,
-            Attendance.date.between(start_date, end_date),
-            Attendance.status == 'Present'
-        ).all()
-        
-        for record in attendance_records:
-            worker_attendance[record.worker_id] = worker_attendance.get(record.worker_id, 0) + 1
-        
-        # Modify preview records to include attendance days
-        # Get custom fields for formula builder
-        custom_fields_for_formulas = ReportField.query.filter_by(company_id=company.id).all()
-        
-        preview_records = []
-        recent_attendance = Attendance.query.filter(
-            Attendance.company_id == company.id,
-            Attendance.date.between(start_date, end_date)
-        ).order_by(Attendance.date.desc()).limit(5).all()
-        
-        for record in recent_attendance:
-            preview_records.append({
-                'worker_name': f"{record.worker.first_name} {record.worker.last_name}",
-                'task_name': record.task.name,
-                'date': record.date.strftime('%Y-%m-%d'),
-                'status': record.status,
-                'daily_rate': company.daily_payout_rate,
-                'attendance_days': worker_attendance.get(record.worker.id, 0)
-            })
 
 @app.route("/api/report-field/<int:field_id>", methods=['GET'])
 @subscription_required
@@ -5208,6 +5118,14 @@ def manage_report_field():
             logging.info(f"PUT /api/report-field: field_id={field_id}, checking for duplicate name={data['name']}, duplicate={duplicate}")
             if duplicate:
                 return jsonify({'error': 'A custom field with this name already exists.'}), 400
+            try:
+                validate_formula(data['formula'])
+                check_field_cycles(
+                    [(f.name, f.formula) for f in ReportField.query.filter_by(company_id=company.id).all() if f.id != field.id] +
+                    [(data['name'], data['formula'])]
+                )
+            except FormulaError as e:
+                return jsonify({'error': f'Invalid formula: {str(e)}'}), 400
             field.name = data['name']
             field.formula = data['formula']
             field.max_limit = data.get('max_limit')
@@ -5229,6 +5147,16 @@ def manage_report_field():
             logging.warning(f"Duplicate field name detected: {data['name']}")
             return jsonify({'error': 'A custom field with this name already exists.'}), 400
         
+        try:
+            validate_formula(data['formula'])
+            check_field_cycles(
+                [(f.name, f.formula) for f in ReportField.query.filter_by(company_id=company.id).all()] +
+                [(data['name'], data['formula'])]
+            )
+        except FormulaError as e:
+            logging.warning(f"Invalid formula for field {data['name']}: {str(e)}")
+            return jsonify({'error': f'Invalid formula: {str(e)}'}), 400
+        
         new_field = ReportField(
             company_id=company.id,
             name=data['name'],
@@ -5319,6 +5247,8 @@ def task_units_completed_route(task_id):
                     task_id=task.id
                 )
                 db.session.add(new_attendance)
+        if db.session.new:
+            refresh_attendance_rollup(company_id=company.id, task_id=task.id, start_date=selected_date, end_date=selected_date)
         db.session.commit()
 
         # Fetch attendance records again to ensure up-to-date list
@@ -5395,6 +5325,8 @@ def task_hours_worked_route(task_id):
                     hours_worked=0
                 )
                 db.session.add(new_attendance)
+        if db.session.new:
+            refresh_attendance_rollup(company_id=company.id, task_id=task.id, start_date=selected_date, end_date=selected_date)
         db.session.commit()
 
         # Fetch attendance records again to ensure up-to-date list
@@ -5422,7 +5354,6 @@ def master_dashboard_route():
     """Master Admin Dashboard - Enhanced Platform Overview with Marketing Insights"""
     try:
         from datetime import datetime, timedelta
-        from sqlalchemy import case, and_
         
         # Time periods for calculations
         seven_days_ago = datetime.utcnow() - timedelta(days=7)
@@ -5500,11 +5431,12 @@ def master_dashboard_route():
                 ).count()
                 
                 # Get attendance data
-                total_attendance_days = Attendance.query.filter(
-                    Attendance.company_id == company.id,
-                    Attendance.date >= current_month_start,
-                    Attendance.status == 'Present'
-                ).count()
+                total_attendance_days = db.session.query(
+                    func.coalesce(func.sum(AttendanceDailyRollup.present_rows), 0)
+                ).filter(
+                    AttendanceDailyRollup.company_id == company.id,
+                    AttendanceDailyRollup.date >= current_month_start
+                ).scalar()
             else:
                 worker_count = 0
                 workers_this_month = 0
@@ -5745,15 +5677,13 @@ def master_dashboard_route():
             Task.created_at,
             Company.name.label('company_name'),
             Workspace.name.label('workspace_name'),
-            func.count(func.distinct(Attendance.worker_id)).label('unique_workers'),
-            func.count(Attendance.id).label('total_attendance'),
-            func.avg(case(
-                (Attendance.units_completed.isnot(None), Attendance.units_completed),
-                else_=0
-            )).label('avg_units_completed')
+            func.count(func.distinct(AttendanceDailyRollup.worker_id)).label('unique_workers'),
+            func.coalesce(func.sum(AttendanceDailyRollup.attendance_rows), 0).label('total_attendance'),
+            (func.sum(AttendanceDailyRollup.units) * 1.0 /
+             func.nullif(func.sum(AttendanceDailyRollup.attendance_rows), 0)).label('avg_units_completed')
         ).join(Company, Task.company_id == Company.id)\
          .join(Workspace, Company.workspace_id == Workspace.id)\
-         .outerjoin(Attendance, Task.id == Attendance.task_id)\
+         .outerjoin(AttendanceDailyRollup, Task.id == AttendanceDailyRollup.task_id)\
          .group_by(Task.id, Task.name, Task.payment_type, Task.status, Task.created_at, Company.name, Workspace.name)\
          .order_by(desc('unique_workers'), desc('total_attendance'))\
          .limit(20).all()
@@ -5831,8 +5761,8 @@ def master_dashboard_route():
             
             # Get worker engagement for tasks created in this month
             worker_engagement = db.session.query(
-                func.count(func.distinct(Attendance.worker_id))
-            ).join(Task, Attendance.task_id == Task.id)\
+                func.count(func.distinct(AttendanceDailyRollup.worker_id))
+            ).join(Task, AttendanceDailyRollup.task_id == Task.id)\
              .filter(
                 Task.created_at >= month_start,
                 Task.created_at < month_end
@@ -6046,9 +5976,13 @@ def delete_workspace_route(workspace_id):
         if not workspace:
             return jsonify({'error': 'Workspace not found'}), 404
         
+        company_ids = [company.id for company in Company.query.filter_by(workspace_id=workspace.id).all()]
+        
         # With proper cascade relationships, we can simply delete the workspace
         # and all related data will be automatically deleted
         db.session.delete(workspace)
+        for company_id in company_ids:
+            refresh_attendance_rollup(company_id=company_id)
         db.session.commit()
         
         return jsonify({'success': True})
@@ -6065,6 +5999,7 @@ def delete_worker_route(worker_id):
         if not worker:
             return jsonify({'error': 'Worker not found'}), 404
         db.session.delete(worker)
+        refresh_attendance_rollup(company_id=worker.company_id, worker_ids=[worker_id])
         db.session.commit()
         return jsonify({'success': True})
     except Exception as e:
@@ -0,0 +1,92 @@
+"""Shared fixtures: an in-memory SQLite app and a small company to report on"""
+
+from datetime import date, datetime
+
+import pytest
+from flask import Flask
+
+from models import db, Attendance, Company, ImportField, ReportField, Task, User, Worker, WorkerCustomFieldValue, Workspace
+import attendance_changes  # noqa: F401 - registers the tombstone session events
+import report_cache  # noqa: F401 - registers the report data version session events
+
+
+@pytest.fixture
+def app():
+    app = Flask(__name__)
+    app.config.update(TESTING=True, SQLALCHEMY_DATABASE_URI='sqlite://')
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        report_cache.report_cache.clear()
+        yield app
+        db.session.remove()
+        db.drop_all()
+
+
+class CompanyFactory:
+    """Adds workers, tasks, fields and attendance to one company"""
+
+    def __init__(self, company):
+        self.company = company
+
+    def worker(self, first_name, last_name='', date_of_birth=None, **values):
+        worker = Worker(first_name=first_name, last_name=last_name, date_of_birth=date_of_birth,
+                        company_id=self.company.id)
+        db.session.add(worker)
+        db.session.flush()
+        for field_name, value in values.items():
+            field = ImportField.query.filter_by(company_id=self.company.id, name=field_name).one()
+            db.session.add(WorkerCustomFieldValue(worker_id=worker.id, custom_field_id=field.id, value=value))
+        return worker
+
+    def task(self, name, payment_type, start_date=datetime(2026, 9, 1), **payouts):
+        task = Task(name=name, payment_type=payment_type, start_date=start_date, company_id=self.company.id,
+                    **payouts)
+        db.session.add(task)
+        db.session.flush()
+        return task
+
+    def import_field(self, name):
+        field = ImportField(company_id=self.company.id, name=name)
+        db.session.add(field)
+        db.session.flush()
+        return field
+
+    def report_field(self, name, formula, payout_type='per_day', field_type='numeric', max_limit=None):
+        field = ReportField(company_id=self.company.id, name=name, formula=formula, payout_type=payout_type,
+                            field_type=field_type, max_limit=max_limit)
+        db.session.add(field)
+        db.session.flush()
+        return field
+
+    def attendance(self, worker, task, day, status='Present', units=None, hours=None):
+        attendance = Attendance(worker_id=worker.id, task_id=task.id, company_id=self.company.id,
+                                date=date(2026, 9, day), status=status, units_completed=units,
+                                hours_worked=hours)
+        db.session.add(attendance)
+        return attendance
+
+    def refresh(self):
+        """Rebuild the company's rollup and commit, as the attendance routes do"""
+        from attendance_rollup import refresh_attendance_rollup
+
+        refresh_attendance_rollup(company_id=self.company.id)
+        db.session.commit()
+
+
+@pytest.fixture
+def factory(app):
+    user = User(email='owner@example.com')
+    db.session.add(user)
+    db.session.flush()
+    workspace = Workspace(name='Farm', workspace_code='FARM0001', country='ZM', industry_type='Agriculture',
+                          company_phone='1', company_email='owner@example.com', expected_workers_string='1-10',
+                          created_by=user.id)
+    db.session.add(workspace)
+    db.session.flush()
+    company = Company(name='Farm Ltd', registration_number='R1', address='Lusaka', industry='Agriculture',
+                      created_by=user.id, workspace_id=workspace.id, phone='1', daily_payout_rate=56.0,
+                      currency='ZMW')
+    db.session.add(company)
+    db.session.commit()
+    return CompanyFactory(company)
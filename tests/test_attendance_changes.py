@@ -0,0 +1,74 @@
+"""Tests for attendance change tracking behind delta report exports"""
+
+from datetime import date, datetime, timedelta
+
+from flask.cli import ScriptInfo
+
+from attendance_changes import purge_attendance_tombstones
+from commands import attendance_cli
+from models import db, Attendance, AttendanceTombstone
+from report_pipeline import build_report_delta
+
+START, END = date(2026, 9, 1), date(2026, 9, 30)
+
+
+def test_delta_returns_changed_and_deleted_pairs(factory):
+    ann, ben, cat = factory.worker('Ann'), factory.worker('Ben'), factory.worker('Cat')
+    dig = factory.task('Dig', 'per_day', per_day_payout=60.0)
+    edited = factory.attendance(ann, dig, 1)
+    deleted = factory.attendance(ben, dig, 1)
+    factory.attendance(cat, dig, 1)
+    factory.refresh()
+    since = datetime.utcnow()
+
+    factory.attendance(ann, dig, 2)
+    edited.status = 'Absent'
+    db.session.delete(deleted)
+    factory.refresh()
+    report, removed = build_report_delta(factory.company, START, END, 'per_day', since)
+
+    assert [(record['worker_id'], record['attendance_days']) for record in report['per_day']] == [(ann.id, 1)]
+    assert removed == [(ben.id, dig.id)]
+
+
+def test_bulk_deletes_are_tombstoned(factory):
+    ann = factory.worker('Ann')
+    dig = factory.task('Dig', 'per_day')
+    factory.attendance(ann, dig, 1)
+    factory.refresh()
+    since = datetime.utcnow()
+
+    Attendance.query.filter_by(worker_id=ann.id).delete()
+    factory.refresh()
+
+    assert build_report_delta(factory.company, START, END, 'per_day', since) == (
+        {'import_fields': [], 'custom_fields': [], 'per_day': []}, [(ann.id, dig.id)]
+    )
+
+
+def _tombstone(factory, age_days):
+    db.session.add(AttendanceTombstone(company_id=factory.company.id, worker_id=1, task_id=1, date=START,
+                                       deleted_at=datetime.utcnow() - timedelta(days=age_days)))
+    db.session.commit()
+
+
+def test_purge_keeps_tombstones_a_usable_watermark_needs(factory):
+    _tombstone(factory, 100)
+    _tombstone(factory, 10)
+
+    assert purge_attendance_tombstones(retention_days=30) == 1
+    db.session.commit()
+    assert [tombstone.deleted_at.date() for tombstone in AttendanceTombstone.query] == [
+        (datetime.utcnow() - timedelta(days=10)).date()
+    ]
+
+
+def test_purge_command(app, factory):
+    _tombstone(factory, 100)
+
+    result = app.test_cli_runner().invoke(attendance_cli, ['purge-tombstones', '--retention-days', '30'],
+                                          obj=ScriptInfo(create_app=lambda: app))
+
+    assert result.exit_code == 0, result.output
+    assert 'Purged 1 attendance tombstones' in result.output
+    assert AttendanceTombstone.query.count() == 0
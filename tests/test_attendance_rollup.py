@@ -0,0 +1,45 @@
+"""Tests for the daily attendance rollup and its rebuild command"""
+
+from datetime import date
+
+from flask.cli import ScriptInfo
+
+from commands import rollup_cli
+from models import db, AttendanceDailyRollup, Company
+from report_engine import count_present_days, scan_attendance
+
+SEPTEMBER = (date(2026, 9, 1), date(2026, 9, 30))
+
+
+def test_several_rows_on_one_day_are_all_counted(factory):
+    worker = factory.worker('Ann')
+    dig = factory.task('Dig', 'per_day', per_day_payout=60.0)
+    pack = factory.task('Pack', 'per_part', per_part_payout=2.5)
+    factory.attendance(worker, dig, 1)
+    factory.attendance(worker, dig, 1)
+    factory.attendance(worker, dig, 1, status='Absent')
+    factory.attendance(worker, pack, 2, units=3)
+    factory.attendance(worker, pack, 2, status='Absent', units=4)
+    factory.refresh()
+
+    day = db.session.get(AttendanceDailyRollup, (factory.company.id, dig.id, worker.id, date(2026, 9, 1)))
+    assert (day.present, day.attendance_rows, day.present_rows) == (True, 3, 2)
+
+    buckets = scan_attendance(factory.company.id, *SEPTEMBER)
+    assert [(task.name, quantity) for _, task, quantity in buckets['per_day']] == [('Dig', 2)]
+    assert [(task.name, quantity) for _, task, quantity in buckets['per_part']] == [('Pack', 7)]
+    assert count_present_days(factory.company.id, *SEPTEMBER, [worker.id]) == {worker.id: 3}
+
+
+def test_rebuild_bumps_the_report_data_version(app, factory):
+    worker = factory.worker('Ann')
+    dig = factory.task('Dig', 'per_day')
+    factory.attendance(worker, dig, 1)
+    factory.refresh()
+    version = factory.company.report_data_version
+
+    result = app.test_cli_runner().invoke(rollup_cli, ['rebuild'], obj=ScriptInfo(create_app=lambda: app))
+
+    assert result.exit_code == 0, result.output
+    db.session.expire_all()
+    assert db.session.get(Company, factory.company.id).report_data_version == version + 1
@@ -0,0 +1,117 @@
+"""Tests for compiling and ordering report field formulas"""
+
+from types import SimpleNamespace
+
+import pytest
+
+from formula_engine import (
+    MAX_EXPONENT, FormulaCycleError, FormulaError, check_field_cycles, compile_formula, resolve_field_order,
+    validate_formula
+)
+from report_pipeline import _apply_custom_fields, _apply_custom_fields_vectorized, order_fields
+
+
+def _evaluate(formula, **values):
+    return compile_formula(formula)(lambda name: values[name])
+
+
+@pytest.mark.parametrize('formula', [
+    "__import__('os').system('true')",
+    'units.__class__',
+    'rate[0]',
+    '[units]',
+    'lambda: 1',
+    "'text'",
+    'True',
+    'units << 2',
+    'units in rate',
+    'pow(units, 2)',
+    'round(units, ndigits=2)',
+    '(x := 1)',
+])
+def test_syntax_outside_the_whitelist_is_rejected(formula):
+    with pytest.raises(FormulaError):
+        validate_formula(formula)
+
+
+def test_whitelisted_syntax_evaluates():
+    formula = 'max(units, 2) * rate if units > 0 and not rate < 0 else -abs(round(rate / 3, 1)) % 7'
+
+    assert _evaluate(formula, units=3, rate='2.5') == 7.5
+    assert _evaluate(formula, units=0, rate=4) == pytest.approx(-1.3 % 7)
+
+
+def test_exponents_are_capped():
+    assert _evaluate(f'units ** {MAX_EXPONENT}', units=1) == 1
+    with pytest.raises(FormulaError, match='too large'):
+        _evaluate(f'units ** {MAX_EXPONENT + 1}', units=1)
+    with pytest.raises(FormulaError, match='too large'):
+        _evaluate('9 ** 9 ** 9')
+
+
+def test_non_numeric_values_are_errors():
+    with pytest.raises(FormulaError, match='not a number'):
+        _evaluate('units * 2', units='N/A')
+    with pytest.raises(FormulaError, match='not a number'):
+        _evaluate('units * 2', units=None)
+
+
+def _field(field_id, name, formula, max_limit=None, field_type='numeric'):
+    return SimpleNamespace(id=field_id, name=name, formula=formula, max_limit=max_limit, field_type=field_type)
+
+
+def test_column_evaluation_matches_row_evaluation():
+    fields = [
+        _field(901, 'Pay', 'units * rate'),
+        _field(902, 'Share', 'units / rate'),
+        _field(903, 'Bonus', 'max(Pay, 10) if units > 2 and rate else -rate', max_limit=40),
+        _field(904, 'Rounded', 'round(Pay / 3, 1) + abs(Share)'),
+        _field(905, 'Square', 'units ** 2 - Bonus'),
+        _field(906, 'Huge', 'rate ** 200'),
+        _field(907, 'Note', '', field_type='text'),
+    ]
+    ordered, cyclic = order_fields(fields)
+    values = [(4, 2.5), ('3', '1.5'), (0, 0), (None, 2), ('N/A', 3), (7, None), (2.25, -1), ('1e1', 0.5)]
+    rows = [{'units': units, 'rate': rate} for units, rate in values]
+    by_row = [dict(row) for row in rows]
+    by_column = [dict(row) for row in rows]
+
+    for record in by_row:
+        _apply_custom_fields(record, fields, ordered, cyclic)
+    _apply_custom_fields_vectorized(by_column, fields, ordered, cyclic)
+
+    assert by_column == by_row
+    assert [record['Pay'] for record in by_row] == [10.0, 4.5, 0, 0.0, 0.0, 0.0, -2.25, 5.0]
+
+
+def test_fields_follow_the_fields_they_use():
+    order, cycles = resolve_field_order((
+        ('Net', 'Gross - Tax'),
+        ('Tax', 'Gross * 0.1'),
+        ('Gross', 'units * rate'),
+        ('Note', 'not a formula ('),
+    ))
+
+    assert cycles == ()
+    assert set(order) == {'Net', 'Tax', 'Gross', 'Note'}
+    assert order.index('Gross') < order.index('Tax') < order.index('Net')
+    check_field_cycles((('Gross', 'units * rate'), ('Net', 'Gross * 0.9')))
+
+
+def test_cycles_are_reported():
+    definitions = (
+        ('A', 'B + 1'),
+        ('B', 'C * 2'),
+        ('C', 'A - 1'),
+        ('Self', 'Self + 1'),
+        ('Fine', 'units * 2'),
+        ('After', 'A + Fine'),
+    )
+
+    order, cycles = resolve_field_order(definitions)
+
+    assert sorted(sorted(cycle) for cycle in cycles) == [['A', 'B', 'C'], ['Self']]
+    assert order.index('Fine') < order.index('After') and order.index('A') < order.index('After')
+    with pytest.raises(FormulaCycleError) as error:
+        check_field_cycles(definitions)
+    assert set(error.value.cycle) in ({'A', 'B', 'C'}, {'Self'})
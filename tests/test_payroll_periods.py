@@ -0,0 +1,46 @@
+"""Tests for closing payroll periods"""
+
+from datetime import date
+
+import pytest
+
+from models import db
+from payroll_periods import close_payroll_period
+from report_pipeline import workbook_records, workbook_sheets
+
+START, END = date(2026, 9, 1), date(2026, 9, 30)
+
+
+@pytest.fixture
+def attendance(factory):
+    ann = factory.worker('Ann')
+    dig = factory.task('Dig', 'per_day', per_day_payout=60.0, per_day_currency='ZMW')
+    pack = factory.task('Pack', 'per_part', per_part_payout=2.5, per_part_currency='ZMW')
+    factory.report_field('Bonus', 'attendance_days * 2')
+    factory.report_field('Piece Bonus', 'units_completed * 3', payout_type='per_part')
+    factory.attendance(ann, dig, 1)
+    factory.attendance(ann, dig, 2)
+    factory.attendance(ann, pack, 1, units=4)
+    factory.refresh()
+    return factory
+
+
+def _workbook(company, report_type):
+    report = workbook_records(company, START, END, report_type)
+    return [(title, headers, list(rows))
+            for title, headers, rows in workbook_sheets(report, report_type)]
+
+
+@pytest.mark.parametrize('report_type', [None, 'per_day', 'per_part'])
+def test_closing_a_period_keeps_its_workbook(attendance, report_type):
+    before = _workbook(attendance.company, report_type)
+
+    close_payroll_period(attendance.company, START, END)
+    db.session.commit()
+
+    assert _workbook(attendance.company, report_type) == before
+    if report_type is None:
+        per_day_headers = before[0][1]
+        # The default Per Day sheet carries every numeric field, at the company's rate
+        assert 'Piece Bonus' in per_day_headers
+        assert before[0][2][0]['Daily Rate'] == 56.0
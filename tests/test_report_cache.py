@@ -0,0 +1,111 @@
+"""Tests that ORM writes to report inputs invalidate cached reports"""
+
+from datetime import date
+
+import pytest
+from sqlalchemy import delete, update
+
+from models import db, Attendance, Company, ImportField, ReportField, Task, Worker, WorkerCustomFieldValue
+from report_cache import report_cache
+from report_pipeline import build_report_records
+
+START, END = date(2026, 9, 1), date(2026, 9, 30)
+
+
+@pytest.fixture
+def company(factory):
+    factory.import_field('NRC')
+    worker = factory.worker('Ann', NRC='111/22/1')
+    dig = factory.task('Dig', 'per_day', per_day_payout=60.0)
+    factory.report_field('Day Pay', 'attendance_days * daily_rate')
+    factory.attendance(worker, dig, 1)
+    factory.refresh()
+    return factory.company
+
+
+def _build(company):
+    return build_report_records(company, START, END, payment_types=('per_day',))
+
+
+def _one(model):
+    return model.query.one()
+
+
+def _edit_attendance():
+    _one(Attendance).status = 'Absent'
+
+
+def _add_attendance():
+    db.session.add(Attendance(worker_id=_one(Worker).id, task_id=_one(Task).id, company_id=_one(Company).id,
+                              date=date(2026, 9, 2), status='Present'))
+
+
+def _edit_task():
+    _one(Task).per_day_payout = 70.0
+
+
+def _edit_worker():
+    _one(Worker).first_name = 'Anne'
+
+
+def _add_import_field():
+    db.session.add(ImportField(company_id=_one(Company).id, name='Phone'))
+
+
+def _edit_report_field():
+    _one(ReportField).formula = 'attendance_days * 2'
+
+
+def _edit_import_value():
+    _one(WorkerCustomFieldValue).value = '999/99/1'
+
+
+def _delete_import_value():
+    db.session.delete(_one(WorkerCustomFieldValue))
+
+
+def _change_daily_rate():
+    _one(Company).daily_payout_rate = 70.0
+
+
+def _bulk_update_attendance():
+    db.session.execute(update(Attendance).where(Attendance.task_id == _one(Task).id).values(status='Absent'))
+
+
+def _bulk_delete_attendance():
+    db.session.execute(delete(Attendance).where(Attendance.company_id == _one(Company).id))
+
+
+def _bulk_update_import_values():
+    db.session.execute(update(WorkerCustomFieldValue).values(value='999/99/1'))
+
+
+@pytest.mark.parametrize('write', [
+    _edit_attendance, _add_attendance, _edit_task, _edit_worker, _add_import_field, _edit_report_field,
+    _edit_import_value, _delete_import_value, _change_daily_rate, _bulk_update_attendance,
+    _bulk_delete_attendance, _bulk_update_import_values
+])
+def test_writes_to_report_inputs_miss_the_cache(company, write):
+    _build(company)
+    before = report_cache.stats()
+    _build(company)
+    assert report_cache.stats()['hits'] == before['hits'] + 1
+    before = report_cache.stats()
+
+    write()
+    db.session.commit()
+    _build(company)
+
+    after = report_cache.stats()
+    assert (after['hits'], after['misses']) == (before['hits'], before['misses'] + 1)
+
+
+def test_unrelated_company_writes_keep_the_cache(company):
+    _build(company)
+    _one(Company).name = 'Farm Holdings'
+    db.session.commit()
+    before = report_cache.stats()
+
+    _build(company)
+
+    assert report_cache.stats()['hits'] == before['hits'] + 1
@@ -0,0 +1,108 @@
+"""Tests that the grouped report engine matches the per-worker report loop it replaced"""
+
+from datetime import date, datetime
+
+import pytest
+
+from models import Attendance, ImportField, ReportField, Worker, WorkerCustomFieldValue
+from report_pipeline import QUANTITY_KEYS, RATE_KEYS, build_report_records, fields_for_payout_type
+
+START, END = date(2026, 9, 1), date(2026, 9, 30)
+
+BASELINE_RATES = {
+    'per_day': ('attendance_days', 'daily_rate'),
+    'per_part': ('units_completed', 'per_part_rate'),
+    'per_hour': ('hours_worked', 'per_hour_rate')
+}
+
+
+def baseline_rows(company, payout_type):
+    """
+    The generate_per_*_report loop from routes.py before the engine: one
+    attendance query per worker, grouped by task in Python, formulas
+    evaluated by substituting the quantity and rate into the expression.
+    """
+    quantity_key, rate_key = BASELINE_RATES[payout_type]
+    custom_fields = ReportField.query.filter_by(company_id=company.id).all()
+    rows = []
+    for worker in Worker.query.filter_by(company_id=company.id).all():
+        query = Attendance.query.filter(Attendance.worker_id == worker.id, Attendance.company_id == company.id,
+                                        Attendance.date.between(START, END))
+        if payout_type == 'per_day':
+            query = query.filter(Attendance.status == 'Present')
+        tasks = {}
+        for att in query.all():
+            if att.task.payment_type != payout_type or att.task.start_date.date() > END:
+                continue
+            bucket = tasks.setdefault(att.task.id, {'task': att.task, 'quantity': 0})
+            if payout_type == 'per_day':
+                bucket['quantity'] += 1
+            elif payout_type == 'per_part':
+                bucket['quantity'] += att.units_completed or 0
+            else:
+                bucket['quantity'] += att.hours_worked or 0
+        for bucket in tasks.values():
+            task, quantity = bucket['task'], bucket['quantity']
+            rate = getattr(task, f'{payout_type}_payout')
+            if payout_type == 'per_day':
+                rate = rate or company.daily_payout_rate
+            values = {}
+            for field in ImportField.query.filter_by(company_id=company.id).all():
+                value = WorkerCustomFieldValue.query.filter_by(worker_id=worker.id, custom_field_id=field.id).first()
+                values[field.name] = value.value if value else None
+            for field in fields_for_payout_type(custom_fields, payout_type):
+                formula = field.formula.replace(quantity_key, str(quantity)).replace(rate_key, str(rate or 0))
+                values[field.name] = eval(formula)
+            rows.append((worker.first_name, worker.last_name, task.name, quantity, rate,
+                         getattr(task, f'{payout_type}_currency'), values))
+    return sorted(rows, key=repr)
+
+
+def engine_rows(company, payout_type):
+    report = build_report_records(company, START, END, payment_types=(payout_type,), use_cache=False)
+    rate_key, currency_key = RATE_KEYS[payout_type]
+    names = [field.name for field in report['import_fields']]
+    names += [field.name for field in fields_for_payout_type(report['custom_fields'], payout_type)]
+    rows = []
+    for record in report[payout_type]:
+        values = {name: record[name] for name in names}
+        # A missing import value is written as a placeholder; compare it as missing
+        values.update({field.name: None for field in report['import_fields'] if values[field.name] in ('', 'N/A')})
+        rows.append((record['first_name'], record['last_name'], record['task_name'],
+                     record[QUANTITY_KEYS[payout_type]], record[rate_key], record[currency_key], values))
+    return sorted(rows, key=repr)
+
+
+@pytest.fixture
+def company(factory):
+    factory.import_field('NRC')
+    ann = factory.worker('Ann', 'Banda', NRC='111/22/1')
+    ben = factory.worker('Ben', 'Phiri')
+    factory.worker('Cat', 'Mwale', NRC='333/44/1')
+    dig = factory.task('Dig', 'per_day', per_day_payout=60.0, per_day_currency='ZMW')
+    weed = factory.task('Weed', 'per_day', per_day_currency='USD')
+    pack = factory.task('Pack', 'per_part', per_part_payout=2.5, per_part_currency='ZMW')
+    drive = factory.task('Drive', 'per_hour', per_hour_payout=10.0, per_hour_currency='USD')
+    late = factory.task('Late', 'per_part', start_date=datetime(2026, 12, 1), per_part_payout=1.0)
+    factory.report_field('Day Pay', 'attendance_days * daily_rate')
+    factory.report_field('Piece Pay', 'units_completed * per_part_rate + 1', payout_type='per_part')
+    factory.report_field('Hour Pay', 'hours_worked * per_hour_rate', payout_type='per_hour')
+    for day in (1, 2, 3):
+        factory.attendance(ann, dig, day)
+        factory.attendance(ben, weed, day, status='Absent' if day == 2 else 'Present')
+        factory.attendance(ann, pack, day, units=day * 4)
+        factory.attendance(ben, drive, day, hours=2.5)
+    factory.attendance(ann, dig, 1)
+    factory.attendance(ben, pack, 4, units=0)
+    factory.attendance(ann, drive, 5, status='Absent', hours=1.0)
+    factory.attendance(ben, late, 5, units=9)
+    factory.refresh()
+    return factory.company
+
+
+@pytest.mark.parametrize('payout_type', ['per_day', 'per_part', 'per_hour'])
+def test_engine_matches_the_per_worker_loop(company, payout_type):
+    expected = baseline_rows(company, payout_type)
+
+    assert expected
+    assert engine_rows(company, payout_type) == expected
@@ -0,0 +1,73 @@
+"""Tests for the typed Parquet/Arrow report export"""
+
+from datetime import date
+import io
+
+import pytest
+
+pa = pytest.importorskip('pyarrow')
+
+from report_export import write_columnar, write_columnar_report
+
+COLUMNS = [('first_name', 'string'), ('hours_worked', 'float'), ('currency', 'currency')]
+ROWS = [
+    {'first_name': 'Ann', 'hours_worked': 8, 'currency': 'USD'},
+    {'first_name': 'Ben', 'hours_worked': 4.5, 'currency': 'EUR'},
+    {'first_name': 'Cal', 'hours_worked': 6, 'currency': None},
+    {'first_name': 'Dee', 'hours_worked': 2, 'currency': 'GBP'},
+]
+
+
+def _read(data, format_type):
+    if format_type == 'parquet':
+        import pyarrow.parquet as pq
+        return pq.read_table(io.BytesIO(data))
+    return pa.ipc.open_file(io.BytesIO(data)).read_all()
+
+
+@pytest.mark.parametrize('format_type', ['parquet', 'arrow'])
+def test_currency_outside_given_list_is_added_to_the_dictionary(format_type):
+    # One row per batch, so the unknown codes arrive after the first batch is written
+    output = io.BytesIO()
+    write_columnar(output, iter(ROWS), COLUMNS, format_type, dictionaries={'currency': ['USD']}, batch_rows=1)
+
+    table = _read(output.getvalue(), format_type)
+    assert table.column('currency').to_pylist() == ['USD', 'EUR', None, 'GBP']
+    assert pa.types.is_dictionary(table.schema.field('currency').type)
+
+
+@pytest.mark.parametrize('format_type', ['parquet', 'arrow'])
+def test_report_export_with_unknown_currency(format_type):
+    output = io.BytesIO()
+    write_columnar_report(output, iter(ROWS), COLUMNS, format_type, 'per_hour',
+                          date(2026, 9, 1), date(2026, 9, 30), currencies=['USD'])
+
+    table = _read(output.getvalue(), format_type)
+    assert table.column('currency').to_pylist() == ['USD', 'EUR', None, 'GBP']
+    assert table.column('period_end').to_pylist() == [date(2026, 9, 30)] * 4
+
+
+def _cells(data):
+    from openpyxl import load_workbook
+    workbook = load_workbook(io.BytesIO(data))
+    return {sheet.title: [[cell.value for cell in row] for row in sheet.iter_rows()] for sheet in workbook}
+
+
+def _sheets():
+    headers = ['First Name', 'Units', 'NRC']
+    day_rows = [{'First Name': f'W{n}', 'Units': n * 1.5 if n % 3 else n, 'NRC': 'N/A' if n % 4 else n}
+                for n in range(7)]
+    return [('Per Day', headers, iter(day_rows)), ('Per Part', headers, iter([])),
+            ('Per Hour', ['Name'], iter([{'Name': None}, {'Name': 'Ann'}]))]
+
+
+def test_render_pool_writes_the_same_workbook_as_in_process():
+    from report_export import render_xlsx
+
+    in_process, pooled = io.BytesIO(), io.BytesIO()
+    render_xlsx(in_process, _sheets(), isolate=False)
+    # Two rows per batch, so sheets span several spooled batches with mixed column types
+    render_xlsx(pooled, _sheets(), batch_rows=2, isolate=True)
+
+    assert _cells(pooled.getvalue()) == _cells(in_process.getvalue())
+    assert _cells(pooled.getvalue())['Per Day'][1:3] == [['W0', 0, 0], ['W1', 1.5, 'N/A']]
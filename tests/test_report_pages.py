@@ -0,0 +1,91 @@
+"""Tests for keyset pages of report rows behind /api/reports/rows and the reports page"""
+
+from datetime import date
+import json
+
+import pytest
+
+from models import Worker
+from report_pipeline import build_report_page, build_report_records
+
+START, END = date(2026, 9, 1), date(2026, 9, 30)
+
+
+@pytest.fixture
+def company(factory):
+    factory.import_field('NRC')
+    dig = factory.task('Dig', 'per_day', per_day_payout=60.0)
+    weed = factory.task('Weed', 'per_day', per_day_payout=40.0)
+    factory.report_field('Pay', 'attendance_days * daily_rate')
+    # Several workers share a day count and a name, so sort keys tie
+    for number, days in enumerate([3, 1, 3, 2, 3, 1, 2]):
+        worker = factory.worker('Ann' if number % 2 else 'Ben', str(number), NRC=f'{number}/1')
+        for day in range(1, days + 1):
+            factory.attendance(worker, dig, day)
+        if number % 3 == 0:
+            factory.attendance(worker, weed, 10)
+    factory.refresh()
+    return factory
+
+
+def _pages(company, sort, descending=False, columns=('worker_id', 'task_id'), limit=3):
+    """Every page's rows, passing next through JSON as the cursor does"""
+    pages, after = [], None
+    while True:
+        page = build_report_page(company, START, END, 'per_day', list(columns), sort=sort, descending=descending,
+                                 after=after, limit=limit, include_total=after is None)
+        pages.append(page['rows'])
+        if page['next'] is None:
+            return pages
+        after = json.loads(json.dumps(page['next']))
+
+
+@pytest.mark.parametrize('sort, descending', [
+    ('worker_id', False), ('worker_id', True), ('attendance_days', True), ('last_name', False),
+    ('first_name', False), ('task_name', True), ('Pay', True), ('NRC', False),
+])
+def test_pages_cover_every_row_once_in_order(company, sort, descending):
+    records = build_report_records(company.company, START, END, payment_types=('per_day',))['per_day']
+    pages = _pages(company.company, sort, descending, columns=('worker_id', 'task_id', sort))
+    rows = [row for page in pages for row in page]
+
+    assert all(len(page) == 3 for page in pages[:-1])
+    assert sorted((row['worker_id'], row['task_id']) for row in rows) == sorted(
+        (record['worker_id'], record['task_id']) for record in records
+    )
+    values = [row[sort] for row in rows]
+    assert values == sorted(values, reverse=descending)
+
+
+def test_first_page_carries_the_total(company):
+    page = build_report_page(company.company, START, END, 'per_day', ['worker_id'], limit=3, include_total=True)
+
+    assert page['total'] == 10
+    assert 'total' not in build_report_page(company.company, START, END, 'per_day', ['worker_id'],
+                                            after=page['next'], limit=3)
+
+
+def test_rows_added_before_the_cursor_do_not_shift_later_pages(company):
+    first = build_report_page(company.company, START, END, 'per_day', ['worker_id', 'task_id'], limit=3)
+    rest_before = _pages(company.company, 'worker_id')[1:]
+
+    # The first worker's rows are all on the first page
+    company.attendance(Worker.query.order_by(Worker.id).first(), company.task('Late Dig', 'per_day'), 5)
+    company.refresh()
+    after = json.loads(json.dumps(first['next']))
+    rest = []
+    while after is not None:
+        page = build_report_page(company.company, START, END, 'per_day', ['worker_id', 'task_id'], after=after,
+                                 limit=3)
+        rest.append(page['rows'])
+        after = page['next']
+
+    assert rest == rest_before
+
+
+def test_rows_hold_only_the_requested_columns(company):
+    page = build_report_page(company.company, START, END, 'per_day', ['first_name', 'Pay', 'NRC'], sort='Pay',
+                             descending=True, limit=2)
+
+    assert [sorted(row) for row in page['rows']] == [['NRC', 'Pay', 'first_name']] * 2
+    assert [row['Pay'] for row in page['rows']] == [180.0, 180.0]
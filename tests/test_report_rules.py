@@ -0,0 +1,47 @@
+"""Tests for which attendance becomes a report row, per endpoint"""
+
+from datetime import date, datetime
+
+import pytest
+
+from report_pipeline import build_report_records, workbook_records
+
+START, END = date(2026, 9, 1), date(2026, 9, 30)
+
+
+@pytest.fixture
+def attendance(factory):
+    ann = factory.worker('Ann')
+    dig = factory.task('Dig', 'per_day', per_day_payout=60.0, per_day_currency='ZMW')
+    pack = factory.task('Pack', 'per_part', per_part_payout=2.5, per_part_currency='ZMW')
+    drive = factory.task('Drive', 'per_hour', per_hour_payout=10.0, per_hour_currency='USD')
+    late = factory.task('Late', 'per_day', start_date=datetime(2026, 12, 1))
+    factory.attendance(ann, dig, 1, status='Absent')
+    factory.attendance(ann, pack, 1, units=0)
+    factory.attendance(ann, pack, 2, status='Absent')
+    factory.attendance(ann, drive, 1, hours=0.0)
+    factory.attendance(ann, late, 2)
+    factory.refresh()
+    return factory
+
+
+def _rows(report, payout_type, quantity_key):
+    return [(record['task_name'], record[quantity_key]) for record in report[payout_type]]
+
+
+def test_reports_keep_empty_part_and_hour_rows_of_started_tasks(attendance):
+    report = build_report_records(attendance.company, START, END)
+
+    assert _rows(report, 'per_day', 'attendance_days') == []
+    assert _rows(report, 'per_part', 'units_completed') == [('Pack', 0)]
+    assert _rows(report, 'per_hour', 'hours_worked') == [('Drive', 0)]
+
+
+def test_workbook_needs_something_to_pay_but_not_a_started_task(attendance):
+    report = workbook_records(attendance.company, START, END)
+    per_day = list(report['per_day'])
+
+    assert [(record['task_name'], record['attendance_days']) for record in per_day] == [('Late', 1)]
+    assert list(report['per_part']) == []
+    # The workbook's per-day rate is the company's, even where the task has its own
+    assert per_day[0]['daily_rate'] == 56.0
@@ -0,0 +1,72 @@
+"""Tests for a worker's paged earnings history"""
+
+from datetime import date
+
+import pytest
+
+from report_pipeline import build_worker_history
+
+
+@pytest.fixture
+def history(factory):
+    ann, ben = factory.worker('Ann'), factory.worker('Ben')
+    dig = factory.task('Dig', 'per_day', per_day_payout=60.0, per_day_currency='ZMW')
+    weed = factory.task('Weed', 'per_day')
+    pack = factory.task('Pack', 'per_part', per_part_payout=2.5, per_part_currency='ZMW')
+    drive = factory.task('Drive', 'per_hour', per_hour_payout=10.0, per_hour_currency='USD')
+    for day in range(1, 8):
+        factory.attendance(ann, dig, day, status='Absent' if day == 3 else 'Present')
+        factory.attendance(ann, pack, day, units=day)
+        if day % 2:
+            factory.attendance(ann, drive, day, hours=1.5)
+            factory.attendance(ann, weed, day)
+        factory.attendance(ben, dig, day)
+    factory.refresh()
+    return factory.company, ann
+
+
+def _paged(company, worker, descending, limit):
+    entries, after = [], None
+    while True:
+        page = build_worker_history(company, worker.id, date(2026, 9, 2), date(2026, 9, 30), descending=descending,
+                                    after=after, limit=limit)
+        entries += page['entries']
+        if page['next'] is None:
+            return entries
+        day, task_id = page['next']['after']
+        after = (date.fromisoformat(day), task_id)
+
+
+@pytest.mark.parametrize('descending', [False, True])
+@pytest.mark.parametrize('limit', [1, 2, 5])
+def test_pages_give_the_totals_of_one_full_read(history, descending, limit):
+    company, ann = history
+    full = build_worker_history(company, ann.id, date(2026, 9, 2), date(2026, 9, 30), descending=descending,
+                                limit=1000)
+
+    assert full['next'] is None
+    assert _paged(company, ann, descending, limit) == full['entries']
+
+
+def test_running_totals_count_from_the_start_of_the_range(history):
+    company, ann = history
+    entries = build_worker_history(company, ann.id, date(2026, 9, 2), date(2026, 9, 30), limit=1000)['entries']
+
+    last = {}
+    for entry in entries:
+        last[entry['currency']] = entry['running_total']
+    # Dig 5 present days, Weed 3 days at the company rate, Pack 2..7 units, Drive 3 days of 1.5 hours
+    assert last == {'ZMW': 5 * 60.0 + 3 * 56.0 + 27 * 2.5, 'USD': 45.0}
+    descending = build_worker_history(company, ann.id, date(2026, 9, 2), date(2026, 9, 30), descending=True,
+                                      limit=1000)['entries']
+    first = {}
+    for entry in descending:
+        first.setdefault(entry['currency'], entry['running_total'])
+    assert first == last
+
+
+def test_cursor_carries_only_a_position(history):
+    company, ann = history
+    page = build_worker_history(company, ann.id, descending=True, limit=2)
+
+    assert set(page['next']) == {'after'}